@@ -0,0 +1,184 @@
+"""
+acs_variables.py
+
+Requests only the ACS variables the site actually uses instead of whole groups like group(DP03),
+which return hundreds of estimate, margin of error and annotation columns.
+
+The variables are found by scanning the jinja templates and the Python scripts that read Census
+data for the variable codes (DP03_0088E) and labels ('Estimate!!SEX AND AGE!!Total population')
+they reference. Labels are matched exactly, and a string starting with ^ is used as a regex
+(like the industry filter in section_5.py). Labels come from the dataset's variables.json,
+which is kept in the response cache so it is only downloaded once per dataset and year.
+
+usage:
+    county_econ_data = AcsData(['acs','acs5','profile'], 2019, 'DP03', {'in': "state:04", 'for': "county:027,012"})
+    clean_acs_df = county_econ_data.clean_df().set_index("NAME")
+"""
+from __future__ import annotations
+import functools
+import glob
+import re
+from typing import TYPE_CHECKING
+import requests
+from pyCensus import BASE_URL
+from data_cache import cached_fetch, cached_payload
+from data_sources import census_data, census_request
+from fetch_executor import rate_limited
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+#files that reference ACS variables
+SOURCE_FILES = sorted(glob.glob('templates/*.jinja')) + ['section_5.py']
+
+#the Census API allows up to 50 variables per request, one is always used for NAME
+MAX_VARIABLES_PER_REQUEST = 50
+
+#geography columns returned with every request, used to join the requests back together
+GEOGRAPHY_COLUMNS = ['NAME', 'state', 'county', 'place', 'us']
+
+VARIABLE_CODE_PATTERN = re.compile(r"\b[A-Z]+\d+[A-Z]?_\d{3,4}[A-Z]{1,3}\b")
+LABEL_PATTERN = re.compile(r"""(['"])([^'"\n]*!![^'"\n]*)\1""")
+
+@functools.lru_cache(maxsize=None)
+def load_variables(dataset:tuple, year:int) -> dict:
+    """
+    Reads the variables.json for a dataset from the response cache, downloading it if needed.
+    Arguments:
+        - dataset = tuple; dataset name path, like ('acs','acs5','profile')
+        - year = int; year of the dataset
+    Returns dict mapping each variable code to its label.
+    """
+    def fetch() -> dict:
+        response = requests.get(f"{BASE_URL}{year}/{'/'.join(dataset)}/variables.json")
+        response.raise_for_status()
+        return response.json()
+
+    json_vars = cached_fetch('census', variables_request(dataset, year), rate_limited('census', fetch))
+    return {var: name['label'] for var, name in json_vars['variables'].items()}
+
+def variables_request(dataset:tuple, year:int) -> dict:
+    """
+    Returns the request the variables.json of a dataset is cached under.
+    """
+    return {'dataset': list(dataset), 'year': int(year), 'variables': True}
+
+def scan_references(source_files:list=SOURCE_FILES) -> tuple:
+    """
+    Finds the ACS variable codes and labels referenced in the source files.
+    Arguments:
+        - source_files = list; paths to the templates and scripts to scan
+    Returns tuple of (set of variable codes, set of label strings)
+    """
+    codes, labels = set(), set()
+    for source_file in source_files:
+        with open(source_file, encoding='utf-8') as source:
+            text = source.read()
+        codes.update(VARIABLE_CODE_PATTERN.findall(text))
+        labels.update(match[1] for match in LABEL_PATTERN.findall(text))
+    return codes, labels
+
+def used_variables(dataset:tuple, year:int, group:str, source_files:list=SOURCE_FILES) -> list:
+    """
+    Finds the variables in a group that are referenced in the source files.
+    Arguments:
+        - dataset = tuple; dataset name path, like ('acs','acs5','profile')
+        - year = int; year of the dataset
+        - group = str; variable group, like 'DP03'
+        - source_files = list; paths to the templates and scripts to scan
+    Returns sorted list of variable codes.
+    """
+    return match_variables(load_variables(tuple(dataset), year), group, source_files)
+
+def match_variables(variable_labels:dict, group:str, source_files:list=SOURCE_FILES) -> list:
+    """
+    Picks the variables of a group whose code or label is referenced in the source files.
+    Arguments:
+        - variable_labels = dict; mapping of variable code to label, see load_variables()
+        - group = str; variable group, like 'DP03'
+        - source_files = list; paths to the templates and scripts to scan
+    Returns sorted list of variable codes.
+    """
+    codes, labels = scan_references(source_files)
+    patterns = [re.compile(label) for label in labels if label.startswith('^')]
+    variables = {
+        var for var, label in variable_labels.items()
+        if var.startswith(f"{group}_")
+        and (var in codes or label in labels or any(pattern.match(label) for pattern in patterns))
+    }
+    if not variables:
+        raise ValueError(f"No {group} variables are referenced in {', '.join(source_files)}")
+    return sorted(variables)
+
+def variable_chunks(variables:list) -> list:
+    """
+    Splits variables into groups small enough for one request each.
+    Returns list of lists of variable codes.
+    """
+    chunk_size = MAX_VARIABLES_PER_REQUEST - 1
+    return [variables[start:start + chunk_size] for start in range(0, len(variables), chunk_size)]
+
+class AcsData():
+    """
+    Requests the variables of an ACS group that the site uses, split across as many requests as
+    the Census variable limit needs. Has the same df, year and clean_df() as censusData.
+
+    Arguments:
+        - dataset = list; dataset name path, like ['acs','acs5','profile']
+        - year = int; year of the dataset
+        - group = str; variable group, like 'DP03'
+        - geography = dict; the 'for' and 'in' parts of the query
+        - source_files = list; paths to the templates and scripts to scan for variables
+    """
+    def __init__(self, dataset:list, year:int, group:str, geography:dict, source_files:list=SOURCE_FILES):
+
+        self.dataset = dataset
+        self.year = year
+        self.group = group
+        self.variables = used_variables(tuple(dataset), year, group, source_files)
+
+        #request each chunk of variables and join them on the geography columns
+        df = None
+        for chunk in variable_chunks(self.variables):
+            chunk_df = census_data(dataset, year, {'get': ','.join(['NAME'] + chunk), **geography}).df
+            if df is None:
+                df = chunk_df
+            else:
+                keys = [col for col in GEOGRAPHY_COLUMNS if col in df.columns]
+                df = df.merge(chunk_df, on=keys)
+        self.df = df
+
+    @staticmethod
+    def planned_requests(dataset:list, year:int, group:str, geography:dict, source_files:list=SOURCE_FILES) -> list:
+        """
+        Works out the requests an AcsData with these arguments would send, without sending them.
+        The variables come from variables.json, so until it has been downloaded only its request
+        is listed.
+        Returns list of (source, request) tuples, see data_cache.cache_status().
+        """
+        request = variables_request(tuple(dataset), year)
+        json_vars = cached_payload('census', request)
+        if json_vars is None:
+            return [('census', request)]
+        variable_labels = {var: name['label'] for var, name in json_vars['variables'].items()}
+        return [('census', request)] + [
+            ('census', census_request(dataset, year, {'get': ','.join(['NAME'] + chunk), **geography}))
+            for chunk in variable_chunks(match_variables(variable_labels, group, source_files))
+        ]
+
+    def clean_df(self, index_col:str=None, replace_col_names:bool=True) -> pd.DataFrame:
+        """
+        Replaces the column names with the variable labels.
+        Arguments:
+            - index_col = str; The column that should be the index column
+            - replace_col_names = bool; True will replace column names with the variable labels,
+                                        False will leave columns named with variable ID.
+        Returns pandas dataframe
+        """
+        clean_df = self.df.copy()
+        if index_col:
+            clean_df = clean_df.set_index(index_col)
+        if replace_col_names:
+            labels = load_variables(tuple(self.dataset), self.year)
+            clean_df = clean_df.rename(columns={var: labels[var] for var in self.variables})
+        return clean_df
@@ -0,0 +1,259 @@
+"""
+artifacts.py
+
+Writes plotly figures (graphs and tables) to the graphs/ and tables/ directories. Figures can be
+written in two formats, chosen with the WAEDD_FIGURE_OUTPUT environment variable:
+    - html = a standalone html document per figure that is embedded with an iframe (default)
+    - json = compact figure json that is mounted on the page by js/plotly-figures.js, so plotly.js
+             is loaded once per page instead of once per figure
+    - both = write both formats
+
+Tables have their own setting, WAEDD_TABLE_OUTPUT:
+    - plotly = write tables like any other figure, using WAEDD_FIGURE_OUTPUT (default)
+    - static = write plain html <table> markup with no javascript (see html_table.py) to
+               {path}.table.html, which can be put straight into a page
+    - both = write both
+
+Figures are passed around by their path without an extension (./graphs/mean_weekly_wage) and the
+extension is added for each format that is written.
+
+Every output (figures, tables and the pages from render.py) goes through one ArtifactWriter. It
+serializes and writes on a thread pool so writing overlaps with building the next figure, and
+each file is written to a temp file next to it and renamed into place, so the site never serves a
+half written file. Figure json is encoded with orjson when it is installed. Writes are finished
+by flush(), which BuildManifest.save() calls, so a file is never recorded before it exists.
+WAEDD_PUBLISH chooses when the finished files replace the live ones:
+    - each = as soon as each file is written (default)
+    - together = all at once in flush(), and only if every write in the run succeeded. A failed
+                 run leaves every live file as it was. build.py keeps the files its worker
+                 processes write staged and publishes them once every node has succeeded
+
+usage:
+    for path in write_figure(fig, './graphs/mean_weekly_wage'):
+        manifest.record(path, fingerprint)
+    ...
+    flush()
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import html_table
+from tracing import annotate, span
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+FIGURE_OUTPUT = os.environ.get('WAEDD_FIGURE_OUTPUT', 'html')
+FIGURE_FORMATS = {'html': ['html'], 'json': ['json'], 'both': ['html', 'json']}
+TABLE_OUTPUT = os.environ.get('WAEDD_TABLE_OUTPUT', 'plotly')
+TABLE_FORMATS = ['plotly', 'static', 'both']
+PUBLISH_MODE = os.environ.get('WAEDD_PUBLISH', 'each')
+PUBLISH_MODES = ['each', 'together']
+JSON_ENGINE = 'orjson' if orjson else 'json'
+
+#files that change how figures and tables are serialized, for build_manifest.code_version()
+ARTIFACT_SOURCES = [__file__, html_table.__file__]
+
+class ArtifactWriter():
+    """
+    Serializes and writes output files on a thread pool. Each file is written to a temp file and
+    renamed into place.
+
+    Arguments:
+        max_workers = int; number of writer threads
+        publish = str; 'each' to rename each file into place when it is written, 'together' to
+                  rename them all in flush() once every write has succeeded
+    """
+    def __init__(self, max_workers:int=4, publish:str=PUBLISH_MODE):
+
+        if publish not in PUBLISH_MODES:
+            raise ValueError(f"Invalid WAEDD_PUBLISH. Expected one of: {', '.join(PUBLISH_MODES)}")
+        self.publish = publish
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='artifact-writer')
+        self._lock = threading.Lock()
+        self._pending = []
+        self._staged = []
+
+    def submit(self, path:str, serialize, *args):
+        """
+        Queues a file to be written.
+        Arguments:
+            - path = str; the file to write
+            - serialize = callable; called with args on a writer thread, returns the str contents
+            - args = arguments for serialize
+        """
+        with self._lock:
+            self._pending.append(self._pool.submit(self._write, path, serialize, *args))
+
+    def _write(self, path:str, serialize, *args):
+        with span(f"write {path}", 'write'):
+            text = serialize(*args).encode('utf-8')
+            annotate(bytes=len(text))
+            tmp_path = f"{path}.tmp{os.getpid()}.{threading.get_ident()}"
+            with open(tmp_path, 'wb') as tmp_file:
+                tmp_file.write(text)
+            if self.publish == 'each':
+                os.replace(tmp_path, path)
+            else:
+                with self._lock:
+                    self._staged.append((tmp_path, path))
+
+    def _finish(self) -> tuple:
+        """
+        Waits for every queued write. Returns tuple of (write errors, staged files).
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+        errors = [future.exception() for future in pending]
+        errors = [err for err in errors if err is not None]
+        with self._lock:
+            staged, self._staged = self._staged, []
+        return errors, staged
+
+    def flush(self, keep_staged:bool=False) -> list:
+        """
+        Waits for every queued write. In 'together' mode the written files are renamed into
+        place here, or all thrown away if any write failed. Raises the first write error.
+        Arguments:
+            - keep_staged = bool; leave the files staged and return them instead of renaming them,
+                            for publish_staged() once the rest of the build has succeeded
+        Returns list of (temp path, path) tuples, empty unless keep_staged is True.
+        """
+        errors, staged = self._finish()
+        if errors:
+            discard_staged(staged)
+            raise errors[0]
+        if keep_staged:
+            return staged
+        publish_staged(staged)
+        return []
+
+    def discard(self):
+        """
+        Waits for every queued write and throws away the files that haven't been published.
+        """
+        discard_staged(self._finish()[1])
+
+def publish_staged(staged:list):
+    """
+    Renames staged files into place.
+    Arguments:
+        - staged = list; (temp path, path) tuples returned by flush(keep_staged=True)
+    """
+    for tmp_path, path in staged:
+        os.replace(tmp_path, path)
+
+def discard_staged(staged:list):
+    """
+    Removes staged files without publishing them.
+    Arguments:
+        - staged = list; (temp path, path) tuples returned by flush(keep_staged=True)
+    """
+    for tmp_path, _ in staged:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+
+#shared by every script in this process
+_writer = ArtifactWriter()
+
+def write_text(path:str, serialize, *args):
+    """
+    Queues a file on the shared writer, see ArtifactWriter.submit().
+    """
+    _writer.submit(path, serialize, *args)
+
+def flush(keep_staged:bool=False) -> list:
+    """
+    Waits for every file queued on the shared writer, see ArtifactWriter.flush().
+    """
+    return _writer.flush(keep_staged)
+
+def discard():
+    """
+    Throws away every unpublished file on the shared writer, see ArtifactWriter.discard().
+    """
+    _writer.discard()
+
+def figure_paths(figure_path:str) -> list:
+    """
+    Lists the files written for a figure in the current output mode.
+    Arguments:
+        - figure_path = str; path of the figure without an extension
+    Returns list of str
+    """
+    if FIGURE_OUTPUT not in FIGURE_FORMATS:
+        raise ValueError(f"Invalid WAEDD_FIGURE_OUTPUT. Expected one of: {', '.join(FIGURE_FORMATS)}")
+    return [f"{figure_path}.{extension}" for extension in FIGURE_FORMATS[FIGURE_OUTPUT]]
+
+def figure_json(fig) -> str:
+    """
+    Serializes a figure for js/plotly-figures.js. The plotly.js version the figure was built for is
+    included so the page loads that exact version instead of plotly-latest.
+    Arguments:
+        - fig = plotly figure
+    Returns str
+    """
+    #plotly is only imported once a figure is written, so importing this module stays fast
+    import plotly.io as pio
+    from plotly.offline import get_plotlyjs_version
+
+    figure = fig.to_plotly_json()
+    figure['config'] = {'displaylogo': False, 'responsive': True}
+    figure['plotlyjsVersion'] = get_plotlyjs_version()
+    return pio.to_json(figure, validate=False, engine=JSON_ENGINE)
+
+def figure_html(fig) -> str:
+    """
+    Serializes a figure as a standalone html document that loads plotly.js from the CDN.
+    Arguments:
+        - fig = plotly figure
+    Returns str
+    """
+    import plotly.io as pio
+    return pio.to_html(fig, include_plotlyjs='cdn')
+
+def write_figure(fig, figure_path:str) -> list:
+    """
+    Queues a figure to be written in every format for the current output mode.
+    Arguments:
+        - fig = plotly figure
+        - figure_path = str; path of the figure without an extension
+    Returns list of the paths that were written.
+    """
+    paths = figure_paths(figure_path)
+    for path in paths:
+        write_text(path, figure_json if path.endswith('.json') else figure_html, fig)
+    return paths
+
+def table_paths(table_path:str) -> list:
+    """
+    Lists the files written for a table in the current output modes.
+    Arguments:
+        - table_path = str; path of the table without an extension
+    Returns list of str
+    """
+    if TABLE_OUTPUT not in TABLE_FORMATS:
+        raise ValueError(f"Invalid WAEDD_TABLE_OUTPUT. Expected one of: {', '.join(TABLE_FORMATS)}")
+    paths = figure_paths(table_path) if TABLE_OUTPUT in ('plotly', 'both') else []
+    if TABLE_OUTPUT in ('static', 'both'):
+        paths.append(f"{table_path}.table.html")
+    return paths
+
+def write_table(table, table_path:str) -> list:
+    """
+    Queues a go.Table figure to be written in every format for the current output modes.
+    Arguments:
+        - table = plotly.graph_objects.Figure; a figure containing a single go.Table
+        - table_path = str; path of the table without an extension
+    Returns list of the paths that were written.
+    """
+    paths = table_paths(table_path)
+    if TABLE_OUTPUT in ('plotly', 'both'):
+        write_figure(table, table_path)
+    if TABLE_OUTPUT in ('static', 'both'):
+        write_text(f"{table_path}.table.html", html_table.figure_to_table, table)
+    return paths
@@ -0,0 +1,101 @@
+"""
+import_time.py
+
+Checks that the site scripts still start quickly. Each module is imported in a fresh interpreter
+with `python -X importtime`, and the check fails if:
+    - the module takes longer to import than its budget in IMPORT_BUDGETS
+    - importing it pulls in one of the HEAVY_MODULES (pandas, plotly and the API packages), which
+      should only be imported once a script builds something
+
+The slowest imports are printed for every module that fails, so the import that went back to
+the top of a module is easy to find. Budgets are generous because timings depend on the machine,
+the heavy module check doesn't.
+
+usage:
+    python benchmarks/import_time.py                    #check every module
+    python benchmarks/import_time.py --module build     #check one module
+    python benchmarks/import_time.py --scale 2          #double every budget on a slow machine
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+#seconds each module may take to import, the cumulative time -X importtime reports for it
+IMPORT_BUDGETS = {
+    'build': 0.4,
+    'section_3': 0.3,
+    'section_5': 0.3,
+    'distress': 0.3,
+    'profiles': 0.3,
+    'freshness': 0.3,
+}
+
+#packages that take longer to import than planning a whole build
+HEAVY_MODULES = ['pandas', 'numpy', 'plotly', 'bls_data', 'pyCensus.censusdata', 'bea_data']
+
+#slowest imports printed for a module that fails
+SLOWEST_SHOWN = 8
+
+IMPORTTIME_PATTERN = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$")
+
+def import_times(module:str) -> list:
+    """
+    Imports a module in a fresh interpreter with -X importtime.
+    Arguments:
+        - module = str; name of the module to import
+    Returns list of (name, cumulative seconds) tuples, one for every module that was imported.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"],
+                            cwd=REPO_DIR, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"importing {module} failed:\n{result.stderr}")
+
+    times = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_PATTERN.match(line)
+        if match:
+            times.append((match[4], int(match[2]) / 1e6))
+    return times
+
+def check_module(module:str, budget:float) -> list:
+    """
+    Checks one module against its budget and the heavy modules.
+    Returns list of problems, empty if the module passed.
+    """
+    times = import_times(module)
+    total = dict(times)[module]
+    heavy = [name for name,_ in times if name in HEAVY_MODULES]
+
+    problems = []
+    if total > budget:
+        problems.append(f"took {total:.3f}s, the budget is {budget:.3f}s")
+    if heavy:
+        problems.append(f"imports {', '.join(heavy)}")
+    print(f"{module}: {total:.3f}s (budget {budget:.3f}s)" + (f" FAILED, {'; '.join(problems)}" if problems else ""))
+    if problems:
+        for name, seconds in sorted(times, key=lambda x: x[1], reverse=True)[1:SLOWEST_SHOWN + 1]:
+            print(f"    {name}: {seconds:.3f}s")
+    return problems
+
+def main():
+    """
+    Checks every module, or the ones given, and exits with an error if any of them failed.
+    """
+    ap = argparse.ArgumentParser(description="Checks how long the site scripts take to import.")
+    ap.add_argument('--module', action='append', choices=list(IMPORT_BUDGETS), help="module to check, can be given more than once")
+    ap.add_argument('--scale', type=float, default=1.0, help="multiply every budget by this much")
+    args = ap.parse_args()
+
+    failed = [module for module in (args.module or IMPORT_BUDGETS)
+              if check_module(module, IMPORT_BUDGETS[module] * args.scale)]
+    if failed:
+        print(f"import time check failed for {', '.join(failed)}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
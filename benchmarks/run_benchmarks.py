@@ -0,0 +1,373 @@
+"""
+run_benchmarks.py
+
+Times every stage of the site scripts against the stand-in API server in standin_api.py, so
+refresh timings are repeatable and don't depend on the real APIs. Each scenario runs in a scratch
+copy of the site with an empty cache, so every run is a cold build:
+    - section_3 = fetch (batched BLS requests), clean (BLS dataframes), plot and write for every
+                  bls_config.yaml section
+    - population = fetch (workbook downloads), clean (reading the workbooks), plot and write
+    - distress = fetch (BLS, Census and BEA), compute (criteria matrix), plot and write
+    - section_5 = fetch (BLS and ACS), compute (the template context), render and write
+
+Stages that happen inside a build function are timed by wrapping the functions that do them
+(like write_figure), and the rest of the build is counted as plot or render. Files are written on
+the artifact writer's threads while the build carries on, so write is the time spent queueing
+files plus waiting for the writer to finish at the end. Timings are the median of --repeat runs.
+
+Timings can be saved as a baseline, and --check exits with an error if any stage is more than
+--tolerance slower than the baseline or a scenario fails.
+
+usage:
+    python benchmarks/run_benchmarks.py                             #print stage timings
+    python benchmarks/run_benchmarks.py --save-baseline             #store timings as the baseline
+    python benchmarks/run_benchmarks.py --check                     #compare against the baseline
+    python benchmarks/run_benchmarks.py --regions 15 --series 200   #scale up the regions and series
+    python benchmarks/run_benchmarks.py --latency 0.1 --failure-rate 0.05 --scenario distress
+"""
+import argparse
+import importlib
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import yaml
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+BASELINE_FILE = os.path.join(BENCHMARK_DIR, 'baseline.json')
+SCENARIOS = ['section_3', 'population', 'distress', 'section_5']
+
+#files and directories copied into the scratch site for each run
+SITE_FILES = ['bls_config.yaml', 'distress_regions.yaml', 'table_rules.yaml', 'section_5.py', 'templates']
+
+#stages shorter than this are never counted as regressions, they are mostly noise
+MIN_REGRESSION_SECONDS = 0.05
+
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+class StageTimer():
+    """
+    Adds up the time spent in each stage. Safe to use from several threads.
+    """
+    def __init__(self):
+
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage:str, seconds:float):
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def time(self, stage:str, func, *args, **kwargs):
+        """
+        Calls func and adds its run time to the stage. Returns the result of func.
+        """
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def time_build(self, remainder_stage:str, sub_stages:list, func, *args, **kwargs):
+        """
+        Times a build function, counting the time that isn't in one of the wrapped sub stages as
+        remainder_stage.
+        """
+        before = sum(self.stages.get(stage, 0.0) for stage in sub_stages)
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        inside = sum(self.stages.get(stage, 0.0) for stage in sub_stages) - before
+        self.add(remainder_stage, max(elapsed - inside, 0.0))
+        return result
+
+def attribute(timer:StageTimer, module, func_name:str, stage:str):
+    """
+    Replaces a function in a module namespace with one that adds its run time to a stage.
+    """
+    func = getattr(module, func_name)
+    setattr(module, func_name, lambda *args, **kwargs: timer.time(stage, func, *args, **kwargs))
+
+#####
+## Scratch site ##
+#####
+
+def scale_bls_config(bls_config:list, series_count:int) -> list:
+    """
+    Adds a section with series_count county unemployment series to the bls_config.yaml sections.
+    """
+    from bls_data import la_area_codes_df
+    if not series_count:
+        return bls_config
+    area_codes = [code for code in la_area_codes_df.index if code.startswith('CN')][:series_count]
+    return bls_config + [{
+        'seriesIDs': [f"LAU{code}03" for code in area_codes],
+        'start_year': 2015,
+        'end_year': 2021,
+        'filename': 'benchmark_scale',
+        'graph_name': 'Benchmark Scale',
+        'graph_type': 'line',
+        #county names repeat across states, so label each line with its area code
+        'custom_column_names': {f"LAU{code}03": code for code in area_codes},
+    }]
+
+def scale_distress_config(distress_config:dict, region_count:int) -> dict:
+    """
+    Extends the distress regions to region_count Arizona counties and then places.
+    """
+    from bls_data import la_area_codes_df
+    from geography import GEOGRAPHY_FILE, GeographyIndex
+    if not region_count:
+        return distress_config
+    index = GeographyIndex(os.path.join(REPO_DIR, GEOGRAPHY_FILE))
+    regions = [index.resolve(region) for region in distress_config['regions']]
+    known = {region['census'] for region in regions}
+    for code in la_area_codes_df.index:
+        if len(regions) >= region_count:
+            break
+        if code.startswith('CN04'):
+            census, bea = f"county:{code[4:7]}", f"04{code[4:7]}"
+        elif code.startswith('CT04'):
+            census, bea = f"place:{code[4:9]}", None
+        else:
+            continue
+        if census in known:
+            continue
+        region = {'name': la_area_codes_df.loc[code]['area_text'].replace(', AZ', ''),
+                  'census': census, 'bls': f"LAU{code}03", 'filename': f"benchmark_{code}_distress"}
+        if bea:
+            region['bea'] = bea
+        regions.append(region)
+        known.add(census)
+    return dict(distress_config, regions=regions[:region_count])
+
+def make_site(work_dir:str, args):
+    """
+    Creates a scratch copy of the site in work_dir with the scaled configs and empty output
+    directories.
+    """
+    from geography import GEOGRAPHY_FILE
+    for name in SITE_FILES:
+        source = os.path.join(REPO_DIR, name)
+        if os.path.isdir(source):
+            shutil.copytree(source, os.path.join(work_dir, name))
+        else:
+            shutil.copy(source, work_dir)
+    for name in ('graphs', 'tables', 'waedd_data'):
+        os.makedirs(os.path.join(work_dir, name), exist_ok=True)
+    shutil.copy(os.path.join(REPO_DIR, GEOGRAPHY_FILE), os.path.join(work_dir, GEOGRAPHY_FILE))
+
+    with open(os.path.join(REPO_DIR, 'bls_config.yaml')) as bls_yaml:
+        bls_config = yaml.load(bls_yaml, Loader=yaml.FullLoader)
+    with open(os.path.join(work_dir, 'bls_config.yaml'), 'w') as bls_yaml:
+        yaml.dump(scale_bls_config(bls_config, args.series), bls_yaml)
+
+    with open(os.path.join(REPO_DIR, 'distress_regions.yaml')) as distress_yaml:
+        distress_config = yaml.load(distress_yaml, Loader=yaml.FullLoader)
+    with open(os.path.join(work_dir, 'distress_regions.yaml'), 'w') as distress_yaml:
+        yaml.dump(scale_distress_config(distress_config, args.regions), distress_yaml)
+
+def load_site_modules(server_url:str) -> dict:
+    """
+    Imports the site modules fresh (they read their config and cache location on import) and
+    points them at the stand-in server.
+    """
+    modules = {}
+    for name in ['geography', 'data_cache', 'fetch_executor', 'bls_store', 'bls_batch', 'data_sources', 'table_rules',
+                 'html_table', 'artifacts', 'build_manifest', 'population_data', 'acs_variables', 'render',
+                 'section_3', 'distress', 'section_5']:
+        if name in sys.modules:
+            del sys.modules[name]
+    import pyCensus.censusdata
+    pyCensus.censusdata.BASE_URL = f"{server_url}/data/"
+    for name in ['artifacts', 'bls_batch', 'data_sources', 'population_data', 'acs_variables', 'render',
+                 'section_3', 'distress', 'section_5', 'build_manifest']:
+        modules[name] = importlib.import_module(name)
+
+    modules['bls_batch'].BLS_URL = f"{server_url}/bls/"
+    modules['data_sources'].BEA_API_URL = f"{server_url}/bea/"
+    modules['acs_variables'].BASE_URL = f"{server_url}/data/"
+    population_data = modules['population_data']
+    population_data.POP_EST_EXCEL_URL = f"{server_url}/workbooks/{population_data.POP_EST_EXCEL_URL.split('/')[-1]}"
+    population_data.POP_PREDICTION_EXCEL_URL = f"{server_url}/workbooks/{population_data.POP_PREDICTION_EXCEL_URL.split('/')[-1]}"
+    return modules
+
+#####
+## Scenarios ##
+#####
+
+def run_section_3(modules:dict, timer:StageTimer):
+    bls_batch, section_3 = modules['bls_batch'], modules['section_3']
+    attribute(timer, section_3, 'write_figure', 'write')
+    attribute(timer, section_3, 'write_table', 'write')
+    manifest = modules['build_manifest'].BuildManifest()
+
+    timer.time('fetch', bls_batch.prefetch_bls_data)
+    sections = section_3.load_bls_config()
+    for waedd_section in sections:
+        timer.time('clean', lambda: bls_batch.get_bls_data(waedd_section['filename']).clean_df(waedd_section.get('custom_column_names')))
+    for waedd_section in sections:
+        timer.time_build('plot', ['write'], section_3.build_bls_section, waedd_section, manifest)
+    timer.time('write', modules['artifacts'].flush)
+
+def run_population(modules:dict, timer:StageTimer):
+    population_data = modules['population_data']
+    attribute(timer, population_data, 'read_workbook', 'clean')
+    attribute(timer, population_data, 'write_figure', 'write')
+    attribute(timer, population_data, 'write_table', 'write')
+    manifest = modules['build_manifest'].BuildManifest()
+
+    timer.time('fetch', population_data.download_file, population_data.POP_EST_EXCEL_URL)
+    timer.time('fetch', population_data.download_file, population_data.POP_PREDICTION_EXCEL_URL)
+    timer.time_build('plot', ['clean', 'write'], population_data.current_populations, manifest)
+    timer.time_build('plot', ['clean', 'write'], population_data.population_predictions, manifest)
+    timer.time('write', modules['artifacts'].flush)
+
+def run_distress(modules:dict, timer:StageTimer):
+    distress = modules['distress']
+    attribute(timer, distress, 'criteria_matrix', 'compute')
+    attribute(timer, distress, 'write_figure', 'write')
+    attribute(timer, distress, 'write_table', 'write')
+    manifest = modules['build_manifest'].BuildManifest()
+
+    fetched = timer.time('fetch', distress.fetch_data)
+    timer.time_build('plot', ['compute', 'write'], distress.build_distress, manifest, fetched)
+    timer.time('write', modules['artifacts'].flush)
+
+def run_section_5(modules:dict, timer:StageTimer):
+    section_5, render = modules['section_5'], modules['render']
+    attribute(timer, render, 'write_text', 'write')
+    manifest = modules['build_manifest'].BuildManifest()
+
+    fetched = timer.time('fetch', section_5.fetch_data)
+    context_dict = timer.time('compute', section_5.build_context, fetched)
+    timer.time_build('render', ['write'], section_5.render_page, context_dict, manifest)
+    timer.time('write', modules['artifacts'].flush)
+
+SCENARIO_FUNCS = {
+    'section_3': run_section_3,
+    'population': run_population,
+    'distress': run_distress,
+    'section_5': run_section_5,
+}
+
+def run_scenario(scenario:str, args) -> dict:
+    """
+    Runs a scenario once in a fresh scratch site against a fresh stand-in server.
+    Returns dict mapping stage name to seconds, plus 'requests' with the number of API requests.
+    """
+    import standin_api
+    start_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_dir:
+        make_site(work_dir, args)
+        os.chdir(work_dir)
+        os.environ['WAEDD_CACHE_DIR'] = os.path.join(work_dir, '.cache')
+        os.environ.setdefault('BLS_API_KEY', 'benchmark')
+        os.environ.setdefault('BEA_API_KEY', 'benchmark')
+        try:
+            acs_refs = standin_api_labels()
+            server = standin_api.start_server(latency=args.latency, failure_rate=args.failure_rate,
+                                              fixture_dir=args.fixtures, label_refs=acs_refs)
+            try:
+                modules = load_site_modules(f"http://127.0.0.1:{server.server_port}")
+                timer = StageTimer()
+                SCENARIO_FUNCS[scenario](modules, timer)
+                timer.stages['requests'] = server.request_count
+                return timer.stages
+            finally:
+                server.shutdown()
+        finally:
+            os.chdir(start_dir)
+
+def standin_api_labels() -> set:
+    """
+    Finds the ACS labels the site references so the stand-in can serve a variables.json with them.
+    """
+    if 'acs_variables' in sys.modules:
+        del sys.modules['acs_variables']
+    acs_variables = importlib.import_module('acs_variables')
+    return acs_variables.scan_references()[1]
+
+#####
+## Results ##
+#####
+
+def compare(results:dict, baseline:dict, tolerance:float) -> list:
+    """
+    Lists every stage that is slower than the baseline by more than the tolerance.
+    """
+    regressions = []
+    for scenario, stages in results.items():
+        for stage, seconds in stages.items():
+            if stage == 'requests' or stage not in baseline.get(scenario, {}):
+                continue
+            allowed = baseline[scenario][stage] * (1 + tolerance)
+            if seconds > allowed and seconds - baseline[scenario][stage] > MIN_REGRESSION_SECONDS:
+                regressions.append(f"{scenario} {stage}: {seconds:.3f}s, baseline {baseline[scenario][stage]:.3f}s")
+    return regressions
+
+def main():
+    """
+    Runs the selected scenarios and prints, saves or checks their timings.
+    """
+    ap = argparse.ArgumentParser(description="Times each stage of the site scripts against a local stand-in API.")
+    ap.add_argument('--scenario', action='append', choices=SCENARIOS, help="scenario to run, can be given more than once. Default is every scenario")
+    ap.add_argument('--repeat', type=int, default=3, help="number of runs per scenario, the median is reported")
+    ap.add_argument('--regions', type=int, default=0, help="number of distress regions, default is distress_regions.yaml as is")
+    ap.add_argument('--series', type=int, default=0, help="number of extra BLS series to add to bls_config.yaml")
+    ap.add_argument('--latency', type=float, default=0.0, help="seconds the stand-in waits before each response")
+    ap.add_argument('--failure-rate', type=float, default=0.0, help="fraction of stand-in requests that fail with a 503")
+    ap.add_argument('--fixtures', default=None, help="response cache directory with recorded responses to replay")
+    ap.add_argument('--baseline', default=BASELINE_FILE, help="baseline file to save or check against")
+    ap.add_argument('--save-baseline', action='store_true', help="save the timings as the baseline")
+    ap.add_argument('--check', action='store_true', help="exit with an error if a stage regressed against the baseline")
+    ap.add_argument('--tolerance', type=float, default=0.25, help="allowed slowdown before a stage counts as a regression")
+    args = ap.parse_args()
+    if args.check and not args.save_baseline and not os.path.exists(args.baseline):
+        print(f"no baseline at {args.baseline}, run with --save-baseline first")
+        sys.exit(1)
+
+    settings = {key: getattr(args, key) for key in ('regions', 'series', 'latency', 'failure_rate', 'fixtures')}
+    results, failures = {}, []
+    for scenario in args.scenario or SCENARIOS:
+        runs = []
+        for _ in range(args.repeat):
+            try:
+                runs.append(run_scenario(scenario, args))
+            except Exception:
+                failures.append(scenario)
+                print(f"{scenario} failed:\n{traceback.format_exc()}")
+                break
+        if runs:
+            stages = sorted({stage for run in runs for stage in run})
+            results[scenario] = {stage: statistics.median(run.get(stage, 0.0) for run in runs) for stage in stages}
+            print(f"{scenario}: " + ', '.join(
+                f"{stage} {seconds:.0f}" if stage == 'requests' else f"{stage} {seconds:.3f}s"
+                for stage, seconds in results[scenario].items()))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump({'settings': settings, 'results': results}, baseline_file, indent=2, sort_keys=True)
+        print(f"saved baseline to {args.baseline}")
+
+    if args.check:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline['settings'] != settings:
+            print(f"WARNING: baseline was recorded with {baseline['settings']}, this run used {settings}")
+        regressions = compare(results, baseline['results'], args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions or failures:
+            sys.exit(1)
+        print("no regressions")
+
+if __name__ == '__main__':
+    main()
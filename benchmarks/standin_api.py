@@ -0,0 +1,341 @@
+"""
+standin_api.py
+
+A local HTTP stand-in for the BLS, Census Bureau and BEA APIs and the AZ Commerce workbook
+downloads, so the site scripts can be benchmarked without touching the real APIs.
+
+Responses are replayed from recorded fixtures when there is one for the request, and otherwise
+generated from the request. Recorded fixtures are a response cache directory from a real run
+(the .cache/responses directory written by data_cache.py), so recording a set of fixtures is just
+running the scripts once against the live APIs and copying that directory. Generated responses
+are deterministic: the same request always returns the same values.
+
+Latency and failures can be injected to see how the fetch stage behaves on a slow or unreliable
+connection. Failed requests return a 503 like the real APIs do when they are overloaded.
+
+usage:
+    python benchmarks/standin_api.py --port 8765 --latency 0.2 --failure-rate 0.05
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import urllib.parse as urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from bls_data import la_area_codes_df
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKBOOK_DIR = os.path.join(REPO_DIR, 'waedd_data')
+
+#generated census variables.json files get this many extra variables per group so they are
+#about the size of the real profile tables
+FILLER_VARIABLES_PER_GROUP = 500
+
+#variables the scripts request by code
+KNOWN_VARIABLES = {
+    'DP03_0088E': "Estimate!!INCOME AND BENEFITS (IN 2019 INFLATION-ADJUSTED DOLLARS)!!Per capita income (dollars)",
+    'DP05_0001E': "Estimate!!SEX AND AGE!!Total population",
+}
+
+INDUSTRIES = [
+    "Agriculture, forestry, fishing and hunting, and mining", "Construction", "Manufacturing",
+    "Wholesale trade", "Retail trade", "Transportation and warehousing, and utilities", "Information",
+    "Finance and insurance, and real estate and rental and leasing",
+    "Professional, scientific, and management, and administrative and waste management services",
+    "Educational services, and health care and social assistance",
+    "Arts, entertainment, and recreation, and accommodation and food services",
+    "Other services, except public administration", "Public administration",
+]
+
+def _seeded(*parts) -> random.Random:
+    """
+    Returns a random number generator seeded from the parts, so generated values are repeatable.
+    """
+    return random.Random(hashlib.sha256(json.dumps(parts).encode('utf-8')).hexdigest())
+
+def load_fixtures(fixture_dir:str) -> dict:
+    """
+    Reads recorded responses from a response cache directory.
+    Arguments:
+        - fixture_dir = str; a directory of data_cache.py entries, like .cache/responses
+    Returns dict mapping (source, serialized request) to the recorded payload.
+    """
+    fixtures = {}
+    if not fixture_dir:
+        return fixtures
+    for root, _, files in os.walk(fixture_dir):
+        for file_name in files:
+            if not file_name.endswith('.json.gz'):
+                continue
+            with gzip.open(os.path.join(root, file_name), 'rt', encoding='utf-8') as fixture_file:
+                entry = json.load(fixture_file)
+            fixtures[(entry['source'], json.dumps(entry['request'], sort_keys=True))] = entry['payload']
+    return fixtures
+
+#####
+## Generated responses ##
+#####
+
+def bls_series(series_id:str, start_year:int, end_year:int, today=None) -> dict:
+    """
+    Generates a BLS series with the period type the series ID prefix uses (annual OES, quarterly
+    QCEW, monthly for everything else), newest first, ending a couple of months before today.
+    """
+    today = today if today else time.localtime()
+    latest = (today.tm_year, today.tm_mon - 2) if today.tm_mon > 2 else (today.tm_year - 1, today.tm_mon + 10)
+    if series_id.startswith('OE'):
+        periods = [('A01', 12)]
+    elif series_id.startswith('EN'):
+        periods = [(f"Q0{quarter}", quarter * 3) for quarter in range(1, 5)]
+    else:
+        periods = [(f"M{month:02}", month) for month in range(1, 13)]
+
+    rng = _seeded('bls', series_id)
+    level = rng.uniform(3, 1500)
+    data = []
+    for year in range(start_year, end_year + 1):
+        for period, month in periods:
+            if (year, month) > latest:
+                continue
+            level = max(level * rng.uniform(0.97, 1.03), 0.1)
+            data.append({'year': str(year), 'period': period, 'periodName': period,
+                         'value': f"{level:.1f}", 'footnotes': [{}]})
+    return {'seriesID': series_id, 'data': data[::-1]}
+
+def _place_name(level:str, code:str, state:str='04') -> str:
+    """
+    Looks up a geography name from the BLS area codes, like 'Yuma County, Arizona'.
+    """
+    if level == 'us':
+        return 'United States'
+    if level == 'state':
+        area_code = f"ST{code}00000000000"
+    elif level == 'county':
+        area_code = f"CN{state}{code}00000000"
+    else:
+        area_code = f"CT{state}{code}000000"
+    if area_code in la_area_codes_df.index:
+        return la_area_codes_df.loc[area_code]['area_text'].replace(', AZ', ', Arizona')
+    return f"{level.title()} {code}, Arizona"
+
+def census_rows(query:dict) -> list:
+    """
+    Generates a Census API response for a query with get, for and in clauses.
+    """
+    variables = query['get'].split(',')
+    level, codes = query['for'].split(':')
+    codes = [f"{num:03}" for num in range(1, 30, 2)] if codes == '*' else codes.split(',')
+    parents = [clause.split(':') for clause in query.get('in', '').split() if clause]
+
+    rows = [variables + [parent for parent,_ in parents] + [level]]
+    for code in codes:
+        row = []
+        for variable in variables:
+            rng = _seeded('census', variable, level, code)
+            if variable == 'NAME':
+                row.append(_place_name(level, code, parents[0][1] if parents else '04'))
+            elif variable.endswith('PE'):
+                row.append(f"{rng.uniform(0, 30):.1f}")
+            else:
+                row.append(str(rng.randint(1000, 60000)))
+        rows.append(row + [code for _,code in parents] + [code])
+    return rows
+
+def census_variables(label_refs:set) -> dict:
+    """
+    Generates a census variables.json with a code for every label the site references, the
+    industry labels and filler variables for the DP03 and DP05 groups.
+    """
+    labels = {label for label in label_refs if not label.startswith('^') and not label.endswith('!!')}
+    labels.update(f"Percent!!INDUSTRY!!Civilian employed population 16 years and over!!{industry}" for industry in INDUSTRIES)
+    variables = {code: {'label': label} for code,label in KNOWN_VARIABLES.items()}
+    labels.difference_update(KNOWN_VARIABLES.values())
+    for num, label in enumerate(sorted(labels), start=100):
+        group = 'DP05' if 'SEX AND AGE' in label else 'DP03'
+        suffix = 'PE' if label.startswith('Percent') else 'E'
+        variables[f"{group}_{num:04}{suffix}"] = {'label': label}
+    for group in ('DP03', 'DP05'):
+        for num in range(FILLER_VARIABLES_PER_GROUP):
+            variables[f"{group}_{num + 5000:04}M"] = {'label': f"Margin of Error!!FILLER!!Item {num}"}
+    return {'variables': variables}
+
+def bea_response(params:dict) -> dict:
+    """
+    Generates a BEA CAINC1 response for the GeoFIPS codes in the request.
+    """
+    data = []
+    for geo_fips in params['GeoFIPS'].split(','):
+        rng = _seeded('bea', geo_fips, params.get('Year'))
+        if geo_fips == '00000':
+            name = 'United States'
+        elif geo_fips.endswith('000'):
+            name = _place_name('state', geo_fips[:2])
+        else:
+            name = _place_name('county', geo_fips[2:], geo_fips[:2])
+        data.append({'Code': 'CAINC1-3', 'GeoFips': geo_fips, 'GeoName': name.replace(', Arizona', ', AZ'),
+                     'TimePeriod': str(params.get('Year')), 'CL_UNIT': 'Dollars', 'UNIT_MULT': '0',
+                     'DataValue': f"{rng.randint(30000, 60000):,}"})
+    return {'BEAAPI': {'Request': {}, 'Results': {'Data': data, 'Notes': []}}}
+
+def bea_years(today=None) -> dict:
+    """
+    Generates a BEA GetParameterValuesFiltered response listing the years up to last year.
+    """
+    today = today if today else time.localtime()
+    years = [{'Key': str(year), 'Desc': str(year)} for year in range(1969, today.tm_year)]
+    return {'BEAAPI': {'Request': {}, 'Results': {'ParamValue': years}}}
+
+def acs_vintage_published(year:int, today=None) -> bool:
+    """
+    ACS 5-year data comes out in December of the year after it covers, so anything from two
+    years ago or earlier is treated as published.
+    """
+    today = today if today else time.localtime()
+    return year <= today.tm_year - 2
+
+#####
+## Server ##
+#####
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Answers BLS, Census, BEA and workbook requests. The server settings are attributes of the
+    server: fixtures, latency, failure_rate, label_refs and a request counter.
+    """
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _inject(self) -> bool:
+        """
+        Waits for the configured latency and returns True if this request should fail.
+        """
+        with self.server.lock:
+            self.server.request_count += 1
+        time.sleep(self.server.latency)
+        if self.server.rng.random() < self.server.failure_rate:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return True
+        return False
+
+    def _fixture(self, source:str, request:dict):
+        return self.server.fixtures.get((source, json.dumps(request, sort_keys=True)))
+
+    def do_POST(self):
+        if self._inject():
+            return
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        request = {'seriesid': sorted(body['seriesid']), 'startyear': body['startyear'], 'endyear': body['endyear']}
+        series = self._fixture('bls', request)
+        if series is None:
+            series = [bls_series(series_id, int(body['startyear']), int(body['endyear'])) for series_id in body['seriesid']]
+        if body.get('latest'):
+            series = [dict(raw_series, data=raw_series['data'][:1]) for raw_series in series]
+        self._send_json({'status': 'REQUEST_SUCCEEDED', 'message': [], 'Results': {'series': series}})
+
+    def do_GET(self):
+        if self._inject():
+            return
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        parts = [part for part in url.path.split('/') if part]
+
+        if parts[0] == 'workbooks':
+            with open(os.path.join(WORKBOOK_DIR, os.path.basename(parts[-1])), 'rb') as workbook:
+                body = workbook.read()
+            etag = f'"{hashlib.sha256(body).hexdigest()}"'
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        elif parts[0] == 'bea':
+            query = {key.lower(): val for key,val in params.items() if key not in ('UserID', 'ResultFormat')}
+            payload = self._fixture('bea', query)
+            if payload is None and params.get('method') == 'GetParameterValuesFiltered':
+                payload = bea_years()
+            self._send_json(payload if payload is not None else bea_response(params))
+
+        elif parts[-1] == 'variables.json':
+            request = {'dataset': parts[2:-1], 'year': int(parts[1]), 'variables': True}
+            payload = self._fixture('census', request)
+            self._send_json(payload if payload is not None else census_variables(self.server.label_refs))
+
+        elif parts[-1].endswith('.json'):
+            #dataset discovery json, only there for published vintages
+            if not acs_vintage_published(int(parts[1])):
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self._send_json({'dataset': [{'c_vintage': int(parts[1]), 'c_dataset': parts[2:-1] + [parts[-1][:-len('.json')]]}]})
+
+        else:
+            request = {'dataset': parts[2:], 'year': int(parts[1]),
+                       'query': {key.lower(): val.replace(' ', '') for key,val in params.items()}}
+            payload = self._fixture('census', request)
+            self._send_json(payload if payload is not None else census_rows(params))
+
+def start_server(port:int=0, latency:float=0.0, failure_rate:float=0.0, fixture_dir:str=None,
+        label_refs:set=None, seed:int=0) -> ThreadingHTTPServer:
+    """
+    Starts the stand-in server on a background thread.
+    Arguments:
+        - port = int; port to listen on, 0 picks a free port
+        - latency = float; seconds to wait before answering each request
+        - failure_rate = float; fraction of requests that fail with a 503
+        - fixture_dir = str; response cache directory with recorded responses to replay
+        - label_refs = set; ACS labels to include in generated variables.json files
+        - seed = int; seed for the failure injection
+    Returns the running server, its url is f"http://127.0.0.1:{server.server_port}"
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), StandInHandler)
+    server.fixtures = load_fixtures(fixture_dir)
+    server.latency = latency
+    server.failure_rate = failure_rate
+    server.label_refs = label_refs if label_refs else set()
+    server.rng = random.Random(seed)
+    server.lock = threading.Lock()
+    server.request_count = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    """
+    Runs the stand-in server until it is interrupted.
+    """
+    ap = argparse.ArgumentParser(description="Serves stand-in BLS, Census and BEA API responses.")
+    ap.add_argument('--port', type=int, default=8765, help="port to listen on")
+    ap.add_argument('--latency', type=float, default=0.0, help="seconds to wait before answering each request")
+    ap.add_argument('--failure-rate', type=float, default=0.0, help="fraction of requests that fail with a 503")
+    ap.add_argument('--fixtures', default=None, help="response cache directory with recorded responses to replay")
+    args = ap.parse_args()
+
+    server = start_server(args.port, args.latency, args.failure_rate, args.fixtures)
+    print(f"serving on http://127.0.0.1:{server.server_port}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
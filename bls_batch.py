@@ -0,0 +1,325 @@
+"""
+bls_batch.py
+
+Plans and sends every Bureau of Labor Statistics request the site scripts make as a small
+number of batched API calls. Each script used to build its own BlsData object, so series
+that appear in more than one place (the county unemployment rates for example) were
+downloaded once per script and once per bls_config.yaml section.
+
+The planning stage reads every BLS request (all bls_config.yaml sections plus the distress
+and section 5 requests declared below), merges the year ranges of series that are requested
+more than once, and packs the result into as few requests as the BLS v2 API limits allow.
+Results are merged into the local observation store in bls_store.py, so only the newest
+months are requested once a series has been downloaded. Each section then gets a BlsData
+object cut from the shared result.
+
+usage:
+    from bls_batch import get_bls_data
+    section_data = get_bls_data('ceds3_4_unemployment_rate')
+"""
+from __future__ import annotations
+import datetime
+import json
+import os
+import threading
+from typing import TYPE_CHECKING
+import yaml
+import requests
+from bls_store import BlsStore
+from data_cache import cached_fetch, refresh_requested
+from fetch_executor import FetchExecutor, rate_limited
+from geography import load_index
+from tracing import traced
+
+if TYPE_CHECKING:
+    from bls_data.bls import BlsData
+
+#same as bls_data.bls.BLS_URL, bls_data (and pandas) are only imported once data is sliced
+BLS_URL = 'https://api.bls.gov/publicAPI/v2/timeseries/data/'
+
+#BLS v2 API limits for registered users
+MAX_SERIES_PER_REQUEST = 50
+MAX_YEARS_PER_REQUEST = 20
+
+BLS_CONFIG_FILE = 'bls_config.yaml'
+DISTRESS_CONFIG_FILE = 'distress_regions.yaml'
+
+#regions compared to Arizona by section_5.py, distress.py series come from distress_regions.yaml
+SECTION_5_REGIONS = ['Yuma County', 'La Paz County']
+
+#batched results for this process, filled the first time a section is requested
+_bls_results = {}
+_bls_results_lock = threading.Lock()
+
+def distress_series(distress_config_file:str=DISTRESS_CONFIG_FILE) -> list:
+    """
+    Lists the unemployment series for every region and reference in distress_regions.yaml.
+    Arguments:
+        - distress_config_file = str; path to the distress_regions.yaml file
+    Returns list of series IDs.
+    """
+    with open(distress_config_file) as distress_yaml:
+        distress_config = yaml.load(distress_yaml, Loader=yaml.FullLoader)
+    index = load_index()
+    return [index.resolve(geography)['bls'] for geography in distress_config['regions'] + distress_config['references']]
+
+def section_5_series() -> dict:
+    """
+    Lists the unemployment rate series for the section 5 regions and Arizona. The Arizona rate is
+    seasonally adjusted, BLS doesn't adjust county rates.
+    Returns dict mapping series ID to the geography name it is shown under.
+    """
+    index = load_index()
+    series = {index.series_id(region): region for region in SECTION_5_REGIONS}
+    series[index.series_id('Arizona', seasonally_adjusted=True)] = 'Arizona'
+    return series
+
+def load_bls_sections(config_file:str=BLS_CONFIG_FILE) -> list:
+    """
+    Reads the sections from the bls_config.yaml file. Sections with a `laus` key get the series
+    IDs for those geographies and measures from the geography index added to their seriesIDs, and
+    column names for them added to their custom_column_names.
+    Arguments:
+        - config_file = str; path to the bls_config.yaml file
+    Returns list of dicts, one per section.
+    """
+    with open(config_file) as bls_yaml:
+        bls_list = yaml.load(bls_yaml, Loader=yaml.FullLoader)
+
+    index = load_index()
+    for waedd_section in bls_list:
+        if 'laus' not in waedd_section:
+            continue
+        laus = waedd_section['laus']
+        series = index.laus_series(laus['geographies'], laus.get('measures', ['unemployment_rate']))
+        waedd_section['seriesIDs'] = waedd_section.get('seriesIDs', []) + list(series)
+        waedd_section['custom_column_names'] = dict(series, **waedd_section.get('custom_column_names', {}))
+    return bls_list
+
+def bls_requests(config_file:str=BLS_CONFIG_FILE) -> dict:
+    """
+    Collects every BLS request made by the site scripts.
+    Arguments:
+        - config_file = str; path to the bls_config.yaml file
+    Returns dict mapping a request name (the filename for bls_config.yaml sections) to a tuple
+    of (series_ids, start_year, end_year).
+    """
+    bls_list = load_bls_sections(config_file)
+
+    this_year = datetime.date.today().year
+    all_requests = {
+        waedd_section['filename']: (
+            waedd_section['seriesIDs'],
+            int(waedd_section['start_year']),
+            int(waedd_section['end_year']),
+        )
+        for waedd_section in bls_list
+    }
+    all_requests['distress'] = (distress_series(), this_year - 3, this_year)
+    all_requests['section_5'] = (list(section_5_series()), this_year - 10, this_year)
+    return all_requests
+
+def plan_requests(bls_request_list:list) -> list:
+    """
+    Merges overlapping requests and packs them into the fewest API calls the BLS limits allow.
+    Overlapping year ranges requested for the same series are merged, and the merged ranges are
+    split into windows of at most MAX_YEARS_PER_REQUEST years. Windows are then packed together
+    into batches as long as the batch stays under both the series and the year limit.
+    Arguments:
+        - bls_request_list = list; tuples of (series_ids, start_year, end_year)
+    Returns a list of (series_ids, start_year, end_year) tuples, one per API call.
+    """
+    #merge overlapping or adjacent year ranges for each series
+    series_ranges = {}
+    for series_ids, start_year, end_year in sorted(bls_request_list, key=lambda x: x[1]):
+        for series_id in series_ids:
+            ranges = series_ranges.setdefault(series_id, [])
+            if ranges and start_year <= ranges[-1][1] + 1:
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1], end_year))
+            else:
+                ranges.append((start_year, end_year))
+
+    #split long ranges into windows that fit in a single request
+    windows = []
+    for series_id, ranges in series_ranges.items():
+        for start_year, end_year in ranges:
+            for window_start in range(start_year, end_year + 1, MAX_YEARS_PER_REQUEST):
+                windows.append((series_id, window_start, min(window_start + MAX_YEARS_PER_REQUEST - 1, end_year)))
+
+    #greedily pack windows into batches, oldest windows first
+    batches = []
+    for series_id, start_year, end_year in sorted(windows, key=lambda x: (x[1], x[2], x[0])):
+        for batch in batches:
+            batch_start = min(batch['start_year'], start_year)
+            batch_end = max(batch['end_year'], end_year)
+            if (len(batch['series_ids']) < MAX_SERIES_PER_REQUEST
+                    and series_id not in batch['series_ids']
+                    and batch_end - batch_start < MAX_YEARS_PER_REQUEST):
+                batch['series_ids'].append(series_id)
+                batch['start_year'], batch['end_year'] = batch_start, batch_end
+                break
+        else:
+            batches.append({'series_ids': [series_id], 'start_year': start_year, 'end_year': end_year})
+
+    return [(batch['series_ids'], batch['start_year'], batch['end_year']) for batch in batches]
+
+def request_bls_batch(series_ids:list, start_year:int, end_year:int) -> list:
+    """
+    Sends a single request to the BLS API. This mirrors BlsData._request_bls_data but returns
+    the raw series so they can be shared between several BlsData objects.
+    Arguments:
+        - series_ids = list; series IDs to request, at most MAX_SERIES_PER_REQUEST
+        - start_year = int; first year of data
+        - end_year = int; last year of data
+    Returns list of raw series dicts as returned by the BLS API.
+    """
+    if 'BLS_API_KEY' not in os.environ:
+        raise ValueError("BLS_API_KEY environment variable must be set.")
+
+    headers = {
+        'content-type' : 'application/json',
+    }
+    data = json.dumps({
+        "seriesid" : series_ids,
+        "startyear" : start_year,
+        "endyear" : end_year,
+        "catalog" : False,
+        "annualaverage" : False,
+        "aspects" : False,
+        "registrationKey" : os.environ.get('BLS_API_KEY'),
+    })
+
+    response = requests.post(BLS_URL, data=data, headers=headers)
+    response.raise_for_status()
+    bls_json = response.json()
+
+    #the BLS API returns a 200 when the daily quota is used up, so check the status too
+    if bls_json.get('status') != 'REQUEST_SUCCEEDED':
+        raise ValueError(f"BLS request failed: {' '.join(bls_json.get('message', []))}")
+    return bls_json['Results'].get('series', [])
+
+def missing_requests(bls_request_list:list, store:BlsStore) -> list:
+    """
+    Cuts the requests down to the years that aren't already in the local observation store (plus
+    its revision window), or keeps every year if --refresh was given.
+    Arguments:
+        - bls_request_list = list; tuples of (series_ids, start_year, end_year)
+        - store = BlsStore; observation store to check
+    Returns list of ([series_id], start_year, end_year) tuples.
+    """
+    missing = []
+    for series_ids, start_year, end_year in bls_request_list:
+        for series_id in series_ids:
+            if refresh_requested():
+                missing.append(([series_id], start_year, end_year))
+            else:
+                missing.extend(([series_id], first, last)
+                               for first,last in store.missing_ranges(series_id, start_year, end_year))
+    return missing
+
+def batch_request(series_ids:list, start_year:int, end_year:int) -> dict:
+    """
+    Returns the request a batch is cached under.
+    """
+    return {'seriesid': sorted(series_ids), 'startyear': start_year, 'endyear': end_year}
+
+def planned_requests(config_file:str=BLS_CONFIG_FILE, store:BlsStore=None) -> list:
+    """
+    Works out the batched requests the next fetch would send, without sending them.
+    Arguments:
+        - config_file = str; path to the bls_config.yaml file
+        - store = BlsStore; observation store to check
+    Returns list of (source, request) tuples, see data_cache.cache_status().
+    """
+    store = store if store else BlsStore()
+    missing = missing_requests(list(bls_requests(config_file).values()), store)
+    return [('bls', batch_request(*batch)) for batch in plan_requests(missing)]
+
+@traced('fetch')
+def fetch_bls_data(bls_request_list:list, store:BlsStore=None) -> dict:
+    """
+    Plans and sends the batched BLS requests for the given requests. Only the years that aren't
+    already in the local observation store (plus its revision window) are requested, batches are
+    sent concurrently, and each batch is cached on its own.
+    Arguments:
+        - bls_request_list = list; tuples of (series_ids, start_year, end_year)
+        - store = BlsStore; observation store to read from and merge results into
+    Returns dict mapping each series ID to its list of raw data points, newest first.
+    """
+    store = store if store else BlsStore()
+
+    fetches = FetchExecutor()
+    batches = plan_requests(missing_requests(bls_request_list, store))
+    for batch_num, (series_ids, start_year, end_year) in enumerate(batches):
+        fetches.add(batch_num, cached_fetch, 'bls', batch_request(series_ids, start_year, end_year),
+                    lambda args=(series_ids, start_year, end_year): rate_limited('bls', request_bls_batch)(*args))
+
+    #merge new data into the store, then read everything back out of it
+    for batch_num, batch in fetches.run().items():
+        _, start_year, end_year = batches[batch_num]
+        store.add(batch, start_year, end_year)
+
+    all_series_ids = {series_id for series_ids,_,_ in bls_request_list for series_id in series_ids}
+    return store.read(sorted(all_series_ids))
+
+@traced('transform')
+def slice_bls_data(series_data:dict, series_ids:list, start_year:int, end_year:int) -> BlsData:
+    """
+    Cuts a single request out of the shared batch results.
+    Arguments:
+        - series_data = dict; the result of fetch_bls_data
+        - series_ids = list; series IDs in the order the section lists them
+        - start_year = int; first year of data
+        - end_year = int; last year of data
+    Returns BlsData object built from the sliced raw data.
+    """
+    from bls_data.bls import BlsData
+
+    raw_data = [
+        {
+            'seriesID': series_id,
+            'data': [point for point in series_data.get(series_id, [])
+                     if start_year <= int(point['year']) <= end_year],
+        }
+        for series_id in series_ids
+    ]
+    return BlsData(series_ids, start_year, end_year, raw_data=raw_data)
+
+def get_bls_data(name:str, config_file:str=BLS_CONFIG_FILE) -> BlsData:
+    """
+    Returns the BlsData object for a single named request. The first call fetches every planned
+    BLS request in one batch so later calls in the same process don't touch the API.
+    Arguments:
+        - name = str; the request name, see bls_requests()
+        - config_file = str; path to the bls_config.yaml file
+    Returns BlsData object.
+    """
+    all_requests = bls_requests(config_file)
+    if name not in all_requests:
+        raise KeyError(f"No BLS request named '{name}'. Expected one of: {', '.join(all_requests)}")
+
+    prefetch_bls_data(config_file)
+    return slice_bls_data(_bls_results, *all_requests[name])
+
+def prefetch_bls_data(config_file:str=BLS_CONFIG_FILE) -> dict:
+    """
+    Fetches every planned BLS request for this process without building any BlsData objects.
+    Used by the build orchestrator to fetch everything once before starting worker processes.
+    Arguments:
+        - config_file = str; path to the bls_config.yaml file
+    Returns the shared batch results, see fetch_bls_data.
+    """
+    with _bls_results_lock:
+        if not _bls_results:
+            _bls_results.update(fetch_bls_data(list(bls_requests(config_file).values())))
+    return _bls_results
+
+def preload_bls_data(series_data:dict):
+    """
+    Loads batch results fetched by another process so get_bls_data doesn't fetch them again.
+    Arguments:
+        - series_data = dict; the result of prefetch_bls_data
+    """
+    with _bls_results_lock:
+        _bls_results.clear()
+        _bls_results.update(series_data)
@@ -0,0 +1,198 @@
+"""
+bls_store.py
+
+A local SQLite store of every BLS observation that has been downloaded. Results from the BLS
+API are merged into the store, and the store keeps a high-water mark (the newest period with
+data) for each series. Later runs only request the years after the high-water mark, plus a
+small revision window so values BLS revises after they are first published (like the annual
+LAUS benchmark revisions) are picked up.
+
+usage:
+    store = BlsStore()
+    ranges = store.missing_ranges('LAUCN040120000000003', 2015, 2021)
+    store.add(raw_series, 2015, 2021)
+    series_data = store.read(['LAUCN040120000000003'])
+"""
+import contextlib
+import json
+import os
+import sqlite3
+from data_cache import CACHE_DIR
+
+BLS_STORE_FILE = os.path.join(CACHE_DIR, 'bls_observations.sqlite')
+
+#months before the high-water mark that are requested again to pick up revisions
+REVISION_MONTHS = 13
+
+def period_month(period:str) -> int:
+    """
+    Converts a BLS period code to the last month it covers.
+    Arguments:
+        - period = str; BLS period like 'M05', 'Q02', 'S01' or 'A01'
+    Returns int
+    """
+    months_per_period = {'M': 1, 'Q': 3, 'S': 6, 'A': 12}
+    return min(int(period[1:]) * months_per_period[period[0]], 12)
+
+def merge_ranges(ranges:list) -> list:
+    """
+    Merges overlapping and adjacent year ranges.
+    Arguments:
+        - ranges = list; (first_year, last_year) tuples in any order
+    Returns list of (first_year, last_year) tuples, oldest first.
+    """
+    merged = []
+    for first_year, last_year in sorted(ranges):
+        if merged and first_year <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last_year))
+        else:
+            merged.append((first_year, last_year))
+    return merged
+
+class BlsStore():
+    """
+    Stores BLS observations keyed by series ID and period.
+
+    Arguments:
+        path = str; location of the SQLite file, created if it doesn't exist
+
+    Tables:
+        observations = one row per series and period with the raw values from the BLS API
+        covered_years = the ranges of years that have been requested for each series, one row per
+                        range. Overlapping and adjacent ranges are merged
+    """
+    def __init__(self, path:str=BLS_STORE_FILE):
+
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS observations (
+                    series_id TEXT NOT NULL,
+                    year TEXT NOT NULL,
+                    period TEXT NOT NULL,
+                    period_name TEXT,
+                    value TEXT,
+                    footnotes TEXT,
+                    PRIMARY KEY (series_id, year, period)
+                )""")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS covered_years (
+                    series_id TEXT NOT NULL,
+                    first_year INTEGER NOT NULL,
+                    last_year INTEGER NOT NULL,
+                    PRIMARY KEY (series_id, first_year)
+                )""")
+            #the old single-span table could hide gaps, so those years are requested again
+            conn.execute("DROP TABLE IF EXISTS coverage")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """
+        Opens the store for one transaction, committed if the block succeeds and always closed.
+        """
+        with contextlib.closing(sqlite3.connect(self.path)) as conn:
+            with conn:
+                yield conn
+
+    def covered_ranges(self, series_id:str) -> list:
+        """
+        Returns list of (first_year, last_year) tuples that have been requested for a series, oldest first.
+        """
+        with self._connect() as conn:
+            return conn.execute("SELECT first_year, last_year FROM covered_years WHERE series_id = ? "
+                                "ORDER BY first_year", (series_id,)).fetchall()
+
+    def high_water_mark(self, series_id:str) -> tuple:
+        """
+        Finds the newest observation stored for a series.
+        Returns a tuple of (year, month) or None if nothing is stored.
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT year, period FROM observations WHERE series_id = ? AND period != 'M13' "
+                "ORDER BY year DESC, period DESC LIMIT 1",
+                (series_id,),
+            ).fetchone()
+        return (int(row[0]), period_month(row[1])) if row else None
+
+    def missing_ranges(self, series_id:str, start_year:int, end_year:int) -> list:
+        """
+        Works out which years need to be requested from BLS for a series.
+        Arguments:
+            - series_id = str; BLS series ID
+            - start_year = int; first year that is needed
+            - end_year = int; last year that is needed
+        Returns a list of (start_year, end_year) tuples, empty if the store already has everything.
+        """
+        covered = self.covered_ranges(series_id)
+        high_water_mark = self.high_water_mark(series_id)
+        if not covered or high_water_mark is None:
+            return [(start_year, end_year)]
+
+        #every part of the range that no earlier request covered
+        ranges = []
+        next_year = start_year
+        for first_year, last_year in covered:
+            if first_year > next_year:
+                ranges.append((next_year, min(first_year - 1, end_year)))
+            next_year = max(next_year, last_year + 1)
+            if next_year > end_year:
+                break
+        if next_year <= end_year:
+            ranges.append((next_year, end_year))
+
+        #plus everything from the start of the revision window through the end year
+        hwm_year, hwm_month = high_water_mark
+        months = hwm_year * 12 + hwm_month - 1 - REVISION_MONTHS
+        revision_start = max(months // 12, start_year)
+        if end_year >= revision_start:
+            ranges.append((revision_start, end_year))
+        return merge_ranges(ranges)
+
+    def add(self, bls_series:list, start_year:int, end_year:int):
+        """
+        Merges raw series returned from the BLS API into the store. New values replace stored
+        values for the same period, so revisions are kept.
+        Arguments:
+            - bls_series = list; raw series dicts from the BLS API
+            - start_year = int; first year that was requested
+            - end_year = int; last year that was requested
+        """
+        with self._connect() as conn:
+            for series in bls_series:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO observations VALUES (?, ?, ?, ?, ?, ?)",
+                    [(series['seriesID'], point['year'], point['period'], point.get('periodName'),
+                      point['value'], json.dumps(point.get('footnotes', []))) for point in series['data']],
+                )
+                covered = conn.execute("SELECT first_year, last_year FROM covered_years WHERE series_id = ?",
+                                       (series['seriesID'],)).fetchall()
+                conn.execute("DELETE FROM covered_years WHERE series_id = ?", (series['seriesID'],))
+                conn.executemany(
+                    "INSERT INTO covered_years VALUES (?, ?, ?)",
+                    [(series['seriesID'], first_year, last_year)
+                     for first_year, last_year in merge_ranges(covered + [(start_year, end_year)])],
+                )
+
+    def read(self, series_ids:list) -> dict:
+        """
+        Reads stored observations in the same format the BLS API returns them.
+        Arguments:
+            - series_ids = list; BLS series IDs
+        Returns dict mapping each series ID to a list of data points, newest first.
+        """
+        series_data = {series_id: [] for series_id in series_ids}
+        with self._connect() as conn:
+            for series_id in series_ids:
+                rows = conn.execute(
+                    "SELECT year, period, period_name, value, footnotes FROM observations "
+                    "WHERE series_id = ? ORDER BY year DESC, period DESC",
+                    (series_id,),
+                )
+                series_data[series_id] = [
+                    {'year': year, 'period': period, 'periodName': period_name,
+                     'value': value, 'footnotes': json.loads(footnotes)}
+                    for year, period, period_name, value, footnotes in rows
+                ]
+        return series_data
@@ -0,0 +1,280 @@
+"""
+build.py
+
+Single entry point that rebuilds every generated graph, table and page on the site. Each output
+is a node in a dependency graph:
+    - population:current, population:predictions = the AZ Commerce population graphs and tables
+    - bls:{filename} = one node per section in bls_config.yaml
+    - distress = the distress page graph and tables
+    - profiles = every community profile page in profiles.yaml
+    - context:workforce-development = the section 5 data for the workforce-development template
+    - pages = every page registered in render.py, rendered in one pass once their contexts are built
+
+Nodes declare the data they need (bls, distress, section_5, profiles). All of that data is fetched once
+in this process through the shared cache, then independent nodes run in parallel across a
+process pool. A node runs once every node it depends on has finished, and gets their results.
+
+None of the scripts import pandas, plotly or the API packages until they build something, so
+--list and --plan only read the config files and the cache and finish in a fraction of a second.
+--plan prints the files each node writes and every request the build would send, and whether the
+response is already cached.
+
+usage:
+    python build.py                     #rebuild everything
+    python build.py --node distress     #rebuild a single node (and anything it depends on)
+    python build.py --list              #list every node
+    python build.py --plan --node pages #show what a build would write and fetch without building
+    python build.py --jobs 4 --refresh
+"""
+import argparse
+import functools
+import os
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import artifacts
+import bls_batch
+import distress
+import population_data
+import profiles
+import render
+import section_3
+import section_5
+import tracing
+from build_manifest import BuildManifest
+from data_cache import cache_status, evict, set_refresh
+from data_sources import planned_requests
+from fetch_executor import FetchExecutor
+
+def _workforce_context(manifest:BuildManifest) -> dict:
+    return section_5.build_context()
+
+#context nodes that pages can be rendered with, see render.PAGES
+CONTEXTS = {
+    'workforce-development': {'func': _workforce_context, 'inputs': ['bls', 'section_5']},
+}
+
+def _render_pages(context_names:list, manifest:BuildManifest, *context_dicts):
+    render.render_pages(dict(zip(context_names, context_dicts)), manifest)
+
+def build_graph(config_file:str=bls_batch.BLS_CONFIG_FILE) -> dict:
+    """
+    Creates the dependency graph for every output of the site.
+    Arguments:
+        - config_file = str; path to the bls_config.yaml file
+    Returns dict mapping each node name to a dict with:
+        - func = callable; takes the build manifest and the results of each dependency in order
+        - deps = list; names of the nodes that must finish first
+        - inputs = list; names of the data this node fetches, see prefetch()
+        - outputs = list; paths of the files this node writes
+    """
+    nodes = {
+        'population:current': {'func': population_data.current_populations, 'deps': [], 'inputs': [],
+                               'outputs': population_data.current_population_outputs()},
+        'population:predictions': {'func': population_data.population_predictions, 'deps': [], 'inputs': [],
+                                   'outputs': population_data.prediction_outputs()},
+        'distress': {'func': distress.build_distress, 'deps': [], 'inputs': ['bls', 'distress'],
+                     'outputs': distress.distress_outputs(distress.load_distress_config())},
+        'profiles': {'func': profiles.build_profiles, 'deps': [], 'inputs': ['profiles'],
+                     'outputs': [page['output'] for page in profiles.profile_pages(profiles.load_profiles())]},
+    }
+    for name, context in CONTEXTS.items():
+        nodes[f"context:{name}"] = {'func': context['func'], 'deps': [], 'inputs': context['inputs'], 'outputs': []}
+    context_names = [name for name in CONTEXTS if any(page['context'] == name for page in render.PAGES)]
+    nodes['pages'] = {
+        'func': functools.partial(_render_pages, context_names),
+        'deps': [f"context:{name}" for name in context_names],
+        'inputs': [],
+        'outputs': [page['output'] for page in render.PAGES if page['context'] in context_names],
+    }
+    for waedd_section in section_3.load_bls_config(config_file):
+        nodes[f"bls:{waedd_section['filename']}"] = {
+            'func': functools.partial(section_3.build_bls_section, waedd_section),
+            'deps': [],
+            'inputs': ['bls'],
+            'outputs': section_3.section_outputs(waedd_section),
+        }
+    return nodes
+
+def select_nodes(nodes:dict, names:list) -> list:
+    """
+    Finds the named nodes and everything they depend on.
+    Arguments:
+        - nodes = dict; the dependency graph from build_graph()
+        - names = list; names of the nodes to build, every node if empty
+    Returns list of node names.
+    """
+    if not names:
+        return list(nodes)
+
+    selected = []
+    to_visit = list(names)
+    while to_visit:
+        name = to_visit.pop()
+        if name not in nodes:
+            raise KeyError(f"No node named '{name}'. Use --list to see every node.")
+        if name not in selected:
+            selected.append(name)
+            to_visit.extend(nodes[name]['deps'])
+    return selected
+
+def data_requests(inputs:set) -> dict:
+    """
+    Collects the Census and BEA requests declared by the scripts whose data is in inputs.
+    Arguments:
+        - inputs = set; data names from the nodes' inputs
+    Returns dict mapping '{script}:{request name}' to the (func, args, kwargs) DATA_REQUESTS entry.
+    """
+    return {
+        f"{module.__name__}:{name}": request
+        for module in (distress, section_5, profiles) if module.__name__ in inputs
+        for name, request in module.DATA_REQUESTS.items()
+    }
+
+def prefetch(inputs:set):
+    """
+    Fetches all of the data the selected nodes need in this process so it is in the response
+    cache (and the BLS batch results) before the worker processes start.
+    Arguments:
+        - inputs = set; data names from the nodes' inputs
+    Returns the BLS batch results to hand to the worker processes.
+    """
+    fetches = FetchExecutor()
+    if 'bls' in inputs:
+        fetches.add('bls', bls_batch.prefetch_bls_data)
+    for name, (func, args, kwargs) in data_requests(inputs).items():
+        fetches.add(name, func, *args, **kwargs)
+    return fetches.run().get('bls', {})
+
+def plan(nodes:dict, selected:list, manifest:BuildManifest):
+    """
+    Prints the files the selected nodes write and every request a build of them would send,
+    without fetching or building anything. Requests are checked against the response cache.
+    Arguments:
+        - nodes = dict; the dependency graph from build_graph()
+        - selected = list; names of the nodes to plan, must include their dependencies
+        - manifest = BuildManifest; the build manifest, to find outputs that were never built
+    """
+    print("outputs:")
+    for name in selected:
+        outputs = nodes[name]['outputs']
+        unbuilt = [path for path in outputs if os.path.normpath(path) not in manifest.artifacts or not os.path.exists(path)]
+        print(f"  {name}: {len(outputs)} files" + (f", {len(unbuilt)} not built yet" if unbuilt else ""))
+
+    inputs = {data for name in selected for data in nodes[name]['inputs']}
+    planned = {'bls': bls_batch.planned_requests()} if 'bls' in inputs else {}
+    for name, (func, args, kwargs) in data_requests(inputs).items():
+        planned[name] = planned_requests(func, args, kwargs)
+
+    print("fetches:")
+    for name, requests in planned.items():
+        statuses = Counter(cache_status(source, request) for source, request in requests)
+        print(f"  {name}: {len(requests)} requests" + (f" ({', '.join(f'{count} {status}' for status, count in statuses.items())})" if requests else ""))
+    if any(node.startswith('population:') for node in selected):
+        print("  population: azcommerce.com workbooks, only downloaded if they changed")
+
+def _init_worker(bls_results:dict, trace:bool):
+    """
+    Runs in each worker process. Workers only read data the main process already fetched.
+    """
+    set_refresh(False)
+    if trace:
+        tracing.enable()
+    bls_batch.preload_bls_data(bls_results)
+
+def _run_node(func, dep_results:list) -> tuple:
+    """
+    Runs a node in a worker process with its own view of the build manifest, and returns the
+    manifest changes (and any trace events) so the main process can save them all at once.
+    With WAEDD_PUBLISH=together the node's files are left staged and returned, so the main
+    process only publishes them once every node has succeeded.
+    """
+    manifest = BuildManifest()
+    try:
+        result = func(manifest, *dep_results)
+        staged = artifacts.flush(keep_staged=True)
+    except BaseException:
+        artifacts.discard()
+        raise
+    rebuilt = {artifact: manifest.artifacts[os.path.normpath(artifact)] for artifact in manifest.rebuilt}
+    return result, rebuilt, manifest.skipped, tracing.take_events(), staged
+
+def run_nodes(nodes:dict, selected:list, manifest:BuildManifest, jobs:int=None):
+    """
+    Runs the selected nodes across a process pool, starting each one as soon as its
+    dependencies have finished.
+    Arguments:
+        - nodes = dict; the dependency graph from build_graph()
+        - selected = list; names of the nodes to run, must include their dependencies
+        - manifest = BuildManifest; the build manifest to update with every node's changes
+        - jobs = int; number of worker processes, defaults to the number of cores
+    Returns dict mapping each node name to its result.
+    """
+    bls_results = prefetch({data for name in selected for data in nodes[name]['inputs']})
+
+    results = {}
+    pending = list(selected)
+    running = {}
+    staged = []
+    try:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(bls_results, tracing.enabled())) as pool:
+            while pending or running:
+                for name in [name for name in pending if all(dep in results for dep in nodes[name]['deps'])]:
+                    dep_results = [results[dep] for dep in nodes[name]['deps']]
+                    running[pool.submit(_run_node, nodes[name]['func'], dep_results)] = name
+                    pending.remove(name)
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    results[name], rebuilt, skipped, events, node_staged = future.result()
+                    staged.extend(node_staged)
+                    tracing.add_events(events)
+                    for artifact, fingerprint in rebuilt.items():
+                        manifest.record(artifact, fingerprint)
+                    manifest.skipped.extend(skipped)
+                    print(f"finished {name}")
+    except BaseException:
+        #a failed build publishes nothing, including the files of nodes that were still running
+        for future in running:
+            if not future.cancelled() and future.exception() is None:
+                staged.extend(future.result()[4])
+        artifacts.discard_staged(staged)
+        raise
+    artifacts.publish_staged(staged)
+    return results
+
+def main():
+    """
+    Parses the command line and builds the selected nodes.
+    """
+    ap = argparse.ArgumentParser(description="Rebuilds the generated graphs, tables and pages for the site.")
+    ap.add_argument('--node', action='append', default=[], help="name of a node to build, can be given more than once")
+    ap.add_argument('--jobs', type=int, default=None, help="number of worker processes, defaults to the number of cores")
+    ap.add_argument('--list', action='store_true', help="list every node and exit")
+    ap.add_argument('--plan', action='store_true', help="show the files and requests a build would make and exit, without building")
+    ap.add_argument('--refresh', action='store_true', help="ignore cached API responses and download everything again")
+    ap.add_argument('--trace', metavar='FILE', help="record a timing and memory trace of the run to FILE (Chrome trace format)")
+    args = ap.parse_args()
+
+    nodes = build_graph()
+    if args.list:
+        for name, node in nodes.items():
+            print(f"{name}" + (f" (after {', '.join(node['deps'])})" if node['deps'] else ""))
+        return
+
+    set_refresh(args.refresh)
+    manifest = BuildManifest()
+    if args.plan:
+        plan(nodes, select_nodes(nodes, args.node), manifest)
+        return
+
+    if args.trace:
+        tracing.enable(args.trace)
+    run_nodes(nodes, select_nodes(nodes, args.node), manifest, args.jobs)
+    manifest.save()
+    evict()
+    manifest.report()
+    tracing.finish()
+
+if __name__ == '__main__':
+    main()
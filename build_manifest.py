@@ -0,0 +1,157 @@
+"""
+build_manifest.py
+
+Keeps track of a content fingerprint for every generated graph, table and page so unchanged
+artifacts aren't written again. A fingerprint covers everything that goes into an artifact:
+the data it shows, its bls_config.yaml entry or template, and the version of the code that
+renders it. If the fingerprint matches the one recorded in build_manifest.json and the file
+still exists, the artifact is skipped, which keeps file mtimes (and CDN caches) unchanged.
+The manifest also records when each artifact was last rebuilt, which post_build.py uses for the
+sitemap.xml lastmod dates.
+
+usage:
+    manifest = BuildManifest()
+    fingerprint = make_fingerprint(df, waedd_section, code_version(__file__))
+    if not manifest.up_to_date(['graphs/my_graph.html'], fingerprint):
+        for path in write_figure(fig, 'graphs/my_graph'):
+            manifest.record(path, fingerprint)
+    manifest.save()
+    manifest.report()
+"""
+import datetime
+import hashlib
+import json
+import os
+from importlib import metadata
+from artifacts import flush as flush_artifacts
+
+MANIFEST_FILE = 'build_manifest.json'
+
+#packages whose version changes how an artifact is rendered
+RENDERING_PACKAGES = ['plotly', 'Jinja2']
+
+def code_version(*source_files:str) -> str:
+    """
+    Creates a version string for the code that renders an artifact from the contents of the given
+    source files and the installed versions of the rendering packages.
+    Arguments:
+        - source_files = str; paths to the python files or templates used to render the artifact
+    Returns str
+    """
+    version_hash = hashlib.sha256()
+    for source_file in source_files:
+        with open(source_file, 'rb') as source:
+            version_hash.update(source.read())
+    for package in RENDERING_PACKAGES:
+        try:
+            version_hash.update(f"{package}=={metadata.version(package)}".encode('utf-8'))
+        except metadata.PackageNotFoundError:
+            pass
+    return version_hash.hexdigest()
+
+def make_fingerprint(*parts) -> str:
+    """
+    Creates a content fingerprint from the inputs of an artifact.
+    Arguments:
+        - parts = dataframes, dicts, lists or strings that the artifact is built from
+    Returns str
+    """
+    fingerprint = hashlib.sha256()
+    for part in parts:
+        if hasattr(part, 'to_json'):  #pandas dataframes and series
+            part = part.to_json(orient='split', date_format='iso')
+        elif not isinstance(part, str):
+            part = json.dumps(part, sort_keys=True, default=str)
+        fingerprint.update(part.encode('utf-8'))
+        fingerprint.update(b'\0')
+    return fingerprint.hexdigest()
+
+def read_manifest(path:str) -> tuple:
+    """
+    Reads a manifest file, including manifests from before build times were recorded, which
+    only mapped artifacts to fingerprints.
+    Returns tuple of (fingerprints dict, build times dict)
+    """
+    try:
+        with open(path, encoding='utf-8') as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}, {}
+    if isinstance(manifest.get('artifacts'), dict):
+        return manifest['artifacts'], manifest.get('built', {})
+    return manifest, {}
+
+class BuildManifest():
+    """
+    Reads and updates the build manifest.
+
+    Arguments:
+        path = str; location of the manifest file
+
+    Attributes:
+        artifacts = dict; mapping of artifact path to its recorded fingerprint
+        built = dict; mapping of artifact path to when it was last rebuilt (ISO 8601, UTC)
+        rebuilt = list; artifacts written during this run
+        skipped = list; artifacts that were unchanged during this run
+    """
+    def __init__(self, path:str=MANIFEST_FILE):
+
+        self.path = path
+        self.rebuilt = []
+        self.skipped = []
+        self.artifacts, self.built = read_manifest(path)
+
+    def is_current(self, artifact:str, fingerprint:str) -> bool:
+        """
+        Returns True if the artifact exists and was built from the same inputs.
+        """
+        return self.artifacts.get(os.path.normpath(artifact)) == fingerprint and os.path.exists(artifact)
+
+    def up_to_date(self, artifacts:list, fingerprint:str) -> bool:
+        """
+        Checks a group of artifacts that are built from the same inputs. If all of them are current
+        they are marked as skipped.
+        Arguments:
+            - artifacts = list; paths of the artifacts
+            - fingerprint = str; fingerprint of their inputs
+        Returns True if every artifact is current and nothing needs to be built.
+        """
+        if all(self.is_current(artifact, fingerprint) for artifact in artifacts):
+            self.skipped.extend(artifacts)
+            return True
+        return False
+
+    def record(self, artifact:str, fingerprint:str):
+        """
+        Records the fingerprint of an artifact that was just written.
+        """
+        self.artifacts[os.path.normpath(artifact)] = fingerprint
+        self.built[os.path.normpath(artifact)] = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
+        self.rebuilt.append(artifact)
+
+    def save(self):
+        """
+        Writes the manifest back to disk. Queued artifact writes are finished first so the manifest
+        never records a file that wasn't written. The file is read again first so artifacts
+        recorded by other scripts since this manifest was loaded are kept.
+        """
+        flush_artifacts()
+        artifacts, built = read_manifest(self.path)
+        for artifact in map(os.path.normpath, self.rebuilt):
+            artifacts[artifact] = self.artifacts[artifact]
+            built[artifact] = self.built[artifact]
+
+        tmp_path = f"{self.path}.tmp{os.getpid()}"
+        with open(tmp_path, 'w', encoding='utf-8') as manifest_file:
+            json.dump({'artifacts': artifacts, 'built': built}, manifest_file, indent=2, sort_keys=True)
+            manifest_file.write('\n')
+        os.replace(tmp_path, self.path)
+        self.artifacts, self.built = artifacts, built
+
+    def report(self):
+        """
+        Prints which artifacts were rebuilt and how many were unchanged.
+        """
+        for artifact in self.rebuilt:
+            print(f"rebuilt {artifact}")
+        print(f"{len(self.rebuilt)} artifacts rebuilt, {len(self.skipped)} unchanged")
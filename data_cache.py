@@ -0,0 +1,224 @@
+"""
+data_cache.py
+
+A persistent on-disk cache for responses from the BLS, Census Bureau and BEA APIs. Responses
+are keyed on the normalized request and stored as gzipped json files in the cache directory so
+repeat builds don't have to download data that hasn't changed.
+
+Every source has its own expiration rule:
+    - census = ACS vintages are never revised, so these never expire
+    - bls = expires on the next BLS release day so new months are picked up
+    - bea = expires after a week
+
+If a request fails and an expired entry exists, the expired entry is used and a warning is
+printed so a throttled or unavailable API doesn't stop a rebuild. The cache is kept under
+MAX_CACHE_BYTES by removing the least recently used entries with evict(), which the scripts call
+once at the end of a run rather than after every write.
+
+Environment variables:
+    - WAEDD_CACHE_DIR = directory used for the cache, default '.cache'
+    - WAEDD_CACHE_MAX_BYTES = size limit for the response cache, default 256MB
+    - WAEDD_REFRESH = set to 1 to ignore cached responses (same as passing --refresh to a script)
+    - WAEDD_EXPIRE = comma separated sources (like 'bls') whose responses cached before the run
+                     started are treated as expired, used by freshness.py once new data is out
+"""
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import threading
+from tracing import annotate, enabled as tracing_enabled, span
+
+CACHE_DIR = os.environ.get('WAEDD_CACHE_DIR', '.cache')
+RESPONSE_CACHE_DIR = os.path.join(CACHE_DIR, 'responses')
+MAX_CACHE_BYTES = int(os.environ.get('WAEDD_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+#days of the month that LAUS data is published. State data comes out around the third week
+#of the month and county/metro data at the beginning of the next month.
+BLS_RELEASE_DAYS = (1, 20)
+
+_refresh = os.environ.get('WAEDD_REFRESH', '') not in ('', '0')
+
+#sources whose responses fetched before these times are treated as expired
+_expired_before = {source: datetime.datetime.now() for source in os.environ.get('WAEDD_EXPIRE', '').split(',') if source}
+
+def _next_bls_release(fetched:datetime.datetime) -> datetime.datetime:
+    """
+    Finds the first BLS release day after the time a response was fetched.
+    """
+    day = fetched.date() + datetime.timedelta(days=1)
+    while day.day not in BLS_RELEASE_DAYS:
+        day += datetime.timedelta(days=1)
+    return datetime.datetime.combine(day, datetime.time())
+
+#functions that take the fetch time and return the expiration time, None never expires
+SOURCE_EXPIRATION = {
+    'census': lambda fetched: None,
+    'bls': _next_bls_release,
+    'bea': lambda fetched: fetched + datetime.timedelta(days=7),
+}
+
+def set_refresh(refresh:bool):
+    """
+    Ignore (but still update) cached responses for the rest of the run.
+    Arguments:
+        - refresh = bool; True to re-download every request
+    """
+    global _refresh
+    _refresh = refresh
+
+def expire_source(source:str):
+    """
+    Treats every response from a source that is already in the cache as expired for the rest of
+    the run, so requests go to the API once but expired entries are still there if it fails.
+    Arguments:
+        - source = str; name of the API, one of the SOURCE_EXPIRATION keys
+    """
+    _expired_before[source] = datetime.datetime.now()
+
+def refresh_requested() -> bool:
+    """
+    Returns True if cached data should be ignored for this run.
+    """
+    return _refresh
+
+def request_key(source:str, request:dict) -> str:
+    """
+    Creates the cache key for a request. Requests are serialized with sorted keys so the same
+    request always creates the same key no matter what order the parameters were given in.
+    Arguments:
+        - source = str; name of the API, one of the SOURCE_EXPIRATION keys
+        - request = dict; the normalized request parameters
+    Returns str
+    """
+    normalized = json.dumps([source, request], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+def _entry_path(source:str, key:str) -> str:
+    return os.path.join(RESPONSE_CACHE_DIR, source, f"{key}.json.gz")
+
+def _read_entry(path:str) -> dict:
+    """
+    Reads a cache entry from disk, returns None if it is missing or can't be read.
+    """
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as cache_file:
+            return json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+
+def _write_entry(path:str, entry:dict):
+    """
+    Writes a cache entry to a temp file and renames it so a crash never leaves a partial entry.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}.{threading.get_ident()}"  #threads can write the same entry at once
+    with gzip.open(tmp_path, 'wt', encoding='utf-8') as cache_file:
+        json.dump(entry, cache_file, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+def _is_expired(entry:dict) -> bool:
+    if entry['source'] in _expired_before and datetime.datetime.fromisoformat(entry['fetched']) < _expired_before[entry['source']]:
+        return True
+    return entry['expires'] is not None and datetime.datetime.fromisoformat(entry['expires']) <= datetime.datetime.now()
+
+def cache_status(source:str, request:dict) -> str:
+    """
+    Checks whether a request would be answered from the cache, without sending it.
+    Arguments:
+        - source = str; name of the API, one of the SOURCE_EXPIRATION keys
+        - request = dict; the normalized request parameters
+    Returns str; 'cached', 'expired' (it will be downloaded again) or 'missing'
+    """
+    entry = _read_entry(_entry_path(source, request_key(source, request)))
+    if entry is None:
+        return 'missing'
+    return 'expired' if _refresh or _is_expired(entry) else 'cached'
+
+def cached_payload(source:str, request:dict):
+    """
+    Returns the cached response for a request even if it has expired, or None if it was never
+    fetched. Nothing is downloaded.
+    Arguments:
+        - source = str; name of the API, one of the SOURCE_EXPIRATION keys
+        - request = dict; the normalized request parameters
+    """
+    entry = _read_entry(_entry_path(source, request_key(source, request)))
+    return entry['payload'] if entry else None
+
+def evict(max_bytes:int=MAX_CACHE_BYTES):
+    """
+    Removes the least recently used cache entries until the cache fits in max_bytes. This walks
+    the whole cache, so call it once a run after the fetches finish.
+    Arguments:
+        - max_bytes = int; size limit for all of the cached responses
+    """
+    entries = []
+    for root, _, files in os.walk(RESPONSE_CACHE_DIR):
+        for file_name in files:
+            path = os.path.join(root, file_name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:  #renamed or removed by another process since the walk
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+
+def cached_fetch(source:str, request:dict, fetch_func):
+    """
+    Returns the cached response for a request, calling fetch_func to download it when there is
+    no fresh entry in the cache.
+    Arguments:
+        - source = str; name of the API, one of the SOURCE_EXPIRATION keys
+        - request = dict; the normalized request parameters, these must not include API keys
+        - fetch_func = callable; takes no arguments and returns the json-serializable response
+    Returns the response returned from fetch_func or the cache.
+    """
+    with span(f"fetch {source}", 'fetch'):
+        return _cached_fetch(source, request, fetch_func)
+
+def _cached_fetch(source:str, request:dict, fetch_func):
+    path = _entry_path(source, request_key(source, request))
+    entry = _read_entry(path)
+
+    if entry and not _refresh and not _is_expired(entry):
+        try:
+            os.utime(path)  #mark as recently used for eviction
+        except FileNotFoundError:  #evicted by another process after it was read
+            pass
+        annotate(cache='hit')
+        return entry['payload']
+
+    try:
+        payload = fetch_func()
+    except Exception as err:
+        if entry is None:
+            raise
+        print(f"WARNING: {source} request failed ({err}), using cached response from {entry['fetched']}")
+        annotate(cache='stale')
+        return entry['payload']
+
+    annotate(cache='miss')
+    if tracing_enabled():
+        annotate(bytes=len(json.dumps(payload, separators=(',', ':'))))
+
+    fetched = datetime.datetime.now()
+    expires = SOURCE_EXPIRATION[source](fetched)
+    _write_entry(path, {
+        'source': source,
+        'request': request,
+        'fetched': fetched.isoformat(),
+        'expires': expires.isoformat() if expires else None,
+        'payload': payload,
+    })
+    return payload
@@ -0,0 +1,151 @@
+"""
+data_sources.py
+
+Drop-in replacements for the pyCensus censusData and bea_data getData classes that send their
+requests through the response cache in data_cache.py and the per-API rate limits in
+fetch_executor.py. These take the same arguments and have the same attributes as the classes
+they replace.
+
+pyCensus and bea_data import pandas, which takes longer than planning a whole build, so the
+classes are only created the first time data is requested. Scripts list their requests in
+DATA_REQUESTS with census_data() and bea_data(), and planned_requests() works out what each one
+will ask the cache for without importing either package.
+
+usage:
+    from data_sources import census_data, bea_data
+    county_data = census_data(['acs','acs5','profile'], 2019, {'get': 'NAME,DP03_0088E', 'for': 'county:*', 'in': 'state:04'})
+"""
+import os
+import re
+import threading
+import requests
+from data_cache import cached_fetch
+from fetch_executor import rate_limited
+
+#same as bea_data.bea_data.BEA_API_URL
+BEA_API_URL = "http://apps.bea.gov/api/data?"
+
+_classes_lock = threading.Lock()
+
+def census_request(dataset:list, year:int, query_dict:dict) -> dict:
+    """
+    Normalizes a Census request into the request its response is cached under.
+    Arguments:
+        - dataset = list; dataset name path, like ['acs','acs5','profile']
+        - year = int; year of the dataset
+        - query_dict = dict; the query, see pyCensus.censusdata.censusData
+    Returns dict
+    """
+    return {
+        'dataset': list(dataset),
+        'year': int(year),
+        'query': {key.lower(): str(val).replace(' ', '') for key,val in query_dict.items()},
+    }
+
+def bea_cache_request(params:dict) -> dict:
+    """
+    Normalizes BEA query parameters into the request their response is cached under.
+    Returns dict
+    """
+    return {key.lower(): str(val).replace(' ', '') for key,val in params.items()}
+
+def _define_classes():
+    """
+    Creates CensusData and BeaData as module attributes, importing pyCensus and bea_data.
+    """
+    global CensusData, BeaData
+    from bea_data.bea_data import getData
+    from pyCensus.censusdata import censusData
+    import pandas as pd
+
+    class CensusData(censusData):
+        """
+        censusData that reads responses from the cache when possible.
+        See pyCensus.censusdata.censusData for arguments and attributes.
+        """
+        def _request_data(self) -> list:
+            """
+            Requests data from the census API for the specified endpoint, or returns the cached
+            response if the same request has already been made.
+            """
+            request = census_request(self.dataset, self.year, self.query_dict)
+            return cached_fetch('census', request, rate_limited('census', super()._request_data))
+
+    class BeaData(getData):
+        """
+        getData that reads responses from the cache when possible.
+        See bea_data.bea_data.getData for arguments and attributes.
+        """
+        def __init__(self, **kwargs):
+
+            self.query_params = kwargs
+
+            request = bea_cache_request(kwargs)
+            self.raw_data = cached_fetch('bea', request, lambda: rate_limited('bea', bea_request)(kwargs))
+            self.raw_df = pd.DataFrame(self.raw_data['BEAAPI']['Results']['Data'])
+            self.notes = self.raw_data['BEAAPI']['Results']['Notes']
+
+def _data_class(name:str) -> type:
+    with _classes_lock:
+        if name not in globals():
+            _define_classes()
+    return globals()[name]
+
+def __getattr__(name:str):
+    #lets `from data_sources import CensusData` keep working, at the cost of importing pandas
+    if name in ('CensusData', 'BeaData'):
+        return _data_class(name)
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+def census_data(dataset:list, year:int, query_dict:dict):
+    """
+    Requests Census data through the cache.
+    Arguments: see pyCensus.censusdata.censusData
+    Returns CensusData object.
+    """
+    return _data_class('CensusData')(dataset, year, query_dict)
+
+def bea_data(**kwargs):
+    """
+    Requests BEA data through the cache.
+    Arguments: see bea_data.bea_data.getData
+    Returns BeaData object.
+    """
+    return _data_class('BeaData')(**kwargs)
+
+def planned_requests(func, args:tuple, kwargs:dict) -> list:
+    """
+    Works out what a DATA_REQUESTS entry will ask the cache for, without sending anything.
+    Arguments:
+        - func, args, kwargs = the DATA_REQUESTS entry. Anything other than census_data() and
+                               bea_data() must have a planned_requests() taking the same arguments
+    Returns list of (source, request) tuples, see data_cache.cache_status().
+    """
+    if func is census_data:
+        return [('census', census_request(*args, **kwargs))]
+    if func is bea_data:
+        return [('bea', bea_cache_request(kwargs))]
+    return func.planned_requests(*args, **kwargs)
+
+def bea_request(params:dict) -> dict:
+    """
+    Sends a request to the BEA API. This mirrors bea_data.bea_request, but raises an error for
+    bad HTTP responses so they can be retried, and for errors returned by the API so they are
+    never cached.
+    Arguments:
+        - params = dict; query parameters, not including the API key
+    Returns dict
+    """
+    query = {key: re.sub(r"\s?", "", val) if isinstance(val, str) else val for key,val in params.items()}
+    query.update({
+        'UserID' : os.environ.get('BEA_API_KEY'),
+        'ResultFormat' : 'JSON',
+    })
+
+    response = requests.get(BEA_API_URL, params=query)
+    response.raise_for_status()
+    bea_json = response.json()
+
+    if 'Error' in bea_json['BEAAPI'] or 'Error' in bea_json['BEAAPI'].get('Results', {}):
+        raise ValueError(f"BEA request failed: {bea_json['BEAAPI']}")
+    return bea_json
@@ -3,51 +3,54 @@ A script designed to update and display the Distress page data for waedd.org/dis
 
 By: Aaron Finocchiaro
 """
-import datetime
-import re
-import pandas as pd
-import plotly.graph_objects as go
-from dateutil.relativedelta import relativedelta
-from bea_data.bea_data import getData
-from bls_data.bls import BlsData
-from pyCensus.censusdata import censusData
-
-def distress_table_fill_colors(df:pd.DataFrame) -> list:
-    """
-    Takes a dataframe and determines the fill colors for the table that is going to be
-    created from the dataframe. It will color the column headers and the index column orange,
-    use white and light grey stripes for the regular columns, and highlight cells that are beyond
-    the threshold limit in the threshold column yellow.
-    """
-    fill_color = ['orange']
-    for col in df.columns:
-        if col == "Threshold":
-            threshold_color = ['white'] #unemployment cell, will always be white
-            for val in list(df["Threshold"])[1:]:
-                if val < .8:
-                    threshold_color.append('yellow')
-                elif val % 2 == 0:
-                    threshold_color.append('lightgrey')
-                elif val % 2 != 0:
-                    threshold_color.append('white')
-            fill_color.append(threshold_color)
-        else:
-            fill_color.append(['white', 'lightgrey']*len(df.index))
-    return fill_color
+from __future__ import annotations
+import argparse
+from typing import TYPE_CHECKING
+import yaml
+from artifacts import ARTIFACT_SOURCES, figure_paths, table_paths, write_figure, write_table
+from bls_batch import DISTRESS_CONFIG_FILE, get_bls_data
+from build_manifest import BuildManifest, code_version, make_fingerprint
+from data_cache import evict, set_refresh
+from data_sources import bea_data, census_data
+from fetch_executor import FetchExecutor
+from freshness import published_vintage
+from geography import load_index
+from tracing import traced
+import tracing
 
+if TYPE_CHECKING:
+    import pandas as pd
+    import plotly.graph_objects as go
+
+#newest ACS 5-year and BEA CAINC1 years that have been published, see freshness.py
+ACS_YEAR = published_vintage('census')
+BEA_YEAR = published_vintage('bea')
+MONEY_INCOME_VARIABLE = 'DP03_0088E'
+UNEMPLOYMENT_GRAPH_FILE = "./graphs/region_distress_unemployment"
+
+#distress criteria, one row of each distress table
+UNEMPLOYMENT_MONTHS = 24
+UNEMPLOYMENT_CRITERION = f"{UNEMPLOYMENT_MONTHS}-month Average Unemployment Rate (BLS)"
+MONEY_INCOME_CRITERION = f"{ACS_YEAR} Per Capita Money Income (5-year ACS)"
+PERSONAL_INCOME_CRITERION = f"{BEA_YEAR} Per Capita Personal Income (BEA)"
+
+@traced('figure')
 def distress_table(df:pd.DataFrame) -> go.Figure:
     """
     Takes a pandas dataframe and constructs a plotly graph objects table based on
     the dataframe.
     """
-    #determine the fill colors
-    fill_colors = distress_table_fill_colors(df)
+    import plotly.graph_objects as go
+    from table_rules import fill_colors
+
+    #determine the fill colors from the distress rules in table_rules.yaml
+    cell_colors = fill_colors(df, 'distress')
 
     #apply units ($ and %) to the appropriate data
     df['Threshold'] = df['Threshold'].apply('{}%'.format)
     df.iloc[0, df.columns != 'Threshold'] = df.iloc[0, df.columns != 'Threshold'].apply('{}%'.format)
-    df.loc['2019 Per Capita Money Income (5-year ACS)':, df.columns != 'Threshold'] = (
-        df.loc['2019 Per Capita Money Income (5-year ACS)':, df.columns != 'Threshold'].applymap('${:,.2f}'.format)
+    df.loc[MONEY_INCOME_CRITERION:, df.columns != 'Threshold'] = (
+        df.loc[MONEY_INCOME_CRITERION:, df.columns != 'Threshold'].applymap('${:,.2f}'.format)
     )
 
     #create table
@@ -61,140 +64,223 @@ def distress_table(df:pd.DataFrame) -> go.Figure:
                     align='left'),
         cells=dict(values=[df.index.to_list()] + col_vals,
                    line_color="black",
-                   fill_color=fill_colors,
+                   fill_color=cell_colors,
                    align='left'),
     )])
 
-def make_df(data:dict) -> pd.DataFrame:
+def load_distress_config(config_file:str=DISTRESS_CONFIG_FILE) -> dict:
     """
-    Makes a dataframe based on a dict of values passed in and creates the threshold column for that
-    data.
+    Reads the regions, aggregations and references from the distress_regions.yaml file, with the
+    codes of every region and reference filled in from the geography index.
     Arguments:
-        - data = dict; data to be added to dataframe
-    Returns dataframe
-    """
-    df = pd.DataFrame(
-            data,
-            index=["24-month Average Unemployment Rate (BLS)",
-                    "2019 Per Capita Money Income (5-year ACS)",
-                    "2019 Per Capita Personal Income (BEA)"],
-        )
-    df = df.apply(pd.to_numeric)
-    df['Threshold'] = round(df.iloc[:,0]/df['United States'], 2)
-    return df
+        - config_file = str; path to the distress_regions.yaml file
+    Returns dict
+    """
+    with open(config_file) as distress_yaml:
+        distress_config = yaml.load(distress_yaml, Loader=yaml.FullLoader)
 
-if __name__ == '__main__':
-    #gather BLS data for the past 3 years from most recent available month
-    bls_unemployment = BlsData(
-        ["LAUST040000000000003", "LAUCN040120000000003", "LAUCN040270000000003", "LNU04000000"],
-        (datetime.date.today() - relativedelta(years=3)).year,
-        datetime.date.today().year,
-    )
-    bls_unemployment_df = bls_unemployment.clean_df(custom_column_names={"LNU04000000": "United States"})
+    index = load_index()
+    for key in ('regions', 'references'):
+        distress_config[key] = [index.resolve(geography) for geography in distress_config[key]]
+    return distress_config
 
-    # remove NaN entries for lines with national data and not state data (usually most recent month)
-    bls_unemployment_df = bls_unemployment_df.dropna()
+def table_filename(region:dict) -> str:
+    """
+    Returns the name of the distress table file for a region or aggregation.
+    """
+    if region.get('filename'):
+        return region['filename']
+    return '_'.join(word for word in region['name'].lower().split() if word != 'county') + '_distress'
 
-    # remove entries outside of 24 previous months
-    bls_unemployment_df = (
-        bls_unemployment_df[~(
-            pd.to_datetime(bls_unemployment_df.index) < pd.to_datetime(bls_unemployment_df.iloc[-1].name) -
-            pd.DateOffset(months=24))]
-    )
+def distress_outputs(distress_config:dict) -> list:
+    """
+    Lists every file build_distress() writes in the current output modes.
+    Arguments:
+        - distress_config = dict; the distress_regions.yaml config
+    Returns list of str
+    """
+    paths = figure_paths(UNEMPLOYMENT_GRAPH_FILE)
+    for region in distress_config.get('aggregations', []) + distress_config['regions']:
+        paths += table_paths(f"./tables/{table_filename(region)}")
+    return paths
+
+def data_requests(config_file:str=DISTRESS_CONFIG_FILE) -> dict:
+    """
+    Creates one Census request per geography level (every county in one request, every place in
+    another, and so on) and one BEA request for every region with a BEA code.
+    Arguments:
+        - config_file = str; path to the distress_regions.yaml file
+    Returns dict mapping a request name to a tuple of (func, args, kwargs).
+    """
+    distress_config = load_distress_config(config_file)
+    geographies = distress_config['regions'] + distress_config['references']
+
+    census_levels = {}
+    for geography in geographies:
+        level, code = geography['census'].split(':')
+        census_in = geography.get('census_in', 'state:04')
+        census_levels.setdefault((level, census_in), []).append(code)
+
+    distress_requests = {}
+    for (level, census_in), codes in census_levels.items():
+        query = {'get': f"NAME,{MONEY_INCOME_VARIABLE}", 'for': f"{level}:{','.join(codes)}"}
+        if census_in:
+            query['in'] = census_in
+        distress_requests[f"census:{level}"] = (census_data, (['acs','acs5','profile'], ACS_YEAR, query), {})
 
-    # gather Census ACS data
-    county_data = censusData(
-        ['acs','acs5','profile'],
-        2019,
-        {
-            'get': "NAME,DP03_0088E",
-            'in' : "state:04",
-            'for': "county:012,027",
-        }
-    ).df
-    county_data = county_data.set_index("NAME").transpose()
-
-    state_data = censusData(
-        ['acs','acs5','profile'],
-        2019,
-        {
-            'get': "NAME,DP03_0088E",
-            'for': "state:04",
-        }
-    ).df
-    state_data = state_data.set_index("NAME").transpose()
-
-    national_data = censusData(
-        ['acs','acs5','profile'],
-        2019,
-        {
-            'get': "NAME,DP03_0088E",
-            'for': "us:1",
-        }
-    ).df
-    national_data = national_data.set_index("NAME").transpose()
-
-    # merge census data into single dataframe
-    census_data = pd.concat([county_data, state_data, national_data], axis=1)
-    census_data = census_data.rename(columns=lambda x: re.sub(',.*', '', x))
-
-    #gather BEA data
-    bea_data = getData(
-        datasetname="Regional",
-        TableName="CAINC1",
-        method='getdata',
-        LineCode=3,
-        GeoFIPS="04027,04012,04000,00000",
-        Year=2019
-    ).clean_df('TimePeriod','GeoName','DataValue')
-    bea_data = bea_data.rename(columns=lambda x: re.sub(',.*', ' County', x))
-    bea_data.iloc[0] = bea_data.replace(',','',regex=True)
+    bea_codes = [geography['bea'] for geography in geographies if geography.get('bea')]
+    distress_requests['bea'] = (bea_data, (), dict(datasetname="Regional", TableName="CAINC1", method='getdata',
+                                          LineCode=3, GeoFIPS=','.join(bea_codes), Year=BEA_YEAR))
+    return distress_requests
+
+#Census and BEA requests for the distress criteria, BLS data comes from bls_batch
+DATA_REQUESTS = data_requests()
+
+def fetch_data() -> dict:
+    """
+    Requests all of the data for the distress page at once. BLS data is for the past 3 years
+    from the most recent available month.
+    Returns dict of the fetched data objects keyed by the DATA_REQUESTS names and 'bls'.
+    """
+    fetches = FetchExecutor()
+    fetches.add('bls', get_bls_data, 'distress')
+    for name, (func, args, kwargs) in DATA_REQUESTS.items():
+        fetches.add(name, func, *args, **kwargs)
+    return fetches.run()
+
+@traced('transform')
+def criteria_matrix(fetched:dict, distress_config:dict) -> pd.DataFrame:
+    """
+    Computes every distress criterion for every region, aggregation and reference at once.
+    Arguments:
+        - fetched = dict; data returned from fetch_data()
+        - distress_config = dict; the distress_regions.yaml config
+    Returns pandas.DataFrame with a row per geography and a column per criterion.
+    """
+    import pandas as pd
+    from indicators import indicator_table
+
+    geographies = distress_config['regions'] + distress_config['references']
+    names = [geography['name'] for geography in geographies]
+
+    #BLS unemployment, averaged over the 24 months up to the latest month every series has data for
+    bls_unemployment_df = fetched['bls'].clean_df(custom_column_names={geography['bls']: geography['name'] for geography in geographies})
+    unemployment = indicator_table(bls_unemployment_df[names], window=UNEMPLOYMENT_MONTHS)['rolling_mean']
+
+    #Census ACS money income, joined to the regions on their geography codes
+    census_names = {geography['census']: geography['name'] for geography in geographies}
+    census_frames = []
+    for name in DATA_REQUESTS:
+        if name.startswith('census:'):
+            level = name.split(':')[1]
+            census_df = fetched[name].df
+            census_frames.append(pd.Series(census_df[MONEY_INCOME_VARIABLE].to_numpy(),
+                                           index=(level + ':' + census_df[level]).map(census_names)))
+    money_income = pd.to_numeric(pd.concat(census_frames))
+
+    #BEA personal income, joined to the regions on their GeoFIPS codes
+    bea_df = fetched['bea'].raw_df
+    bea_names = {geography['bea']: geography['name'] for geography in geographies if geography.get('bea')}
+    personal_income = pd.Series(pd.to_numeric(bea_df['DataValue'].str.replace(',', '', regex=False)).to_numpy(),
+                                index=bea_df['GeoFips'].map(bea_names))
+
+    matrix = pd.DataFrame({
+        UNEMPLOYMENT_CRITERION: unemployment,
+        MONEY_INCOME_CRITERION: money_income.reindex(names),
+        PERSONAL_INCOME_CRITERION: personal_income.reindex(names),
+    }, index=names)
+
+    #aggregations are the average of their members, as one matrix product over all of them
+    aggregations = distress_config.get('aggregations', [])
+    if aggregations:
+        weights = pd.DataFrame(0.0, index=[aggregation['name'] for aggregation in aggregations], columns=names)
+        for aggregation in aggregations:
+            weights.loc[aggregation['name'], aggregation['members']] = 1 / len(aggregation['members'])
+        matrix = pd.concat([matrix, weights.dot(matrix).round(2)])
+    matrix[UNEMPLOYMENT_CRITERION] = matrix[UNEMPLOYMENT_CRITERION].round(2)
+    return matrix
+
+def region_table_df(matrix:pd.DataFrame, name:str) -> pd.DataFrame:
+    """
+    Creates the table for one region from the criteria matrix, compared to Arizona and the United
+    States, with the threshold ratio of the region to the United States.
+    Arguments:
+        - matrix = pandas.DataFrame; the matrix from criteria_matrix()
+        - name = str; name of the region or aggregation
+    Returns pandas.DataFrame with a row per criterion.
+    """
+    df = matrix.loc[[name, 'Arizona', 'United States']].transpose()
+    df['Threshold'] = (df[name] / df['United States']).round(2)
+    return df
+
+def build_distress(manifest:BuildManifest, fetched:dict=None):
+    """
+    Creates the unemployment graph and the distress tables for every region and aggregation in
+    distress_regions.yaml. Each one is skipped if its data and this script haven't changed since
+    the last build.
+    Arguments:
+        - manifest = BuildManifest; the build manifest to check and update
+        - fetched = dict; data returned from fetch_data(), requested if not given
+    """
+    from downsample import DOWNSAMPLE_SOURCES, optimize_figure
+    from table_rules import TABLE_RULES_SOURCES
+
+    fetched = fetched if fetched else fetch_data()
+    distress_config = load_distress_config()
+    rendering_version = code_version(__file__, *ARTIFACT_SOURCES, *DOWNSAMPLE_SOURCES)
+    table_version = code_version(__file__, *ARTIFACT_SOURCES, *TABLE_RULES_SOURCES)
 
     #make graph
-    bls_graph = bls_unemployment.create_graph('24 month Unemployment Data (BLS)',
-                                   graph_type='line',
-                                   graph_labels={"date":"Date", "value": "Percent Unemployed"},
-                                   custom_column_names={"LNU04000000": "United States"})
-    bls_graph.update_traces(mode='markers+lines', hovertemplate='%{y}%')
-    bls_graph.update_layout(hovermode='x',
-                            dragmode=False,
-                            legend=dict(title={'text':""},yanchor="top", y=1.02, xanchor='left', x=1, font=dict(size=8)))
-    bls_graph.write_html("./graphs/region_distress_unemployment.html", include_plotlyjs='cdn')
-
-    #make a dataframe from the combined averages for all counties in the region
-    combined_data = {
-        'Region' : [round(bls_unemployment_df[['La Paz County', 'Yuma County']].mean().mean(), 2),
-                    round(census_data.loc[:'DP03_0088E', 'Yuma County'].mean().mean(), 2),
-                    round(bea_data[['La Paz County', 'Yuma County']].mean().mean(), 2)],
-        'Arizona' : [round(bls_unemployment_df['Arizona'].mean(), 2), census_data.loc['DP03_0088E']['Arizona'], bea_data['Arizona'][0]],
-        'United States' : [round(bls_unemployment_df['United States'].mean(), 2),
-                            census_data.loc['DP03_0088E']['United States'],
-                            bea_data['United States'][0]],
-    }
-    combined_region_df = make_df(combined_data)
-
-    #make the region distress table from the dataframe and write to html doc
-    combined_table = distress_table(combined_region_df)
-    combined_table.update_layout(height=275, margin=dict(l=0,r=0,t=0,b=0))
-    combined_table.write_html("./tables/region_combined_distress.html", include_plotlyjs='cdn')
-
-
-    # make county-based tables
-    for region in ['La Paz County', 'Yuma County']:
-
-        # gather data
-        county_data = {
-            region : [round(bls_unemployment_df[region].mean(), 2), census_data.loc['DP03_0088E'][region], bea_data[region][0]],
-            'Arizona' : [round(bls_unemployment_df['Arizona'].mean(), 2), census_data.loc['DP03_0088E']['Arizona'], bea_data['Arizona'][0]],
-            'United States' : [round(bls_unemployment_df['United States'].mean(), 2),
-                                census_data.loc['DP03_0088E']['United States'],
-                                bea_data['United States'][0]],
-        }
-
-        #create new df for data
-        county_df = make_df(county_data)
-
-        #create table and write to html doc
-        table = distress_table(county_df)
+    bls_unemployment = fetched['bls']
+    geographies = distress_config['regions'] + distress_config['references']
+    custom_column_names = {geography['bls']: geography['name'] for geography in geographies}
+    graph_file = UNEMPLOYMENT_GRAPH_FILE
+    fingerprint = make_fingerprint(bls_unemployment.df, custom_column_names, rendering_version)
+    if not manifest.up_to_date(figure_paths(graph_file), fingerprint):
+        bls_graph = bls_unemployment.create_graph('24 month Unemployment Data (BLS)',
+                                       graph_type='line',
+                                       graph_labels={"date":"Date", "value": "Percent Unemployed"},
+                                       custom_column_names=custom_column_names)
+        bls_graph.update_traces(mode='markers+lines', hovertemplate='%{y}%')
+        bls_graph.update_layout(hovermode='x',
+                                dragmode=False,
+                                legend=dict(title={'text':""},yanchor="top", y=1.02, xanchor='left', x=1, font=dict(size=8)))
+        bls_graph = optimize_figure(bls_graph)
+        for path in write_figure(bls_graph, graph_file):
+            manifest.record(path, fingerprint)
+
+    #compute the criteria for every region at once, then write a table for each region and aggregation
+    matrix = criteria_matrix(fetched, distress_config)
+    for region in distress_config.get('aggregations', []) + distress_config['regions']:
+        region_df = region_table_df(matrix, region['name'])
+        table_file = f"./tables/{table_filename(region)}"
+        fingerprint = make_fingerprint(region_df, table_version)
+        if manifest.up_to_date(table_paths(table_file), fingerprint):
+            continue
+        table = distress_table(region_df)
         table.update_layout(height=275, margin=dict(l=0,r=0,t=0,b=0))
-        table.write_html(f"./tables/{'_'.join(region.lower().split()[:-1])}_distress.html", include_plotlyjs='cdn')
+        for path in write_table(table, table_file):
+            manifest.record(path, fingerprint)
+
+def main():
+    """
+    Updates the graphs and tables for the distress page.
+    """
+    ap = argparse.ArgumentParser(description="Updates the graphs and tables for the distress page.")
+    ap.add_argument('--refresh', action='store_true', help="ignore cached API responses and download everything again")
+    ap.add_argument('--trace', metavar='FILE', help="record a timing and memory trace of the run to FILE (Chrome trace format)")
+    args = ap.parse_args()
+    set_refresh(args.refresh)
+    if args.trace:
+        tracing.enable(args.trace)
+
+    #graphs and tables are only written when their data or this script changes
+    manifest = BuildManifest()
+    build_distress(manifest)
+    manifest.save()
+    evict()
+    manifest.report()
+    tracing.finish()
+
+if __name__ == '__main__':
+    main()
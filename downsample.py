@@ -0,0 +1,127 @@
+"""
+downsample.py
+
+Keeps long time series graphs responsive. Plotly draws every point of a line graph as SVG, which
+is fine for a few years of monthly data but stutters on phones once a graph has tens of thousands
+of points. optimize_figure() does two things to a figure before it is written:
+    - downsampling = traces with more than max_points points are reduced to max_points with
+                     Largest-Triangle-Three-Buckets (LTTB), which keeps the peaks, dips and overall
+                     shape of the line instead of every nth point
+    - webgl = once the figure has more than webgl_threshold points in total, its scatter traces
+              are drawn with WebGL (scattergl) instead of SVG, and at or below it with SVG
+
+Only the graphs are reduced, tables are built from the full data. Both limits can be set per
+section in bls_config.yaml with max_points and webgl_threshold (null turns either off), and
+default to MAX_POINTS and WEBGL_THRESHOLD. WEBGL_THRESHOLD matches the cutoff plotly express uses
+on its own, so graphs that aren't downsampled are drawn the same way they always were.
+
+usage:
+    fig = optimize_figure(fig, waedd_section.get('max_points', MAX_POINTS),
+                          waedd_section.get('webgl_threshold', WEBGL_THRESHOLD))
+"""
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+MAX_POINTS = 2000
+WEBGL_THRESHOLD = 1000
+
+#files that change how graphs are drawn, for build fingerprints
+DOWNSAMPLE_SOURCES = [__file__]
+
+#trace type for each renderer
+TRACE_TYPES = {False: go.Scatter, True: go.Scattergl}
+
+#per point trace properties that are cut down along with x and y
+POINT_PROPERTIES = ['x', 'y', 'customdata', 'hovertext', 'text']
+
+def numeric_x(x) -> np.ndarray:
+    """
+    Converts x values to numbers so distances between points can be measured. Dates become
+    nanoseconds, and anything else that isn't a number becomes its position.
+    Arguments:
+        - x = sequence of x values
+    Returns numpy.ndarray of floats
+    """
+    values = np.asarray(x)
+    if np.issubdtype(values.dtype, np.number):
+        return values.astype(float)
+    try:
+        return pd.to_datetime(values).asi8.astype(float)
+    except (ValueError, TypeError):
+        return np.arange(len(values), dtype=float)
+
+def lttb(x:np.ndarray, y:np.ndarray, n_out:int) -> np.ndarray:
+    """
+    Picks the points to keep with Largest-Triangle-Three-Buckets. The first and last points are
+    always kept, and the points between them are split into n_out - 2 buckets. From each bucket
+    the point that makes the largest triangle with the last kept point and the average of the
+    next bucket is kept. Points with a missing y value are only kept if a whole bucket is missing.
+    Arguments:
+        - x = numpy.ndarray; x values as floats, sorted
+        - y = numpy.ndarray; y values as floats
+        - n_out = int; number of points to keep
+    Returns numpy.ndarray of the indexes of the kept points
+    """
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    finite = np.isfinite(y)
+    edges = np.floor(np.arange(n_out - 1) * (n - 2) / (n_out - 2)).astype(int) + 1
+    edges[-1] = n - 1
+    selected = np.empty(n_out, dtype=int)
+    selected[0], selected[-1] = 0, n - 1
+    last = 0
+    for bucket in range(n_out - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_end = edges[bucket + 2] if bucket + 2 < len(edges) else n
+        next_finite = finite[end:next_end]
+        if next_finite.any():
+            avg_x, avg_y = x[end:next_end][next_finite].mean(), y[end:next_end][next_finite].mean()
+        else:
+            avg_x, avg_y = x[end:next_end].mean(), y[last]
+        area = np.abs((x[last] - avg_x) * (y[start:end] - y[last]) - (x[last] - x[start:end]) * (avg_y - y[last]))
+        last = start + int(np.argmax(np.where(np.isfinite(area), area, -1.0)))
+        selected[bucket + 1] = last
+    return selected
+
+def downsample_trace(trace, max_points:int):
+    """
+    Reduces a scatter trace to max_points points in place.
+    Arguments:
+        - trace = plotly scatter or scattergl trace
+        - max_points = int; the most points to keep
+    """
+    if trace.y is None or len(trace.y) <= max_points:
+        return
+    y = pd.to_numeric(pd.Series(trace.y), errors='coerce').to_numpy(dtype=float)
+    x = numeric_x(trace.x) if trace.x is not None else np.arange(len(y), dtype=float)
+    keep = lttb(x, y, max_points)
+    for prop in POINT_PROPERTIES:
+        values = trace[prop]
+        if values is not None and not isinstance(values, str) and len(values) == len(y):
+            trace[prop] = np.asarray(values)[keep]
+
+def optimize_figure(fig:go.Figure, max_points:int=MAX_POINTS, webgl_threshold:int=WEBGL_THRESHOLD) -> go.Figure:
+    """
+    Downsamples long scatter traces and switches large figures to WebGL.
+    Arguments:
+        - fig = plotly.graph_objects.Figure
+        - max_points = int; the most points to keep per trace, None to keep every point
+        - webgl_threshold = int; draw scatter traces with WebGL when the figure has more points
+                            than this and with SVG otherwise, None to always use SVG
+    Returns the figure, or a new figure if any trace was switched between SVG and WebGL.
+    """
+    scatter_traces = [trace for trace in fig.data if trace.type in ('scatter', 'scattergl')]
+    if max_points:
+        for trace in scatter_traces:
+            downsample_trace(trace, max_points)
+
+    total_points = sum(len(trace.y) for trace in scatter_traces if trace.y is not None)
+    trace_type = TRACE_TYPES[webgl_threshold is not None and total_points > webgl_threshold]
+    if all(isinstance(trace, trace_type) for trace in scatter_traces):
+        return fig
+    data = [trace_type(trace.to_plotly_json(), skip_invalid=True) if trace.type in ('scatter', 'scattergl') else trace
+            for trace in fig.data]
+    return go.Figure(data=data, layout=fig.layout)
@@ -0,0 +1,147 @@
+"""
+fetch_executor.py
+
+Runs all of the upstream API requests for a script at the same time instead of one after
+another, so a refresh takes about as long as the slowest API instead of the sum of all of them.
+
+There are two pieces:
+    - rate_limited = wraps the function that actually talks to an API so every call to that API
+                     shares a concurrency cap and a token-bucket rate limit, and retries with
+                     jittered exponential backoff on 429 and 5xx responses.
+    - FetchExecutor = a stage where a script declares every request it needs up front and then
+                      runs them together on a thread pool.
+
+usage:
+    fetches = FetchExecutor()
+    fetches.add('state', CensusData, ['acs','acs5','profile'], 2019, {...})
+    fetches.add('bls', get_bls_data, 'distress')
+    results = fetches.run()
+"""
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+#per-API limits. BEA allows 100 requests a minute, BLS and the Census Bureau don't publish
+#per-second limits so these are kept conservative.
+API_LIMITS = {
+    'bls': {'max_concurrent': 2, 'requests_per_second': 2.0, 'burst': 2},
+    'census': {'max_concurrent': 4, 'requests_per_second': 5.0, 'burst': 5},
+    'bea': {'max_concurrent': 2, 'requests_per_second': 1.5, 'burst': 2},
+}
+MAX_RETRIES = 4
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 30.0
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class TokenBucket():
+    """
+    Thread-safe token bucket. Each call to acquire() takes a token, waiting until one is available.
+
+    Arguments:
+        rate = float; tokens added per second
+        capacity = int; the most tokens that can be saved up for a burst of requests
+    """
+    def __init__(self, rate:float, capacity:int):
+
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes a token from the bucket, sleeping until one is available.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+_semaphores = {source: threading.BoundedSemaphore(limits['max_concurrent']) for source,limits in API_LIMITS.items()}
+_buckets = {source: TokenBucket(limits['requests_per_second'], limits['burst']) for source,limits in API_LIMITS.items()}
+
+def _retry_delay(attempt:int, err:Exception) -> float:
+    """
+    Seconds to wait before the next attempt. Uses the Retry-After header if the API sent one,
+    otherwise exponential backoff with full jitter.
+    """
+    response = getattr(err, 'response', None)
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after and retry_after.isdigit():
+        return min(float(retry_after), BACKOFF_MAX_SECONDS)
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+def _should_retry(err:Exception) -> bool:
+    """
+    Retry throttled requests, server errors and dropped connections, but not bad requests.
+    """
+    if isinstance(err, requests.HTTPError):
+        return err.response is not None and err.response.status_code in RETRY_STATUS_CODES
+    return isinstance(err, (requests.ConnectionError, requests.Timeout))
+
+def rate_limited(source:str, func):
+    """
+    Wraps a function that makes a request to an API so it follows the limits in API_LIMITS
+    and retries failed requests.
+    Arguments:
+        - source = str; name of the API, one of the API_LIMITS keys
+        - func = callable; makes the request. It must raise requests.HTTPError for bad responses
+    Returns a function that takes the same arguments as func.
+    """
+    def limited_func(*args, **kwargs):
+        for attempt in range(MAX_RETRIES + 1):
+            with _semaphores[source]:
+                _buckets[source].acquire()
+                try:
+                    return func(*args, **kwargs)
+                except Exception as err:
+                    if attempt == MAX_RETRIES or not _should_retry(err):
+                        raise
+                    delay = _retry_delay(attempt, err)
+                    print(f"{source} request failed ({err}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+    return limited_func
+
+class FetchExecutor():
+    """
+    Collects every request a script needs and runs them concurrently.
+
+    Arguments:
+        max_workers = int; number of threads used to run requests. The per-API limits still apply.
+    """
+    def __init__(self, max_workers:int=8):
+
+        self.max_workers = max_workers
+        self.fetches = {}
+
+    def add(self, name:str, func, *args, **kwargs):
+        """
+        Declares a request to run.
+        Arguments:
+            - name = str; key for the result in the dict returned by run()
+            - func = callable; function or class that makes the request
+            - args, kwargs = passed to func
+        """
+        if name in self.fetches:
+            raise ValueError(f"A fetch named '{name}' was already added.")
+        self.fetches[name] = (func, args, kwargs)
+
+    def run(self) -> dict:
+        """
+        Runs every declared request and waits for all of them to finish.
+        Returns dict mapping each name to the value returned by its function. If any request
+        failed, its error is raised once the others have finished.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = {name: pool.submit(func, *args, **kwargs) for name,(func,args,kwargs) in self.fetches.items()}
+        return {name: future.result() for name,future in futures.items()}
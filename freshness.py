@@ -0,0 +1,304 @@
+"""
+freshness.py
+
+Checks whether BLS, the Census Bureau or BEA have published data newer than what the site was
+last built from, and rebuilds only the outputs whose data moved forward. Each source is checked
+with a small request instead of downloading the data itself:
+    - bls = the newest month of every series the site tracks (latest=true), 50 series per request
+    - census = the dataset discovery json of the ACS 5-year profile vintages after the newest known one
+    - bea = the years the Regional CAINC1 table has (GetParameterValuesFiltered)
+
+What was found is kept in freshness.json, the watermark:
+    - published = the newest month of each BLS series and the newest ACS and BEA years the
+                  checks found
+    - built = the same, as of the last successful rebuild
+
+Anything newer in published than in built is rebuilt with build.py, only for the nodes that read
+it (the bls_config.yaml sections with the series, the distress page, section 5, the community
+profiles), and then built is moved forward. distress.py and profiles.py read their ACS and BEA
+years from published, so a new vintage moves them forward on their own. section_5.py refers to
+ACS labels that include the survey year, so a new ACS vintage is only reported for it and its
+ACS_YEAR has to be updated by hand.
+
+A check that fails (an API being down, the BLS daily quota being used up) prints a warning and
+leaves that source as it was, so it is tried again on the next run. Run it from cron:
+    0 * * * * cd /path/to/waedd && python freshness.py >> freshness.log 2>&1
+
+usage:
+    python freshness.py              #check every source and rebuild whatever moved forward
+    python freshness.py --dry-run    #only report what moved forward
+"""
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+import requests
+from pyCensus import BASE_URL
+import bls_batch
+from data_sources import bea_request
+from fetch_executor import FetchExecutor, rate_limited
+
+FRESHNESS_FILE = 'freshness.json'
+BUILD_SCRIPT = 'build.py'
+
+#vintages the scripts were written against, used until a newer one has been found
+BASE_VINTAGES = {'census': 2019, 'bea': 2019}
+
+#dataset checked for new ACS vintages
+ACS_DATASET = ['acs', 'acs5', 'profile']
+
+#build.py nodes for the BLS requests that aren't bls_config.yaml sections, see bls_batch.bls_requests()
+REQUEST_NODES = {'distress': ['distress'], 'section_5': ['pages']}
+
+#build.py nodes that read the Census and BEA vintages
+VINTAGE_NODES = {'census': ['distress', 'profiles'], 'bea': ['distress']}
+
+def read_watermark(path:str=FRESHNESS_FILE) -> dict:
+    """
+    Reads the watermark file, returns an empty watermark if it doesn't exist yet.
+    Returns dict with 'published' and 'built', see the module docstring.
+    """
+    try:
+        with open(path, encoding='utf-8') as watermark_file:
+            watermark = json.load(watermark_file)
+    except (OSError, ValueError):
+        watermark = {}
+    watermark.setdefault('published', {})
+    watermark.setdefault('built', {})
+    return watermark
+
+def save_watermark(watermark:dict, path:str=FRESHNESS_FILE):
+    """
+    Writes the watermark file to a temp file and renames it so a crash never leaves a partial file.
+    """
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'w', encoding='utf-8') as watermark_file:
+        json.dump(watermark, watermark_file, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def published_vintage(source:str, path:str=FRESHNESS_FILE) -> int:
+    """
+    Returns the newest Census or BEA year that has been found, or the BASE_VINTAGES year if none has.
+    Arguments:
+        - source = str; 'census' or 'bea'
+        - path = str; path to the watermark file
+    Returns int
+    """
+    return max(BASE_VINTAGES[source], read_watermark(path)['published'].get(source) or 0)
+
+#####
+#### Checks ####
+#####
+
+def request_latest_bls(series_ids:list) -> list:
+    """
+    Asks the BLS API for only the newest observation of each series.
+    Arguments:
+        - series_ids = list; at most bls_batch.MAX_SERIES_PER_REQUEST series
+    Returns list of raw series dicts as returned by the BLS API.
+    """
+    if 'BLS_API_KEY' not in os.environ:
+        raise ValueError("BLS_API_KEY environment variable must be set.")
+
+    #the years are only there in case latest is ignored, then the newest point is picked out below
+    this_year = datetime.date.today().year
+    data = json.dumps({
+        "seriesid" : series_ids,
+        "startyear" : this_year - 1,
+        "endyear" : this_year,
+        "latest" : True,
+        "catalog" : False,
+        "annualaverage" : False,
+        "aspects" : False,
+        "registrationKey" : os.environ.get('BLS_API_KEY'),
+    })
+    response = requests.post(bls_batch.BLS_URL, data=data, headers={'content-type': 'application/json'})
+    response.raise_for_status()
+    bls_json = response.json()
+    if bls_json.get('status') != 'REQUEST_SUCCEEDED':
+        raise ValueError(f"BLS request failed: {' '.join(bls_json.get('message', []))}")
+    return bls_json['Results'].get('series', [])
+
+def latest_month(points:list) -> str:
+    """
+    Finds the newest monthly observation in a list of raw BLS data points.
+    Returns str like '2021-05', or None if there are no monthly points.
+    """
+    months = [f"{point['year']}-{point['period'][1:]}" for point in points
+              if point['period'].startswith('M') and point['period'] != 'M13']
+    return max(months) if months else None
+
+def check_bls(series_ids:list) -> dict:
+    """
+    Finds the newest month BLS has published for each series.
+    Arguments:
+        - series_ids = list; every series the site tracks
+    Returns dict mapping each series ID to its newest month, like '2021-05'.
+    """
+    fetches = FetchExecutor()
+    batch_size = bls_batch.MAX_SERIES_PER_REQUEST
+    for start in range(0, len(series_ids), batch_size):
+        fetches.add(start, rate_limited('bls', request_latest_bls), series_ids[start:start + batch_size])
+
+    months = {}
+    for batch in fetches.run().values():
+        for series in batch:
+            month = latest_month(series['data'])
+            if month:
+                months[series['seriesID']] = month
+    return months
+
+def acs_vintage_exists(year:int) -> bool:
+    """
+    Asks the Census API for the discovery json of a vintage of the ACS dataset.
+    Returns True if the vintage has been published.
+    """
+    response = requests.get(f"{BASE_URL}{year}/{'/'.join(ACS_DATASET)}.json")
+    if response.status_code == 404:
+        return False
+    response.raise_for_status()
+    return bool(response.json().get('dataset'))
+
+def check_census(known:int) -> int:
+    """
+    Finds the newest ACS vintage by checking the years after the newest known one, one at a
+    time, so there is usually a single request.
+    Arguments:
+        - known = int; newest vintage already found
+    Returns int
+    """
+    newest = known
+    for year in range(known + 1, datetime.date.today().year + 1):
+        if not rate_limited('census', acs_vintage_exists)(year):
+            break
+        newest = year
+    return newest
+
+def check_bea() -> int:
+    """
+    Finds the newest year BEA has published for the CAINC1 table.
+    Returns int
+    """
+    bea_json = rate_limited('bea', bea_request)({
+        'method': 'GetParameterValuesFiltered',
+        'datasetname': 'Regional',
+        'TargetParameter': 'Year',
+        'TableName': 'CAINC1',
+    })
+    years = [int(value['Key']) for value in bea_json['BEAAPI']['Results']['ParamValue'] if value['Key'].isdigit()]
+    return max(years)
+
+def _checked(source:str, func, *args):
+    """
+    Runs a check, printing a warning and returning None if it fails.
+    """
+    try:
+        return func(*args)
+    except Exception as err:
+        print(f"WARNING: couldn't check {source} for new data ({err}), trying again next run")
+        return None
+
+def check_sources(watermark:dict, config_file:str=bls_batch.BLS_CONFIG_FILE) -> dict:
+    """
+    Runs every check at the same time.
+    Arguments:
+        - watermark = dict; the current watermark, see read_watermark()
+        - config_file = str; path to the bls_config.yaml file
+    Returns dict with what each source has published, a source is left out if its check failed.
+    """
+    series_ids = sorted({series_id for series_ids,_,_ in bls_batch.bls_requests(config_file).values()
+                         for series_id in series_ids})
+    known_census = max(BASE_VINTAGES['census'], watermark['published'].get('census') or 0)
+
+    fetches = FetchExecutor()
+    fetches.add('bls', _checked, 'bls', check_bls, series_ids)
+    fetches.add('census', _checked, 'census', check_census, known_census)
+    fetches.add('bea', _checked, 'bea', check_bea)
+    return {source: result for source,result in fetches.run().items() if result is not None}
+
+#####
+#### Rebuilding ####
+#####
+
+def outdated_nodes(published:dict, built:dict, config_file:str=bls_batch.BLS_CONFIG_FILE) -> dict:
+    """
+    Works out which build.py nodes read data that is newer than what they were last built from.
+    Arguments:
+        - published = dict; what each source has published, see check_sources()
+        - built = dict; what the outputs were last built from
+        - config_file = str; path to the bls_config.yaml file
+    Returns dict mapping each node name to a list of the reasons it is out of date.
+    """
+    nodes = {}
+    built_months = built.get('bls', {})
+    for name, (series_ids,_,_) in bls_batch.bls_requests(config_file).items():
+        for series_id in series_ids:
+            month = published.get('bls', {}).get(series_id)
+            if month and month > built_months.get(series_id, ''):
+                for node in REQUEST_NODES.get(name, [f"bls:{name}"]):
+                    nodes.setdefault(node, []).append(f"{series_id} {month}")
+
+    for source, source_nodes in VINTAGE_NODES.items():
+        year = published.get(source)
+        if year and year > (built.get(source) or BASE_VINTAGES[source]):
+            for node in source_nodes:
+                nodes.setdefault(node, []).append(f"{source} {year}")
+    return nodes
+
+def rebuild(node_names:list) -> bool:
+    """
+    Runs build.py for the given nodes in a new process, so every script reads the new vintages
+    from the watermark when it is imported. BLS responses already in the cache are treated as
+    expired so the new months are downloaded.
+    Returns True if the build succeeded.
+    """
+    command = [sys.executable, BUILD_SCRIPT]
+    for name in node_names:
+        command += ['--node', name]
+    env = dict(os.environ, WAEDD_EXPIRE='bls')
+    return subprocess.run(command, env=env).returncode == 0
+
+def main():
+    """
+    Checks every source for new data and rebuilds the outputs that read it.
+    """
+    ap = argparse.ArgumentParser(description="Rebuilds the outputs whose BLS, Census or BEA data has been updated.")
+    ap.add_argument('--dry-run', action='store_true', help="only report what has new data, don't rebuild or update the watermark")
+    args = ap.parse_args()
+
+    watermark = read_watermark()
+    published = check_sources(watermark)
+    nodes = outdated_nodes(published, watermark['built'])
+
+    if published.get('census', 0) > (watermark['built'].get('census') or BASE_VINTAGES['census']):
+        print(f"ACS {published['census']} 5-year data is out. distress.py and profiles.py use it on their own, "
+              "section_5.py needs its ACS_YEAR and labels updated by hand.")
+    if not nodes:
+        print("everything is up to date")
+    for name, reasons in sorted(nodes.items()):
+        print(f"{name}: {', '.join(reasons)}")
+    if args.dry_run:
+        return
+
+    watermark['published'].update({source: value for source,value in published.items() if source != 'bls'})
+    watermark['published'].setdefault('bls', {}).update(published.get('bls', {}))
+    watermark['checked'] = datetime.datetime.now().isoformat(timespec='seconds')
+    save_watermark(watermark)
+    if not nodes:
+        return
+
+    if not rebuild(sorted(nodes)):
+        print("build failed, the watermark wasn't moved so the build is tried again next run")
+        sys.exit(1)
+
+    for source, value in published.items():
+        if source == 'bls':
+            watermark['built'].setdefault('bls', {}).update(value)
+        else:
+            watermark['built'][source] = value
+    save_watermark(watermark)
+
+if __name__ == '__main__':
+    main()
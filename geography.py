@@ -0,0 +1,187 @@
+"""
+geography.py
+
+One index of every geography the site reports on, so the scripts look codes up instead of
+repeating them. Each geography in waedd_data/az_geography.json has its FIPS code, name, Census
+name, land area, BLS LAUS area code and BEA GeoFips, and everything else is worked out from those:
+    - Census `for` and `in` clauses, batched into one query per geography level
+    - LAUS series IDs for any measure (unemployment rate, employment and so on)
+    - the codes of config entries that only name their geography, see resolve()
+
+The file is read once per process and every lookup (by FIPS code, name or Census name) is a
+dict lookup. To add a geography, add it to the json file with its codes from the
+Census Bureau (https://www.census.gov/geographies/reference-files.html) and BLS
+(https://download.bls.gov/pub/time.series/la/la.area).
+
+usage:
+    index = load_index()
+    index.series_id('Yuma County')                              #'LAUCN040270000000003'
+    index.census_geographies(['Yuma County', 'La Paz County'])  #[{'for': 'county:027,012', 'in': 'state:04'}]
+"""
+import functools
+import json
+import os
+
+GEOGRAPHY_FILE = os.path.join('waedd_data', 'az_geography.json')
+
+#LAUS measure codes, the last two digits of a LAUS series ID
+LAUS_MEASURES = {
+    'unemployment_rate': '03',
+    'unemployment': '04',
+    'employment': '05',
+    'labor_force': '06',
+}
+
+#column names used for each measure when a graph shows one geography
+LAUS_MEASURE_NAMES = {
+    'unemployment_rate': 'Unemployment Rate',
+    'unemployment': 'Unemployment',
+    'employment': 'Employment',
+    'labor_force': 'Labor Force',
+}
+
+#Census API geography for each level, and the number of FIPS digits the level adds to its parent
+CENSUS_LEVELS = {
+    'us': {'for': 'us', 'digits': 0},
+    'state': {'for': 'state', 'digits': 2},
+    'county': {'for': 'county', 'digits': 3},
+    'place': {'for': 'place', 'digits': 5},
+    'metro': {'for': 'metropolitan statistical area/micropolitan statistical area', 'digits': 5},
+}
+
+class GeographyIndex():
+    """
+    Looks geographies up by any of their codes or names.
+
+    Arguments:
+        path = str; location of the geography json file
+
+    Attributes:
+        geographies = list; every geography as a dict, in the order of the file
+    """
+    def __init__(self, path:str=GEOGRAPHY_FILE):
+
+        with open(path, encoding='utf-8') as geography_file:
+            self.geographies = json.load(geography_file)['geographies']
+
+        #every FIPS code, name and Census name points at its geography
+        self._by_key = {}
+        for geography in self.geographies:
+            for key in (geography['fips'], geography['name'], geography['census_name']):
+                if self._by_key.get(key, geography) is not geography:
+                    raise ValueError(f"'{key}' is used by more than one geography in {path}")
+                self._by_key[key] = geography
+
+    def get(self, key:str) -> dict:
+        """
+        Finds a geography by its FIPS code, name or Census name.
+        Arguments:
+            - key = str; like '04027', 'Yuma County' or 'Yuma County, Arizona'
+        Returns dict
+        """
+        try:
+            return self._by_key[key]
+        except KeyError:
+            raise KeyError(f"No geography '{key}' in {GEOGRAPHY_FILE}") from None
+
+    def series_id(self, key:str, measure:str='unemployment_rate', seasonally_adjusted:bool=False) -> str:
+        """
+        Returns the BLS LAUS series ID for a measure of a geography.
+        Arguments:
+            - key = str; FIPS code, name or Census name of the geography
+            - measure = str; one of the LAUS_MEASURES keys
+            - seasonally_adjusted = bool; BLS only seasonally adjusts state and national data
+        Returns str
+        """
+        geography = self.get(key)
+        if measure in geography.get('series', {}):
+            return geography['series'][measure]
+        if not geography['laus_area']:
+            raise KeyError(f"BLS doesn't publish {measure} for {geography['name']}")
+        return f"LA{'S' if seasonally_adjusted else 'U'}{geography['laus_area']}{LAUS_MEASURES[measure]}"
+
+    def laus_series(self, keys:list, measures:list) -> dict:
+        """
+        Creates the series IDs for every measure of every geography, and the column name each one
+        is shown under: the measure for a single geography, otherwise the geography name.
+        Arguments:
+            - keys = list; FIPS codes, names or Census names
+            - measures = list; LAUS_MEASURES keys
+        Returns dict mapping series ID to column name, in the order given.
+        """
+        series = {}
+        for key in keys:
+            name = self.get(key)['name']
+            for measure in measures:
+                if len(keys) == 1:
+                    series[self.series_id(key, measure)] = LAUS_MEASURE_NAMES[measure]
+                elif len(measures) == 1:
+                    series[self.series_id(key, measure)] = name
+                else:
+                    series[self.series_id(key, measure)] = f"{name} {LAUS_MEASURE_NAMES[measure]}"
+        return series
+
+    def census_clause(self, key:str) -> tuple:
+        """
+        Returns tuple of (level, code, in clause) for the Census API, like ('county', '027', 'state:04').
+        """
+        geography = self.get(key)
+        level = CENSUS_LEVELS[geography['level']]
+        if not level['digits']:
+            return level['for'], '1', ''
+        code = geography['fips'][-level['digits']:]
+        parent = geography['fips'][:-level['digits']]
+        return level['for'], code, f"state:{parent}" if parent else ''
+
+    def census_geographies(self, keys:list) -> list:
+        """
+        Creates the fewest Census `for` and `in` clauses that cover the geographies, one per level.
+        Arguments:
+            - keys = list; FIPS codes, names or Census names
+        Returns list of dicts with 'for', and 'in' when the level is inside a state.
+        """
+        levels = {}
+        for key in keys:
+            level, code, census_in = self.census_clause(key)
+            levels.setdefault((level, census_in), []).append(code)
+
+        clauses = []
+        for (level, census_in), codes in levels.items():
+            clause = {'for': f"{level}:{','.join(codes)}"}
+            if census_in:
+                clause['in'] = census_in
+            clauses.append(clause)
+        return clauses
+
+    def resolve(self, entry:dict) -> dict:
+        """
+        Fills in the codes of a config entry that names a geography, like the regions in
+        distress_regions.yaml. Anything given in the entry is kept as it is.
+        Arguments:
+            - entry = dict; config entry, with a 'geography' key to look up
+        Returns dict with name, census, census_in, bea and bls filled in.
+        """
+        if 'geography' not in entry:
+            return entry
+        geography = self.get(entry['geography'])
+        level, code, census_in = self.census_clause(geography['fips'])
+        resolved = {
+            'name': geography['name'],
+            'census': f"{level}:{code}",
+            'census_in': census_in,
+            'bls': self.series_id(geography['fips']),
+        }
+        if geography['bea']:
+            resolved['bea'] = geography['bea']
+        resolved.update(entry)
+        return resolved
+
+@functools.lru_cache(maxsize=None)
+def load_index(path:str=GEOGRAPHY_FILE) -> GeographyIndex:
+    """
+    Reads the geography index, once per process.
+    Arguments:
+        - path = str; location of the geography json file
+    Returns GeographyIndex
+    """
+    return GeographyIndex(path)
@@ -0,0 +1,118 @@
+"""
+html_table.py
+
+Renders tables as plain html <table> markup with CSS classes instead of a plotly go.Table. The
+markup has no javascript, so small tables can be put straight into a page without loading
+plotly.js, and search engines can read them. The styles for the classes are in css/waedd.css.
+
+Tables take the same fill color lists as go.Table: one entry per column (including the index
+column), where each entry is either a single color for the whole column or a list with one
+color per row.
+
+usage:
+    markup = dataframe_to_table(df, fill_colors=fill_colors, index_label='Criteria')
+    markup = figure_to_table(table_fig)
+"""
+import html
+
+#CSS classes for the colors used by the site's tables, other colors are set with a style attribute
+COLOR_CLASSES = {
+    'orange': 'waedd-cell-orange',
+    'white': 'waedd-cell-white',
+    'lightgrey': 'waedd-cell-lightgrey',
+    'yellow': 'waedd-cell-yellow',
+}
+
+def _cell_text(value) -> str:
+    """
+    Escapes a cell value. List-like values (like a pandas Index passed as a header) are joined.
+    """
+    if isinstance(value, (list, tuple)) or hasattr(value, 'tolist'):
+        value = value.tolist() if hasattr(value, 'tolist') else value
+        if isinstance(value, list):
+            return '<br>'.join(_cell_text(item) for item in value)
+    return html.escape(str(value))
+
+def _color_attr(color:str) -> str:
+    """
+    Converts a fill color to a class or style attribute.
+    """
+    if not color:
+        return ''
+    if color in COLOR_CLASSES:
+        return f' class="{COLOR_CLASSES[color]}"'
+    return f' style="background-color: {html.escape(color)};"'
+
+def _cell_color(fill_colors:list, col_num:int, row_num:int) -> str:
+    """
+    Finds the fill color of a cell from a go.Table style list of fill colors.
+    """
+    if not fill_colors or col_num >= len(fill_colors):
+        return None
+    col_color = fill_colors[col_num]
+    if isinstance(col_color, str) or col_color is None:
+        return col_color
+    return col_color[row_num] if row_num < len(col_color) else None
+
+def render_table(header:list, columns:list, fill_colors:list=None, header_color:str='orange',
+        caption:str=None) -> str:
+    """
+    Renders table markup from column values.
+    Arguments:
+        - header = list; header text for each column
+        - columns = list; a list of cell values for each column
+        - fill_colors = list; go.Table style fill colors, one entry per column
+        - header_color = str; fill color for the header row
+        - caption = str; optional table caption
+    Returns str
+    """
+    header_attr = _color_attr(header_color)
+    lines = ['<table class="waedd-table">']
+    if caption:
+        lines.append(f"<caption>{html.escape(caption)}</caption>")
+    lines.append('<thead><tr>' + ''.join(f"<th{header_attr}>{_cell_text(col)}</th>" for col in header) + '</tr></thead>')
+
+    lines.append('<tbody>')
+    num_rows = max((len(col) for col in columns), default=0)
+    for row_num in range(num_rows):
+        cells = []
+        for col_num, col in enumerate(columns):
+            tag = 'th scope="row"' if col_num == 0 else 'td'
+            value = _cell_text(col[row_num]) if row_num < len(col) else ''
+            cells.append(f"<{tag}{_color_attr(_cell_color(fill_colors, col_num, row_num))}>{value}</{tag.split()[0]}>")
+        lines.append('<tr>' + ''.join(cells) + '</tr>')
+    lines.append('</tbody>')
+    lines.append('</table>')
+    return '\n'.join(lines)
+
+def dataframe_to_table(df, fill_colors:list=None, index_label:str='', header_color:str='orange',
+        caption:str=None) -> str:
+    """
+    Renders a dataframe as table markup, with the index as the first column.
+    Arguments:
+        - df = pandas.DataFrame; data for the table
+        - fill_colors = list; go.Table style fill colors, one entry per column including the index
+        - index_label = str; header text for the index column
+        - header_color = str; fill color for the header row
+        - caption = str; optional table caption
+    Returns str
+    """
+    return render_table([index_label] + df.columns.to_list(),
+                        [df.index.to_list()] + [df[col].to_list() for col in df],
+                        fill_colors=fill_colors,
+                        header_color=header_color,
+                        caption=caption)
+
+def figure_to_table(fig) -> str:
+    """
+    Renders the go.Table in a plotly figure as table markup, keeping its values and fill colors.
+    Arguments:
+        - fig = plotly.graph_objects.Figure; a figure containing a single go.Table
+    Returns str
+    """
+    table = fig.data[0]
+    header_color = table.header.fill.color
+    return render_table(list(table.header.values),
+                        [list(col) for col in table.cells.values],
+                        fill_colors=table.cells.fill.color,
+                        header_color=header_color if isinstance(header_color, str) else None)
@@ -0,0 +1,109 @@
+"""
+indicators.py
+
+Computes the summary numbers the site shows for monthly BLS series (unemployment rates mostly)
+for every series at once. A BLS dataframe (one column per series, indexed by 'YYYY-MM') is
+converted to a monthly PeriodIndex once, and the indicators are worked out column-wise with
+NumPy instead of looking up each series and month on its own:
+    - latest_period, latest = the newest month each series has data for and its value
+    - peak_period, peak = the month with the highest value and that value
+    - vs_peak = latest - peak
+    - yoy_change = latest minus the value 12 months before it
+    - rolling_mean = the average of the `window` months ending at the newest month that every
+                     series has data for, so all series cover the same months
+    - vs:{reference} = latest minus the reference series (Arizona for example) in the same month
+
+Tables are cached on the contents of the dataframe and the options, so section_5.py, distress.py
+and anything else that asks for the same indicators in one process share the work.
+
+usage:
+    indicators = indicator_table(bls_data.clean_df(), references=['Arizona'])
+    indicators.loc['Yuma County', 'latest']
+"""
+import threading
+import numpy as np
+import pandas as pd
+from build_manifest import make_fingerprint
+
+#months in the rolling average unless another window is asked for
+DEFAULT_WINDOW = 24
+
+#indicator tables computed in this process, keyed on the dataframe contents and options
+_indicator_cache = {}
+_indicator_cache_lock = threading.Lock()
+
+def to_monthly(df:pd.DataFrame) -> pd.DataFrame:
+    """
+    Converts a BLS dataframe to numbers on a sorted monthly PeriodIndex. Months missing from the
+    data are added as NaN, so positions in the frame are whole months apart.
+    Arguments:
+        - df = pandas.DataFrame; indexed by 'YYYY-MM' strings (or anything pandas reads as a month)
+    Returns pandas.DataFrame
+    """
+    monthly = df.apply(pd.to_numeric, errors='coerce')
+    monthly.index = pd.PeriodIndex(df.index, freq='M')
+    monthly = monthly[~monthly.index.duplicated(keep='last')].sort_index()
+    return monthly.reindex(pd.period_range(monthly.index.min(), monthly.index.max(), freq='M'))
+
+def indicator_table(df:pd.DataFrame, window:int=DEFAULT_WINDOW, references:list=()) -> pd.DataFrame:
+    """
+    Computes every indicator for every series in a BLS dataframe. Results are cached for the
+    rest of the process, and each caller gets its own copy.
+    Arguments:
+        - df = pandas.DataFrame; one column per series, indexed by month
+        - window = int; months in the rolling average
+        - references = list; names of columns to compare every series with
+    Returns pandas.DataFrame with a row per series and a column per indicator.
+    """
+    key = make_fingerprint(df, {'window': window, 'references': list(references)})
+    with _indicator_cache_lock:
+        if key in _indicator_cache:
+            return _indicator_cache[key].copy()
+
+    table = _compute_indicators(to_monthly(df), window, references)
+    with _indicator_cache_lock:
+        _indicator_cache[key] = table
+    return table.copy()
+
+def _compute_indicators(monthly:pd.DataFrame, window:int, references:list) -> pd.DataFrame:
+    values = monthly.to_numpy(dtype=float)
+    valid = ~np.isnan(values)
+    periods = monthly.index
+    columns = np.arange(values.shape[1])
+
+    #last valid row of each column, counting back from the end
+    latest_pos = len(values) - 1 - np.argmax(valid[::-1], axis=0)
+    latest = values[latest_pos, columns]
+    peak_pos = np.argmax(np.where(valid, values, -np.inf), axis=0)
+    peak = values[peak_pos, columns]
+    year_ago_pos = latest_pos - 12
+    year_ago = np.where(year_ago_pos >= 0, values[np.maximum(year_ago_pos, 0), columns], np.nan)
+
+    #rolling average at the newest month every series has data for
+    common = np.flatnonzero(valid.all(axis=1))
+    rolling = monthly.rolling(window, min_periods=1).mean()
+    rolling_mean = rolling.iloc[common[-1]].to_numpy() if len(common) else np.full(len(columns), np.nan)
+
+    table = pd.DataFrame({
+        'latest_period': periods[latest_pos],
+        'latest': latest,
+        'peak_period': periods[peak_pos],
+        'peak': peak,
+        'vs_peak': latest - peak,
+        'yoy_change': latest - year_ago,
+        'rolling_mean': rolling_mean,
+    }, index=monthly.columns)
+    for reference in references:
+        table[f"vs:{reference}"] = latest - values[latest_pos, monthly.columns.get_loc(reference)]
+
+    #a series with no data at all has no latest or peak month
+    empty = ~valid.any(axis=0)
+    table.loc[empty, ['latest', 'peak', 'vs_peak', 'yoy_change']] = np.nan
+    table.loc[empty, ['latest_period', 'peak_period']] = pd.NaT
+    return table
+
+def month_label(period:pd.Period) -> str:
+    """
+    Formats a month the way the site writes it, like 'March 2021', in the current locale.
+    """
+    return period.strftime('%B %Y')
@@ -0,0 +1,70 @@
+/*
+ * plotly-figures.js
+ *
+ * Mounts figure json written by artifacts.py (WAEDD_FIGURE_OUTPUT=json) into a page. plotly.js is
+ * loaded once for the whole page, and only when the first figure scrolls into view. Each figure is
+ * fetched and drawn as it gets close to the viewport.
+ *
+ * usage:
+ *   <div class="plotly-figure" data-figure="./graphs/mean_weekly_wage.json" style="height: 600px;"></div>
+ *   <script src="./js/plotly-figures.js" defer></script>
+ *
+ * The plotly.js version comes from the data-plotlyjs-version attribute of this script tag if it is
+ * set, otherwise from the version recorded in the figure json.
+ */
+(function () {
+  'use strict';
+
+  var script = document.currentScript;
+  var pinnedVersion = script && script.getAttribute('data-plotlyjs-version');
+  var plotlyLoading = null;
+
+  function loadPlotly(version) {
+    if (!plotlyLoading) {
+      plotlyLoading = new Promise(function (resolve, reject) {
+        var tag = document.createElement('script');
+        tag.src = 'https://cdn.plot.ly/plotly-' + (pinnedVersion || version) + '.min.js';
+        tag.onload = function () { resolve(window.Plotly); };
+        tag.onerror = reject;
+        document.head.appendChild(tag);
+      });
+    }
+    return plotlyLoading;
+  }
+
+  function mount(element) {
+    fetch(element.getAttribute('data-figure'))
+      .then(function (response) { return response.json(); })
+      .then(function (figure) {
+        return loadPlotly(figure.plotlyjsVersion).then(function (Plotly) {
+          Plotly.newPlot(element, figure.data, figure.layout, figure.config);
+        });
+      })
+      .catch(function (err) {
+        console.error('Could not load figure ' + element.getAttribute('data-figure'), err);
+      });
+  }
+
+  function init() {
+    var figures = document.querySelectorAll('.plotly-figure[data-figure]');
+    if (!('IntersectionObserver' in window)) {
+      Array.prototype.forEach.call(figures, mount);
+      return;
+    }
+    var observer = new IntersectionObserver(function (entries) {
+      entries.forEach(function (entry) {
+        if (entry.isIntersecting) {
+          observer.unobserve(entry.target);
+          mount(entry.target);
+        }
+      });
+    }, { rootMargin: '200px 0px' });
+    Array.prototype.forEach.call(figures, function (figure) { observer.observe(figure); });
+  }
+
+  if (document.readyState === 'loading') {
+    document.addEventListener('DOMContentLoaded', init);
+  } else {
+    init();
+  }
+})();
@@ -5,65 +5,205 @@ Written By: Aaron Finocchiaro
 Functions to aggregate all population data for Yuma and La Paz Counties from azcommerce.com
 for use with the WAEDD website.
 """
+from __future__ import annotations
+import hashlib
+import json
 import os
 import re
+import shutil
+import urllib.error
 import urllib.request
-import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
+from typing import TYPE_CHECKING
+from artifacts import ARTIFACT_SOURCES, figure_paths, table_paths, write_figure, write_table
+from build_manifest import BuildManifest, code_version, make_fingerprint
+from data_cache import CACHE_DIR
+from tracing import annotate, traced
+
+if TYPE_CHECKING:
+    import pandas as pd
 
 WAEDD_DATA_DIR = "waedd_data"
+DOWNLOAD_META_DIR = os.path.join(CACHE_DIR, 'downloads')
+SNAPSHOT_DIR = os.path.join(CACHE_DIR, 'workbooks')
 POP_EST_EXCEL_URL = 'https://www.azcommerce.com/media/1546584/estimates1980-2020.xlsx'
 POP_PREDICTION_EXCEL_URL = 'https://www.azcommerce.com/media/1544636/pop-prj-sumtable-medium-series2018-az.xlsx'
+PREDICTION_REGIONS = ['Arizona', 'Yuma County', 'La Paz County']
+
+def current_population_files() -> tuple:
+    """
+    Returns tuple of (graph file, table file) without extensions for current_populations().
+    """
+    return "./graphs/current_population_pie", "./tables/current_population"
+
+def prediction_files() -> tuple:
+    """
+    Returns tuple of (list of graph files, table file) without extensions for population_predictions().
+    """
+    graph_files = [f"./graphs/{region.lower().replace(' ','_')}_pop_predictions" for region in PREDICTION_REGIONS]
+    return graph_files, "./tables/population_predictions"
+
+def current_population_outputs() -> list:
+    """
+    Lists every file current_populations() writes in the current output modes.
+    """
+    graph_file, table_file = current_population_files()
+    return figure_paths(graph_file) + table_paths(table_file)
+
+def prediction_outputs() -> list:
+    """
+    Lists every file population_predictions() writes in the current output modes.
+    """
+    graph_files, table_file = prediction_files()
+    return [path for graph_file in graph_files for path in figure_paths(graph_file)] + table_paths(table_file)
 
+@traced('fetch', 'download workbook')
 def download_file(url:str):
     """
     Downloads excel sheet from the given url and stores it in the waedd_data directory.
-    using the same file name from the url.
+    using the same file name from the url. If the file was downloaded before, the request is
+    conditional (ETag / If-Modified-Since) so it is only downloaded again when azcommerce.com
+    has a newer version. The file is written to a temp file first and then renamed, so a failed
+    download never leaves a partial workbook. If the download fails and a copy of the file
+    already exists, the existing copy is used.
     """
     excel_file = url.split('/')[-1]
-    print(f"Downloading {excel_file} from azcommerce.com")
-    if not os.path.exists(f"{WAEDD_DATA_DIR}"):
-        os.makedirs(f"{WAEDD_DATA_DIR}")
-    urllib.request.urlretrieve(url, f"./waedd_data/{excel_file}")
+    excel_path = os.path.join(WAEDD_DATA_DIR, excel_file)
+    os.makedirs(WAEDD_DATA_DIR, exist_ok=True)
+
+    #add validators from the last download if the file is still there
+    download_meta = _read_download_meta(url)
+    request = urllib.request.Request(url)
+    if os.path.exists(excel_path) and download_meta:
+        if download_meta.get('etag'):
+            request.add_header('If-None-Match', download_meta['etag'])
+        if download_meta.get('last_modified'):
+            request.add_header('If-Modified-Since', download_meta['last_modified'])
+
+    try:
+        with urllib.request.urlopen(request) as response:
+            print(f"Downloading {excel_file} from azcommerce.com")
+            tmp_path = f"{excel_path}.tmp{os.getpid()}"
+            with open(tmp_path, 'wb') as tmp_file:
+                shutil.copyfileobj(response, tmp_file)
+            os.replace(tmp_path, excel_path)
+            annotate(cache='miss', bytes=os.path.getsize(excel_path))
+            download_meta = {
+                'url': url,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+            }
+    except urllib.error.HTTPError as err:
+        annotate(cache='hit' if err.code == 304 else 'stale')
+        if err.code != 304:
+            if not os.path.exists(excel_path):
+                raise
+            print(f"WARNING: could not download {excel_file} ({err}), using existing copy")
+        return
+    except urllib.error.URLError as err:
+        if not os.path.exists(excel_path):
+            raise
+        print(f"WARNING: could not download {excel_file} ({err.reason}), using existing copy")
+        return
+
+    _write_download_meta(url, download_meta)
 
-def table_color(df:pd.DataFrame, index_color:str=None) -> list:
+def _download_meta_path(url:str) -> str:
+    #one file per url so workbooks downloaded by parallel build nodes don't overwrite each other
+    return os.path.join(DOWNLOAD_META_DIR, f"{hashlib.sha256(url.encode('utf-8')).hexdigest()[:16]}.json")
+
+def _read_download_meta(url:str) -> dict:
+    try:
+        with open(_download_meta_path(url), encoding='utf-8') as meta_file:
+            return json.load(meta_file)
+    except (OSError, ValueError):
+        return {}
+
+def _write_download_meta(url:str, download_meta:dict):
+    meta_path = _download_meta_path(url)
+    os.makedirs(DOWNLOAD_META_DIR, exist_ok=True)
+    tmp_path = f"{meta_path}.tmp{os.getpid()}"
+    with open(tmp_path, 'w', encoding='utf-8') as meta_file:
+        json.dump(download_meta, meta_file, indent=2)
+    os.replace(tmp_path, meta_path)
+
+@traced('transform')
+def read_workbook(excel_file:str, **read_excel_args) -> pd.DataFrame:
     """
-    constructs a list of colors that define the color of the plotly table.
+    Parses a sheet of an excel workbook into a dataframe. Parsing xlsx files is slow, so the parsed
+    dataframe is saved as a snapshot keyed on the workbook's content hash and the parsing options.
+    Later runs load the snapshot instead of parsing the workbook again until the workbook or pandas
+    changes, and older snapshots of the workbook with the same options are removed then. A snapshot
+    that can't be loaded is replaced.
     Arguments:
-        df = pandas.DataFrame; the dataframe used to construct the table
-        index_color = str; the color to use for the index column
-    returns list
+        - excel_file = str; path to the excel workbook
+        - read_excel_args = keyword arguments passed to pandas.read_excel
+    Returns pandas dataframe.
     """
-    fill_color = []
-    for col in [df.index.name] + df.columns.to_list():
-        if index_color and col == df.index.name:
-            fill_color.append(index_color)
-        else:
-            fill_color.append(['white', 'lightgrey']*len(df.index))
+    import pandas as pd
+
+    content_hash = hashlib.sha256()
+    with open(excel_file, 'rb') as workbook:
+        for chunk in iter(lambda: workbook.read(1024 * 1024), b''):
+            content_hash.update(chunk)
+    args_hash = hashlib.sha256(repr(sorted(read_excel_args.items())).encode('utf-8')).hexdigest()[:16]
+    snapshot_prefix = f"{os.path.basename(excel_file)}.{args_hash}."
+    #pickles from another pandas version may not load, so the version is part of the key
+    content_hash.update(pd.__version__.encode('utf-8'))
+    snapshot_file = os.path.join(SNAPSHOT_DIR, f"{snapshot_prefix}{content_hash.hexdigest()}.pkl")
 
-    return fill_color
+    if os.path.exists(snapshot_file):
+        try:
+            df = pd.read_pickle(snapshot_file)
+            annotate(cache='hit')
+            return df
+        except Exception as err:
+            print(f"WARNING: could not load the snapshot of {excel_file} ({err}), parsing it again")
+    annotate(cache='miss')
 
-def current_populations():
+    df = pd.read_excel(excel_file, **read_excel_args)
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    tmp_path = f"{snapshot_file}.tmp{os.getpid()}"
+    df.to_pickle(tmp_path)
+    os.replace(tmp_path, snapshot_file)
+
+    #snapshots of older versions of the workbook are never read again
+    for file_name in os.listdir(SNAPSHOT_DIR):
+        old_snapshot = os.path.join(SNAPSHOT_DIR, file_name)
+        if file_name.startswith(snapshot_prefix) and file_name.endswith('.pkl') and old_snapshot != snapshot_file:
+            try:
+                os.remove(old_snapshot)
+            except FileNotFoundError:
+                pass
+    return df
+
+def current_populations(manifest:BuildManifest=None):
     """
     Uses the excel sheet from the POP_EST_EXCEL_URL global variable above and
     parses into Pandas dataframe. This excel sheet contains the population estimates for the
-    current year and prior years.
+    current year and prior years. The graph and table are only written if the data or this
+    file changed since they were last built.
+
+    Arguments:
+        manifest = BuildManifest; the build manifest to check and update. If not given, the
+                   manifest file is loaded and saved by this function.
 
     Note that the `ignore_excel_lines` variable must be set to the lines in the excel sheet
     that should be ignored by pandas when parsing into a dataframe. The easiest way to figure
     out what lines should be ignored is to open the excel sheet and view the lines that don't
     contain data or headings but contain notes or other formatting (like titles).
     """
+    import plotly.express as px
+    import plotly.graph_objects as go
+    from table_rules import TABLE_RULES_SOURCES, fill_colors
+
     ignore_excel_lines = [129,130,131,132]
     excel_file = POP_EST_EXCEL_URL.split('/')[-1]
 
-    #download file if it doesn't exist in the waedd data dir
-    if not os.path.exists(f"{WAEDD_DATA_DIR}/{excel_file}"):
-        download_file(POP_EST_EXCEL_URL)
+    #download file if it doesn't exist in the waedd data dir or has been updated
+    download_file(POP_EST_EXCEL_URL)
 
     #parse excel sheet to pandas df, drop last col because it produces a column of NaN values
-    pop_df = pd.read_excel(f"./{WAEDD_DATA_DIR}/{excel_file}",
+    pop_df = read_workbook(f"./{WAEDD_DATA_DIR}/{excel_file}",
                             sheet_name='Estimates',
                             index_col=0,
                             skiprows=ignore_excel_lines)
@@ -73,11 +213,20 @@ def current_populations():
     graphing_df = pop_df.loc[['Yuma Total', 'La Paz Total'], [2020]]
     graphing_df = graphing_df.rename(index=lambda x: re.split(r'\*|\s(?=Total)', x)[0])
     graphing_df = graphing_df.sort_values(by=[2020], ascending=False)
+
+    #skip if nothing changed since the last build
+    save_manifest = manifest is None
+    manifest = manifest if manifest else BuildManifest()
+    graph_file, table_file = current_population_files()
+    fingerprint = make_fingerprint(graphing_df, code_version(__file__, *ARTIFACT_SOURCES, *TABLE_RULES_SOURCES))
+    if manifest.up_to_date(current_population_outputs(), fingerprint):
+        return
+
     fig = px.pie(graphing_df, values=2020, names=graphing_df.index)
     fig.update_traces(textinfo='percent+label')
 
     #set table colors
-    fill_color = table_color(graphing_df, index_color='orange')
+    fill_color = fill_colors(graphing_df, 'default')
 
     #create table
     table = go.Figure(data=[go.Table(
@@ -92,48 +241,69 @@ def current_populations():
                    align='left')
     )])
 
-    fig.write_html("./graphs/current_population_pie.html", include_plotlyjs='cdn')
-    table.write_html("./tables/current_population.html", include_plotlyjs='cdn')
+    for path in write_figure(fig, graph_file) + write_table(table, table_file):
+        manifest.record(path, fingerprint)
+    if save_manifest:
+        manifest.save()
 
-def population_predictions():
+def population_predictions(manifest:BuildManifest=None):
     """
     Parses the excel sheet from the POP_PREDICTION_EXCEL_URL global variable into a pandas
     dataframe. This excel sheet shows the projected populations for each county in Arizona
-    through 2055.
+    through 2055. The graphs and table are only written if the data or this file changed since
+    they were last built.
+
+    Arguments:
+        manifest = BuildManifest; the build manifest to check and update. If not given, the
+                   manifest file is loaded and saved by this function.
 
     Note that the `ignore_excel_lines` variable must be set to the lines in the excel sheet
     that should be ignored by pandas when parsing into a dataframe. The easiest way to figure
     out what lines should be ignored is to open the excel sheet and view the lines that don't
     contain data or headings but contain notes or other formatting (like titles).
     """
+    import plotly.express as px
+    import plotly.graph_objects as go
+    from downsample import DOWNSAMPLE_SOURCES, optimize_figure
+    from table_rules import TABLE_RULES_SOURCES, fill_colors
+
     excel_file = POP_PREDICTION_EXCEL_URL.split('/')[-1]
     ignore_excel_lines = [0,1,41,42,43,44]
-    regions = ['Arizona', 'Yuma County', 'La Paz County']
+    regions = PREDICTION_REGIONS
 
-    #download file if it doesn't exist in the waedd data dir
-    if not os.path.exists(f"{WAEDD_DATA_DIR}/{excel_file}"):
-        download_file(POP_PREDICTION_EXCEL_URL)
+    #download file if it doesn't exist in the waedd data dir or has been updated
+    download_file(POP_PREDICTION_EXCEL_URL)
 
     #read excel sheet and exclude certain rows from df
-    population_df = pd.read_excel(f"./{WAEDD_DATA_DIR}/{excel_file}",
+    population_df = read_workbook(f"./{WAEDD_DATA_DIR}/{excel_file}",
                                   index_col=0,
                                   skiprows=ignore_excel_lines)
 
+    #skip if nothing changed since the last build
+    save_manifest = manifest is None
+    manifest = manifest if manifest else BuildManifest()
+    graph_files, table_file = prediction_files()
+    fingerprint = make_fingerprint(population_df[regions], code_version(__file__, *ARTIFACT_SOURCES, *TABLE_RULES_SOURCES, *DOWNSAMPLE_SOURCES))
+    if manifest.up_to_date(prediction_outputs(), fingerprint):
+        return
+
     #graph data 1 graph per area
-    for region in regions:
+    for region, graph_file in zip(regions, graph_files):
         fig = px.line(population_df,
                       x=population_df.index,
                       y=region,
                       title=f'{region} Population Prediction 2018-2055')
         fig.update_traces(mode='markers+lines', hovertemplate='Pop=%{y}')
         fig.update_layout(hovermode='x')
-        fig.write_html(f"./graphs/{region.lower().replace(' ','_')}_pop_predictions.html", include_plotlyjs='cdn')
+        fig = optimize_figure(fig)
+        for path in write_figure(fig, graph_file):
+            manifest.record(path, fingerprint)
 
     #data is indexed by date, so data needs to be organized by column in a list
     col_vals = [population_df[col].to_list() for col in population_df[regions]]
 
     #create table colors
-    fill_color = table_color(population_df[regions], index_color='orange')
+    fill_color = fill_colors(population_df[regions], 'default')
 
     #create table
     table = go.Figure(data=[go.Table(
@@ -149,4 +319,7 @@ def population_predictions():
                    align='left')
     )])
     table.update_layout(height=275, margin=dict(l=0,r=0,t=0,b=0))
-    table.write_html("./tables/population_predictions.html", include_plotlyjs='cdn')
+    for path in write_table(table, table_file):
+        manifest.record(path, fingerprint)
+    if save_manifest:
+        manifest.save()
@@ -0,0 +1,301 @@
+"""
+post_build.py
+
+Prepares the site for the static host after the graphs, tables and pages are built. The source
+pages are left alone; everything the host serves is copied to an output directory (dist/ by
+default) and optimized there:
+    - html = comments are removed and runs of whitespace are collapsed to one space, in inline
+             scripts and styles too (outside of their strings and comments). Plotly's iframe documents
+             repeat a lot of indentation around their config and CDN scripts. If the minify-html
+             package is installed it is used instead, which fully minifies inline javascript and css
+    - hashing = with --hash, every graph and table is renamed to include a hash of its contents
+                (graphs/mean_weekly_wage.3f2a9c1b.html) and the iframe src and data-figure
+                references in the pages are updated. Hashed files never change, so the host can
+                serve them with immutable cache headers
+    - compression = a .gz copy (and a .br copy if the brotli package is installed) is written next
+                    to every text file, for hosts that serve precompressed files
+
+sitemap.xml in the source is also updated: the lastmod of each page is moved forward to the
+newest build time (from build_manifest.json) of the page itself and of the graphs and tables it
+embeds, so search engines see when the data on a page changed.
+
+The output is built in a temporary directory and swapped in at the end, so a failed run leaves the
+previous output in place.
+
+usage:
+    python post_build.py
+    python post_build.py --hash --out public
+"""
+import argparse
+import datetime
+import gzip
+import hashlib
+import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from build_manifest import MANIFEST_FILE, read_manifest
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import minify_html
+except ImportError:
+    minify_html = None
+
+OUTPUT_DIR = 'dist'
+SITEMAP_FILE = 'sitemap.xml'
+SITE_URL = 'https://www.waedd.org/'
+
+#source files and directories that are not part of the served site, along with anything starting with a dot
+EXCLUDE = {
+    '__pycache__', 'benchmarks', 'templates', 'waedd_data', OUTPUT_DIR,
+    'README.md', 'requirements.txt', 'requests.jsonl', MANIFEST_FILE, 'mohave_ID_codes.txt',
+}
+EXCLUDE_EXTENSIONS = ('.py', '.pyc', '.yaml', '.jsonl')
+
+#generated directories whose files can be content hashed
+HASHED_DIRS = ['graphs', 'tables']
+
+#files worth compressing, and the smallest file that is
+COMPRESSED_EXTENSIONS = ('.html', '.css', '.js', '.json', '.xml', '.svg', '.txt')
+MIN_COMPRESS_BYTES = 1024
+
+#raw text elements, only the whitespace between the tokens of scripts and styles is collapsed
+RAW_TEXT_PATTERN = re.compile(r"(<(script|style|pre|textarea)\b.*?</\2\s*>)", re.IGNORECASE | re.DOTALL)
+#strings and comments in scripts and styles (group 1, kept as they are) or a run of whitespace
+SCRIPT_TOKEN_PATTERN = re.compile(r"""("(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'|`(?:\\.|[^`\\])*`|/\*.*?\*/|//[^\n]*)|\s{2,}""", re.DOTALL)
+#comments, except conditional comments for old versions of internet explorer
+COMMENT_PATTERN = re.compile(r"<!--(?!\[if).*?-->", re.DOTALL)
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+#references from pages to generated files
+REFERENCE_PATTERN = re.compile(r"""((?:src|data-figure)=["'])(\.?/?)((?:graphs|tables)/[^"']+)(["'])""")
+#a <url> entry in sitemap.xml
+SITEMAP_URL_PATTERN = re.compile(r"(<url>\s*<loc>)([^<]+)(</loc>\s*<lastmod>)([^<]+)(</lastmod>)")
+
+#####
+## HTML ##
+#####
+
+def minify(text:str) -> str:
+    """
+    Minifies an html document. Pre and textarea contents are kept as they are, and script and
+    style contents only have their whitespace collapsed unless the minify-html package is installed.
+    Arguments:
+        - text = str; the html document
+    Returns str
+    """
+    if minify_html:
+        return minify_html.minify(text, minify_js=True, minify_css=True)
+
+    #split out the raw text elements, every odd part is one of them
+    parts = RAW_TEXT_PATTERN.split(text)
+    minified = []
+    for num, part in enumerate(parts):
+        if num % 3 == 0:
+            part = COMMENT_PATTERN.sub('', part)
+            part = WHITESPACE_PATTERN.sub(' ', part)
+            minified.append(part)
+        elif num % 3 == 1:
+            if parts[num + 1].lower() in ('script', 'style'):
+                part = SCRIPT_TOKEN_PATTERN.sub(_collapse_script_whitespace, part)
+            minified.append(part)
+    return ''.join(minified).strip()
+
+def _collapse_script_whitespace(match) -> str:
+    #a line break is kept as one so automatic semicolon insertion still works
+    if match[1]:
+        return match[1]
+    return '\n' if '\n' in match[0] else ' '
+
+def page_references(text:str) -> set:
+    """
+    Finds the graphs and tables a page embeds.
+    Returns set of paths like 'graphs/mean_weekly_wage.html'
+    """
+    return {match[2] for match in REFERENCE_PATTERN.findall(text)}
+
+def hashed_name(path:str, content:bytes) -> str:
+    """
+    Adds a short hash of the contents to a file name, graphs/x.html -> graphs/x.3f2a9c1b.html
+    """
+    root, extension = os.path.splitext(path)
+    return f"{root}.{hashlib.sha256(content).hexdigest()[:8]}{extension}"
+
+#####
+## Output ##
+#####
+
+def site_files(site_dir:str='.') -> list:
+    """
+    Lists every file of the served site.
+    Arguments:
+        - site_dir = str; root of the site source
+    Returns list of paths relative to site_dir, with / separators.
+    """
+    files = []
+    for root, dirs, names in os.walk(site_dir):
+        rel_root = os.path.relpath(root, site_dir)
+        dirs[:] = [name for name in dirs if name not in EXCLUDE and not name.startswith('.') and not name.endswith('.tmp')]
+        for name in names:
+            if name in EXCLUDE or name.startswith('.') or name.endswith(EXCLUDE_EXTENSIONS) or '.tmp' in name:
+                continue
+            files.append(os.path.normpath(os.path.join(rel_root, name)).replace(os.sep, '/'))
+    return sorted(files)
+
+def compress(path:str):
+    """
+    Writes precompressed copies of a file next to it.
+    """
+    with open(path, 'rb') as source:
+        content = source.read()
+    if len(content) < MIN_COMPRESS_BYTES:
+        return
+    #mtime=0 keeps the .gz identical between runs when the file hasn't changed
+    with open(f"{path}.gz", 'wb') as gz_file:
+        gz_file.write(gzip.compress(content, compresslevel=9, mtime=0))
+    if brotli:
+        with open(f"{path}.br", 'wb') as br_file:
+            br_file.write(brotli.compress(content))
+
+def build_output(out_dir:str=OUTPUT_DIR, site_dir:str='.', hash_names:bool=False) -> dict:
+    """
+    Copies the site to out_dir with minified html, optional content hashed graphs and tables, and
+    precompressed copies of every text file.
+    Arguments:
+        - out_dir = str; where the optimized site is written, replaced as a whole at the end
+        - site_dir = str; root of the site source
+        - hash_names = bool; rename graphs and tables to content hashed file names
+    Returns dict with the total size of the html files before ('source_bytes') and after
+    ('output_bytes') minifying.
+    """
+    tmp_dir = f"{out_dir}.tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+
+    #html is minified first, generated files need their final content before they can be hashed.
+    #everything else is copied as it is
+    out_prefix = os.path.relpath(out_dir, site_dir).replace(os.sep, '/') + '/'
+    files = [path for path in site_files(site_dir) if not path.startswith(out_prefix)]
+    contents = {}
+    for path in files:
+        if path.endswith('.html') or path.split('/')[0] in HASHED_DIRS:
+            with open(os.path.join(site_dir, path), 'rb') as source:
+                contents[path] = source.read()
+    source_bytes = sum(len(content) for path, content in contents.items() if path.endswith('.html'))
+    for path, content in contents.items():
+        if path.endswith('.html'):
+            contents[path] = minify(content.decode('utf-8')).encode('utf-8')
+
+    renamed = {}
+    if hash_names:
+        renamed = {path: hashed_name(path, content) for path, content in contents.items()
+                   if path.split('/')[0] in HASHED_DIRS}
+
+        def replace_reference(match):
+            return f"{match[1]}{match[2]}{renamed.get(match[3], match[3])}{match[4]}"
+
+        for path, content in contents.items():
+            if path.endswith('.html') and path.split('/')[0] not in HASHED_DIRS:
+                contents[path] = REFERENCE_PATTERN.sub(replace_reference, content.decode('utf-8')).encode('utf-8')
+
+    written = []
+    for path in files:
+        out_path = os.path.join(tmp_dir, renamed.get(path, path))
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        if path in contents:
+            with open(out_path, 'wb') as output:
+                output.write(contents[path])
+        else:
+            shutil.copy2(os.path.join(site_dir, path), out_path)
+        if out_path.endswith(COMPRESSED_EXTENSIONS):
+            written.append(out_path)
+
+    #zlib and brotli release the GIL, so compressing on threads uses every core
+    with ThreadPoolExecutor() as pool:
+        list(pool.map(compress, written))
+
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.replace(tmp_dir, out_dir)
+    return {'source_bytes': source_bytes,
+            'output_bytes': sum(len(content) for path, content in contents.items() if path.endswith('.html'))}
+
+#####
+## Sitemap ##
+#####
+
+def _parse_time(time:str) -> datetime.datetime:
+    #sitemap dates can leave out the time and timezone, those are read as UTC
+    parsed = datetime.datetime.fromisoformat(time)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=datetime.timezone.utc)
+
+def page_path(url:str, site_url:str=SITE_URL) -> str:
+    """
+    Finds the source file for a sitemap url.
+    Returns str path, or None if the url isn't a page of this site.
+    """
+    if not url.startswith(site_url):
+        return None
+    path = url[len(site_url):] or 'index.html'
+    return path if os.path.isfile(path) else None
+
+def update_sitemap(sitemap_file:str=SITEMAP_FILE, manifest_file:str=MANIFEST_FILE) -> list:
+    """
+    Moves the lastmod of every page in the sitemap forward to the newest build time of the page
+    and of the graphs and tables it embeds. Dates are never moved back, so edits to the pages
+    themselves keep their dates. The rest of the file is left exactly as it is.
+    Arguments:
+        - sitemap_file = str; path to sitemap.xml
+        - manifest_file = str; path to build_manifest.json
+    Returns list of the page urls that were updated.
+    """
+    _, built = read_manifest(manifest_file)
+    built = {os.path.normpath(path): _parse_time(time) for path, time in built.items()}
+    updated = []
+
+    def replace_lastmod(match):
+        path = page_path(match[2].strip())
+        if path is None:
+            return match[0]
+        with open(path, encoding='utf-8') as page:
+            sources = {path} | page_references(page.read())
+        build_times = [built[os.path.normpath(source)] for source in sources if os.path.normpath(source) in built]
+        lastmod = _parse_time(match[4].strip())
+        if not build_times or max(build_times) <= lastmod:
+            return match[0]
+        updated.append(match[2].strip())
+        return f"{match[1]}{match[2]}{match[3]}{max(build_times).isoformat(timespec='seconds')}{match[5]}"
+
+    #newline='' keeps the file's own line endings
+    with open(sitemap_file, encoding='utf-8', newline='') as sitemap:
+        text = sitemap.read()
+    text = SITEMAP_URL_PATTERN.sub(replace_lastmod, text)
+    if updated:
+        tmp_path = f"{sitemap_file}.tmp{os.getpid()}"
+        with open(tmp_path, 'w', encoding='utf-8', newline='') as sitemap:
+            sitemap.write(text)
+        os.replace(tmp_path, sitemap_file)
+    return updated
+
+def main():
+    """
+    Updates sitemap.xml and writes the optimized site.
+    """
+    ap = argparse.ArgumentParser(description="Minifies, hashes and precompresses the site into an output directory.")
+    ap.add_argument('--out', default=OUTPUT_DIR, help="output directory, replaced on every run")
+    ap.add_argument('--hash', action='store_true', help="rename graphs and tables to content hashed file names")
+    args = ap.parse_args()
+
+    for url in update_sitemap():
+        print(f"updated lastmod of {url}")
+    sizes = build_output(args.out, hash_names=args.hash)
+    print(f"wrote {args.out}: {sizes['source_bytes'] / 1024:.0f} KB -> {sizes['output_bytes'] / 1024:.0f} KB minified"
+          + ("" if brotli else " (install brotli for .br files)"))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+"""
+profiles.py
+
+Renders every community profile page (yuma-az.html, parker-az.html, yuma-county-az.html and so
+on) listed in profiles.yaml. The Census data for all of them is fetched with one ACS request for
+every place in Arizona and one for every county, the indicators for every profile are computed
+together as one dataframe, and every page is rendered from the shared profile template in one
+pass. Pages whose data and templates haven't changed are skipped.
+
+usage:
+    python profiles.py [--refresh]
+"""
+from __future__ import annotations
+import argparse
+import locale
+import os
+from typing import TYPE_CHECKING
+import yaml
+from build_manifest import BuildManifest
+from data_cache import evict, set_refresh
+from data_sources import census_data
+from fetch_executor import FetchExecutor
+from freshness import published_vintage
+from render import render_pages
+from tracing import traced
+import tracing
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+locale.setlocale(locale.LC_ALL, '')
+
+PROFILES_FILE = 'profiles.yaml'
+PROFILE_TEMPLATE = 'profile.html.jinja'
+PROFILE_TEMPLATE_DIR = os.path.join('templates', 'profiles')
+
+#newest ACS 5-year year that has been published, see freshness.py
+ACS_YEAR = published_vintage('census')
+
+#ACS profile variables shown on every page and the names they are given
+PROFILE_VARIABLES = {
+    'DP05_0001E': 'population',
+    'DP05_0018E': 'median_age',
+    'DP03_0051E': 'households',
+    'DP03_0062E': 'median_household_income',
+    'DP03_0088E': 'per_capita_income',
+    'DP03_0009PE': 'unemployment_rate',
+    'DP03_0128PE': 'poverty_rate',
+    'DP03_0025E': 'mean_travel_time',
+    'DP04_0089E': 'median_home_value',
+}
+
+def load_profiles(config_file:str=PROFILES_FILE) -> list:
+    """
+    Reads the profiles from the profiles.yaml file.
+    Arguments:
+        - config_file = str; path to the profiles.yaml file
+    Returns list of dicts, one per profile page.
+    """
+    with open(config_file) as profiles_yaml:
+        return yaml.load(profiles_yaml, Loader=yaml.FullLoader)['profiles']
+
+def profile_pages(profiles:list) -> list:
+    """
+    Creates the render.py page entry for every profile.
+    Returns list of dicts with the template, output and context of each page.
+    """
+    return [
+        {
+            'template': f"profiles/{profile['page']}.html.jinja",
+            'output': f"{profile['page']}.html",
+            'context': f"profile:{profile['page']}",
+        }
+        for profile in profiles
+    ]
+
+#####
+#### Data Requests ####
+#####
+
+#every Arizona place and every Arizona county, so adding a profile never adds a request
+_query = {'get': ','.join(['NAME'] + list(PROFILE_VARIABLES)), 'in': 'state:04'}
+DATA_REQUESTS = {
+    'places': (census_data, (['acs','acs5','profile'], ACS_YEAR, dict(_query, **{'for': 'place:*'})), {}),
+    'counties': (census_data, (['acs','acs5','profile'], ACS_YEAR, dict(_query, **{'for': 'county:*'})), {}),
+}
+
+def fetch_data() -> dict:
+    """
+    Requests the place and county data at the same time.
+    Returns dict of the fetched data objects keyed by the DATA_REQUESTS names.
+    """
+    fetches = FetchExecutor()
+    for name, (func, args, kwargs) in DATA_REQUESTS.items():
+        fetches.add(name, func, *args, **kwargs)
+    return fetches.run()
+
+@traced('transform')
+def profile_indicators(fetched:dict, profiles:list) -> pd.DataFrame:
+    """
+    Computes the indicators for every profile at once. Places are compared to their county by
+    joining the county rows onto the place rows.
+    Arguments:
+        - fetched = dict; data returned from fetch_data()
+        - profiles = list; the profiles from profiles.yaml
+    Returns pandas.DataFrame with a row per profile page and a column per indicator.
+    """
+    import pandas as pd
+
+    census_df = pd.concat([fetched[name].df for name in DATA_REQUESTS]).set_index('NAME')
+    values = census_df[list(PROFILE_VARIABLES)].apply(pd.to_numeric, errors='coerce').rename(columns=PROFILE_VARIABLES)
+
+    #the Census API uses large negative numbers for estimates that couldn't be made
+    values = values.where(values >= 0)
+
+    census_names = [profile['census_name'] for profile in profiles]
+    missing = [name for name in census_names if name not in values.index]
+    if missing:
+        raise KeyError(f"No Census data for {', '.join(missing)}. Check the census_name in {PROFILES_FILE}.")
+
+    indicators = values.loc[census_names].set_axis([profile['page'] for profile in profiles])
+    counties = values.reindex([profile.get('county') for profile in profiles]).set_axis(indicators.index)
+    indicators['avg_household_size'] = indicators['population'] / indicators['households']
+    indicators['share_of_county_population'] = indicators['population'] / counties['population'] * 100
+    indicators['income_vs_county'] = indicators['median_household_income'] / counties['median_household_income'] * 100
+    return indicators.round(2)
+
+def build_contexts(fetched:dict=None, profiles:list=None) -> dict:
+    """
+    Creates the context for every profile page.
+    Arguments:
+        - fetched = dict; data returned from fetch_data(), requested if not given
+        - profiles = list; the profiles from profiles.yaml, read if not given
+    Returns dict mapping each page's context name to its context_dict.
+    """
+    fetched = fetched if fetched else fetch_data()
+    profiles = profiles if profiles else load_profiles()
+    indicators = profile_indicators(fetched, profiles)
+
+    #missing values are None so the template can show them as N/A
+    indicators = indicators.astype(object).where(indicators.notna(), None)
+    return {
+        f"profile:{profile['page']}": {
+            'profile': profile,
+            'data': indicators.loc[profile['page']].to_dict(),
+            'acs_year': ACS_YEAR,
+        }
+        for profile in profiles
+    }
+
+def build_profiles(manifest:BuildManifest, fetched:dict=None):
+    """
+    Renders every profile page whose data or templates changed since the last build.
+    Arguments:
+        - manifest = BuildManifest; the build manifest to check and update
+        - fetched = dict; data returned from fetch_data(), requested if not given
+    """
+    profiles = load_profiles()
+    render_pages(build_contexts(fetched, profiles), manifest, profile_pages(profiles))
+
+def main():
+    """
+    Updates every community profile page with the newest data.
+    """
+    ap = argparse.ArgumentParser(description="Renders the community profile pages listed in profiles.yaml.")
+    ap.add_argument('--refresh', action='store_true', help="ignore cached API responses and download everything again")
+    ap.add_argument('--trace', metavar='FILE', help="record a timing and memory trace of the run to FILE (Chrome trace format)")
+    args = ap.parse_args()
+    set_refresh(args.refresh)
+    if args.trace:
+        tracing.enable(args.trace)
+
+    manifest = BuildManifest()
+    build_profiles(manifest)
+    manifest.save()
+    evict()
+    manifest.report()
+    tracing.finish()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+render.py
+
+Renders the site's jinja templates. Every page is registered in PAGES with the template it is
+rendered from and the name of the context it needs, so a script (or build.py) computes each
+context once and renders every page that uses it in one pass. Compiled templates are kept in an
+on-disk bytecode cache so templates are only compiled again when they change, and pages are
+rendered and written in parallel through the shared artifact writer (see artifacts.py), so a page
+is never left half written.
+
+usage:
+    render_pages({'workforce-development': context_dict}, manifest)
+"""
+import functools
+import os
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, meta
+from artifacts import write_text
+from build_manifest import BuildManifest, code_version, make_fingerprint
+from data_cache import CACHE_DIR
+from tracing import traced
+
+TEMPLATE_DIR = 'templates'
+BYTECODE_CACHE_DIR = os.path.join(CACHE_DIR, 'jinja')
+
+#every page rendered from a template. context = name of the context the page is rendered with
+PAGES = [
+    {'template': 'workforce-development.html.jinja', 'output': 'workforce-development.html', 'context': 'workforce-development'},
+    #the Mohave County regions were removed from the section 5 data, enable this once they are added back
+    # {'template': 'workforce-development_w_mohave.html.jinja', 'output': 'workforce-development_w_mohave.html', 'context': 'workforce-development'},
+]
+
+def comma_separated(number:int) -> str:
+    """
+    Custom Jinja filter to format numbers to be separated by commas.
+    Args:
+        - number; int passed from jinja template
+    returns str
+    """
+    return f"{number:n}"
+
+@functools.lru_cache(maxsize=None)
+def get_environment() -> Environment:
+    """
+    Creates the jinja environment shared by every page, with the site's filters and the on-disk
+    bytecode cache.
+    Returns jinja2.Environment
+    """
+    os.makedirs(BYTECODE_CACHE_DIR, exist_ok=True)
+    env = Environment(loader=FileSystemLoader(TEMPLATE_DIR),
+                      bytecode_cache=FileSystemBytecodeCache(BYTECODE_CACHE_DIR))
+    env.filters['comma_separated'] = comma_separated
+    return env
+
+def template_sources(template:str) -> list:
+    """
+    Finds the files a template is rendered from: the template itself and every template it
+    extends, includes or imports, so a change to a shared template re-renders every page using it.
+    Arguments:
+        - template = str; name of the template in TEMPLATE_DIR
+    Returns list of paths.
+    """
+    env = get_environment()
+    sources = []
+    to_visit = [template]
+    while to_visit:
+        name = to_visit.pop()
+        path = os.path.join(TEMPLATE_DIR, name)
+        if path in sources:
+            continue
+        sources.append(path)
+        source, _, _ = env.loader.get_source(env, name)
+        to_visit.extend(child for child in meta.find_referenced_templates(env.parse(source)) if child)
+    return sources
+
+@traced('render')
+def _render_page(page:dict, context_dict:dict) -> str:
+    template = get_environment().get_template(page['template'])
+    return template.render(context_dict=context_dict)
+
+def render_pages(contexts:dict, manifest:BuildManifest, pages:list=PAGES):
+    """
+    Queues every registered page whose context is given to be rendered and written. Pages are
+    skipped if their context and template haven't changed since the last build.
+    Arguments:
+        - contexts = dict; mapping of context name to the context_dict for its pages
+        - manifest = BuildManifest; the build manifest to check and update
+        - pages = list; the pages to render, defaults to every page in PAGES
+    """
+    for page in pages:
+        if page['context'] not in contexts:
+            continue
+        context_dict = contexts[page['context']]
+        fingerprint = make_fingerprint(context_dict, code_version(__file__, *template_sources(page['template'])))
+        if not manifest.up_to_date([page['output']], fingerprint):
+            write_text(page['output'], _render_page, page, context_dict)
+            manifest.record(page['output'], fingerprint)
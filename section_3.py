@@ -6,33 +6,54 @@ Creates all of the data for the section 3 graphs and tables. This will first run
 related to population data, and then handle the Bureau of Labor Statistics data.
 
 usage:
-    - python section_3.py
+    - python section_3.py [--refresh]
 """
-import yaml
-from bls_data.bls import BlsData
+import argparse
+from artifacts import ARTIFACT_SOURCES, figure_paths, table_paths, write_figure, write_table
+from bls_batch import BLS_CONFIG_FILE, get_bls_data, load_bls_sections
+from build_manifest import BuildManifest, code_version, make_fingerprint
+from data_cache import evict, set_refresh
 from population_data import current_populations, population_predictions
+from tracing import annotate, traced
+import tracing
 
-#####
-## Population Data ##
-#####
-current_populations()
-population_predictions()
-
-#####
-## Bureau of Labor Statistics data ##
-#####
-
-# read in yaml file
-with open('bls_config.yaml') as bls_yaml:
-    bls_list = yaml.load(bls_yaml, Loader=yaml.FullLoader)
-
-#iterate dict from yaml config
-for waedd_section in bls_list:
-    section_data = BlsData(
-        waedd_section['seriesIDs'],
-        waedd_section['start_year'],
-        waedd_section['end_year'],
-    )
+def load_bls_config(config_file:str=BLS_CONFIG_FILE) -> list:
+    """
+    Reads the sections from the bls_config.yaml file, see bls_batch.load_bls_sections().
+    Arguments:
+        - config_file = str; path to the bls_config.yaml file
+    Returns list of dicts, one per section.
+    """
+    return load_bls_sections(config_file)
+
+def section_outputs(waedd_section:dict) -> list:
+    """
+    Lists every file written for a bls_config.yaml section in the current output modes.
+    """
+    return figure_paths(f"./graphs/{waedd_section['filename']}") + table_paths(f"./tables/{waedd_section['filename']}")
+
+@traced('figure')
+def build_bls_section(waedd_section:dict, manifest:BuildManifest):
+    """
+    Creates the graph and table for a single section of the bls_config.yaml file. These are
+    skipped if the data and config haven't changed since the last build.
+    Arguments:
+        - waedd_section = dict; a section from the bls_config.yaml file
+        - manifest = BuildManifest; the build manifest to check and update
+    """
+    from downsample import DOWNSAMPLE_SOURCES, MAX_POINTS, WEBGL_THRESHOLD, optimize_figure
+    from table_rules import TABLE_RULES_SOURCES, fill_colors
+
+    #all sections are fetched together in one batch on the first call
+    section_data = get_bls_data(waedd_section['filename'])
+    annotate(section=waedd_section['filename'])
+    graph_file = f"./graphs/{waedd_section['filename']}"
+    table_file = f"./tables/{waedd_section['filename']}"
+
+    #skip this section if the data and config haven't changed since the last build
+    fingerprint = make_fingerprint(section_data.df, waedd_section, code_version(__file__, *ARTIFACT_SOURCES, *TABLE_RULES_SOURCES, *DOWNSAMPLE_SOURCES))
+    if manifest.up_to_date(section_outputs(waedd_section), fingerprint):
+        return
 
     #create graph and table
     fig = section_data.create_graph(waedd_section['graph_name'],
@@ -45,13 +66,16 @@ for waedd_section in bls_list:
     #change graph layout and modify graph mode or the hovertemplate if it is defined
     if waedd_section.get('graph_mode') or waedd_section.get('hovertemplate'):
         fig.update_traces(mode=waedd_section.get('graph_mode'), hovertemplate=waedd_section.get('hovertemplate'))
-        fig.update_layout(hovermode='x') 
+        fig.update_layout(hovermode='x')
     fig.update_layout(dragmode=False, legend=dict(title={'text':""},yanchor="top", y=1.02, xanchor='left', x=1, font=dict(size=8)))
 
     #hide the legend if the hide_legend value is set to true
     if waedd_section.get('hide_legend'):
         fig.update_layout(showlegend=False)
 
+    #downsample long series and draw large graphs with webgl, the table keeps every point
+    fig = optimize_figure(fig, waedd_section.get('max_points', MAX_POINTS), waedd_section.get('webgl_threshold', WEBGL_THRESHOLD))
+
     #create the table, set height and margins
     table = section_data.create_table(
             custom_column_names=waedd_section.get('custom_column_names'),
@@ -62,6 +86,48 @@ for waedd_section in bls_list:
     )
     table.update_layout(height=275, margin=dict(l=0,r=0,t=0,b=0))
 
-    #save graph and table to html files
-    fig.write_html(f"./graphs/{waedd_section['filename']}.html", include_plotlyjs='cdn')
-    table.write_html(f"./tables/{waedd_section['filename']}.html", include_plotlyjs='cdn')
+    #recolor the table cells if the section declares its own formatting rules
+    if waedd_section.get('table_rules'):
+        table_df = section_data.clean_df(waedd_section.get('custom_column_names'), True)
+        if waedd_section.get('sort_descending'):
+            table_df = table_df.sort_index(ascending=False)
+        table.update_traces(cells_fill_color=fill_colors(table_df, waedd_section['table_rules']))
+
+    #save graph and table to html, json or static table files
+    for path in write_figure(fig, graph_file) + write_table(table, table_file):
+        manifest.record(path, fingerprint)
+
+def main():
+    """
+    Creates every section 3 graph and table.
+    """
+    ap = argparse.ArgumentParser(description="Creates the section 3 graphs and tables.")
+    ap.add_argument('--refresh', action='store_true', help="ignore cached API responses and download everything again")
+    ap.add_argument('--trace', metavar='FILE', help="record a timing and memory trace of the run to FILE (Chrome trace format)")
+    args = ap.parse_args()
+    set_refresh(args.refresh)
+    if args.trace:
+        tracing.enable(args.trace)
+
+    #graphs and tables are only written when their data, config or this script changes
+    manifest = BuildManifest()
+
+    #####
+    ## Population Data ##
+    #####
+    current_populations(manifest)
+    population_predictions(manifest)
+
+    #####
+    ## Bureau of Labor Statistics data ##
+    #####
+    for waedd_section in load_bls_config():
+        build_bls_section(waedd_section, manifest)
+
+    manifest.save()
+    evict()
+    manifest.report()
+    tracing.finish()
+
+if __name__ == '__main__':
+    main()
@@ -6,7 +6,7 @@ Gathers data for section 5 from the US Census Bureau and the Bureau of Labor Sta
 and fills a Jinja template to update the HTML document.
 
 Usage:
-    python section_5.py
+    python section_5.py [--refresh]
 
 Adding more data:
     - To add a new source (so a new place where data needs to be requested from), add it 
@@ -16,168 +16,189 @@ Adding more data:
       it to the context_dict. Be sure to follow the sections and formatting to keep it easy
       to follow.
 """
-import calendar
-import datetime
+import argparse
 import locale
-import pandas as pd
-from jinja2 import FileSystemLoader, Environment
-from bls_data.bls import BlsData
-from pyCensus.censusdata import censusData
+from acs_variables import AcsData
+from bls_batch import SECTION_5_REGIONS, get_bls_data, section_5_series
+from build_manifest import BuildManifest
+from data_cache import evict, set_refresh
+from fetch_executor import FetchExecutor
+from geography import load_index
+from render import render_pages
+from tracing import traced
+import tracing
 
 #constants
 locale.setlocale(locale.LC_ALL, '')
-area_dict = {
-    # 'Kingman city, Arizona' : 2133,
-    # 'Lake Havasu City city, Arizona' : 2396,
-    # 'Bullhead City city, Arizona' : 2591,
-    'Yuma County, Arizona': 5519,
-    'La Paz County, Arizona': 4514
-}
-context_dict = dict()
-
-def comma_separated(number:int) -> str:
-    """
-    Custom Jinja filter to format numbers to be separated by commas.
-    Args:
-        - number; int passed from jinja template
-    returns str
-    """
-    return f"{number:n}"
+
+#the ACS labels below include the survey year, so this isn't moved forward by freshness.py
+ACS_YEAR = 2019
 
 #####
 #### Data Requests ####
 #####
 
-#request Census Bureau data
-county_econ_data = censusData(
-    ['acs','acs5','profile'],
-    2019,
-    {
-        'get': "group(DP03)",
-        'in' : "state:04",
-        'for': "county:027,012",
-    }
-)
-county_pop_data = censusData(
-    ['acs','acs5','profile'],
-    2019,
-    {
-        'get': "NAME,DP05_0001E",
-        'in' : "state:04",
-        'for': "county:027,012",
+def data_requests() -> dict:
+    """
+    Creates the Census Bureau requests for the regions in bls_batch.SECTION_5_REGIONS, every county
+    in one request with its geography from the geography index. Only the variables from each group
+    that this script and the templates reference are requested, see acs_variables.py
+    Returns dict mapping a request name to a tuple of (func, args, kwargs).
+    """
+    region_geography = load_index().census_geographies(SECTION_5_REGIONS)[0]
+    return {
+        'county_econ': (AcsData, (['acs','acs5','profile'], ACS_YEAR, 'DP03', region_geography), {}),
+        'county_pop': (AcsData, (['acs','acs5','profile'], ACS_YEAR, 'DP05', region_geography), {}),
     }
-)
-
-#request BLS Data
-bls_employment_data = BlsData(
-    ['LAUCN040120000000003', 'LAUCN040270000000003', 'LASST040000000000003'],
-    datetime.datetime.today().date().year - 10,
-    datetime.datetime.today().date().year
-)
-
-#create a cleaned df for each to work with. Also append county dataframes to regular city/town data for dataframes from census
-clean_acs_df = county_econ_data.clean_df()
-clean_acs_df = clean_acs_df.set_index("NAME")
-clean_county_acs_df = county_econ_data.clean_df()
-clean_pop_df = county_pop_data.clean_df()
-clean_pop_df = clean_pop_df.set_index("NAME")
-clean_bls_employment_df = bls_employment_data.clean_df()
-
-#add ACS survey year to context (mainly to show what year the data is pertenant to)
-context_dict['acs_year'] = county_econ_data.year
-
-#####
-#### Employment and Unemployment ####
-#####
-
-#current emplyment data from Census
-context_dict['employment'] = dict(clean_acs_df['Estimate!!EMPLOYMENT STATUS!!Population 16 years and over!!In labor force!!Civilian labor force!!Employed'])
-
-#iterate bls dataframe columns to get specific Unemployment datapoints
-for col in clean_bls_employment_df:
-
-    #Get current unemplyoment data. Adds a list of [month-year, unemployment_percentage] to context data.
-    current_valid = clean_bls_employment_df[col].last_valid_index()
-    context_dict[f"current_unemployment:{col}"] = [
-        f"{calendar.month_name[int(current_valid.split('-')[1])]} {current_valid.split('-')[0]}",
-        clean_bls_employment_df[col][current_valid]
-    ]
-
-    #Find point in time with highest unemployment data. Adds a list of [month-year, unemployment_percentage] to context data.
-    max_idx = clean_bls_employment_df[col].idxmax()
-    context_dict[f"max_unemployment:{col}"] = [
-        f"{calendar.month_name[int(max_idx.split('-')[1])]} {max_idx.split('-')[0]}",
-        clean_bls_employment_df[col][max_idx]
-    ]
-
-    #Difference between current unemployment for a region and the whole state of AZ. Adds a list of [unemployment_percentage, (higher|lower)]
-    #to context data.
-    state_diff = round(clean_bls_employment_df[col][current_valid] - clean_bls_employment_df['Arizona'][current_valid],2)
-    context_dict[f"current_unemployment_vs_AZ:{col}"] = [abs(state_diff), f"{'higher' if state_diff > 0 else 'lower'}"]
-
-    #Difference between peak unemployment and current. Adds a list of [unemployment_percentage, (higher|lower)]
-    #to context data.
-    peak_diff = round(clean_bls_employment_df[col][current_valid] - clean_bls_employment_df[col][max_idx],2)
-    context_dict[f"current_unemployment_vs_peak:{col}"] = [abs(peak_diff), f"{'higher' if peak_diff > 0 else 'lower'}"]
-
-#Per-industry employment data. Make a df of just the industry percents, then iterate the cols and locate the
-#top 3 percentages for each region. Add these to the context_dict with the industry names.
-industry_df = clean_acs_df.filter(regex=r'^Percent!!INDUSTRY!!Civilian employed population 16 years and over!!.*')
-industry_df = industry_df.rename(lambda x: x[len('Percent!!INDUSTRY!!Civilian employed population 16 years and over!!'):], axis=1)
-industry_df = industry_df.apply(pd.to_numeric)
-industry_df = industry_df.transpose()
 
-for col in industry_df.columns:
-    top_3 = industry_df[col].nlargest(3)
-    context_dict[f"top-industries:{col}"] = dict(top_3)
+#Census Bureau requests, BLS data comes from bls_batch
+DATA_REQUESTS = data_requests()
 
+def fetch_data() -> dict:
+    """
+    Requests the Census Bureau and BLS data at the same time.
+    Returns dict of the fetched data objects keyed by the DATA_REQUESTS names and 'bls_employment'.
+    """
+    fetches = FetchExecutor()
+    for name, (func, args, kwargs) in DATA_REQUESTS.items():
+        fetches.add(name, func, *args, **kwargs)
+    fetches.add('bls_employment', get_bls_data, 'section_5')
+    return fetches.run()
+
+@traced('transform')
+def build_context(fetched:dict=None) -> dict:
+    """
+    Pulls every data point used by the workforce-development template out of the fetched data.
+    Arguments:
+        - fetched = dict; data returned from fetch_data(), requested if not given
+    Returns the context_dict passed to the jinja template.
+    """
+    import pandas as pd
+    from indicators import indicator_table, month_label
+
+    fetched = fetched if fetched else fetch_data()
+    context_dict = dict()
+
+    county_econ_data = fetched['county_econ']
+    county_pop_data = fetched['county_pop']
+    bls_employment_data = fetched['bls_employment']
+
+    #create a cleaned df for each to work with. Also append county dataframes to regular city/town data for dataframes from census
+    clean_acs_df = county_econ_data.clean_df()
+    clean_acs_df = clean_acs_df.set_index("NAME")
+    clean_pop_df = county_pop_data.clean_df()
+    clean_pop_df = clean_pop_df.set_index("NAME")
+    clean_bls_employment_df = bls_employment_data.clean_df(custom_column_names=section_5_series())
+
+    #add ACS survey year to context (mainly to show what year the data is pertenant to)
+    context_dict['acs_year'] = county_econ_data.year
+
+    #####
+    #### Employment and Unemployment ####
+    #####
+
+    #current emplyment data from Census
+    context_dict['employment'] = dict(clean_acs_df['Estimate!!EMPLOYMENT STATUS!!Population 16 years and over!!In labor force!!Civilian labor force!!Employed'])
+
+    #current, peak and differences for every unemployment series at once, see indicators.py
+    unemployment = indicator_table(clean_bls_employment_df, references=['Arizona'])
+    unemployment['vs:Arizona'] = unemployment['vs:Arizona'].round(2)
+    unemployment['vs_peak'] = unemployment['vs_peak'].round(2)
+    for col, row in unemployment.iterrows():
+
+        #Current and highest unemployment. Adds a list of [month-year, unemployment_percentage] to context data.
+        context_dict[f"current_unemployment:{col}"] = [month_label(row['latest_period']), row['latest']]
+        context_dict[f"max_unemployment:{col}"] = [month_label(row['peak_period']), row['peak']]
+
+        #Difference between current unemployment for a region and the whole state of AZ, and between current and peak
+        #unemployment. Adds a list of [unemployment_percentage, (higher|lower)] to context data.
+        context_dict[f"current_unemployment_vs_AZ:{col}"] = [abs(row['vs:Arizona']), 'higher' if row['vs:Arizona'] > 0 else 'lower']
+        context_dict[f"current_unemployment_vs_peak:{col}"] = [abs(row['vs_peak']), 'higher' if row['vs_peak'] > 0 else 'lower']
+
+    #Per-industry employment data. Make a df of just the industry percents, then iterate the cols and locate the
+    #top 3 percentages for each region. Add these to the context_dict with the industry names.
+    industry_df = clean_acs_df.filter(regex=r'^Percent!!INDUSTRY!!Civilian employed population 16 years and over!!.*')
+    industry_df = industry_df.rename(lambda x: x[len('Percent!!INDUSTRY!!Civilian employed population 16 years and over!!'):], axis=1)
+    industry_df = industry_df.apply(pd.to_numeric)
+    industry_df = industry_df.transpose()
+
+    for col in industry_df.columns:
+        top_3 = industry_df[col].nlargest(3)
+        context_dict[f"top-industries:{col}"] = dict(top_3)
+
+
+    #####
+    #### Income data ####
+    #####
+
+    #Per capita income
+    context_dict['per_capita_income'] = dict(clean_acs_df['Estimate!!INCOME AND BENEFITS (IN 2019 INFLATION-ADJUSTED DOLLARS)!!Per capita income (dollars)'])
+
+    #Households making between $15k and $50k per year for each region. Labels are written out in full
+    #so acs_variables.py can find them.
+    context_dict['pct_hh_between_15_50'] = dict(round(
+        pd.to_numeric(clean_acs_df["Percent!!INCOME AND BENEFITS (IN 2019 INFLATION-ADJUSTED DOLLARS)!!Total households!!$15,000 to $24,999"]) +
+        pd.to_numeric(clean_acs_df["Percent!!INCOME AND BENEFITS (IN 2019 INFLATION-ADJUSTED DOLLARS)!!Total households!!$25,000 to $34,999"]) +
+        pd.to_numeric(clean_acs_df["Percent!!INCOME AND BENEFITS (IN 2019 INFLATION-ADJUSTED DOLLARS)!!Total households!!$35,000 to $49,999"]),2))
+
+    #####
+    #### Population and household data ####
+    #####
+
+    #total households
+    total_households_df = clean_acs_df["Estimate!!INCOME AND BENEFITS (IN 2019 INFLATION-ADJUSTED DOLLARS)!!Total households"]
+    context_dict['total_households'] = dict(total_households_df)
+
+    #City Population
+    context_dict['population'] = dict(clean_pop_df['Estimate!!SEX AND AGE!!Total population'])
+
+    #land area and population density, areas are square miles from the geography index
+    index = load_index()
+    context_dict['land_area'] = {index.get(region)['census_name']: index.get(region)['land_area'] for region in SECTION_5_REGIONS}
+    for region,area in context_dict['land_area'].items():
+        density = round(pd.to_numeric(clean_pop_df['Estimate!!SEX AND AGE!!Total population'].loc[region]) / area,2)
+        context_dict[f"pop_density:{region}"] = density
+
+    #avg household size
+    context_dict['avg_hh_size'] = dict(
+        round(pd.to_numeric(clean_pop_df['Estimate!!SEX AND AGE!!Total population']) / pd.to_numeric(total_households_df),2)
+    )
+
+    #Poverty rate in last 12 months
+    context_dict['poverty_rate'] = dict(
+        clean_acs_df["Percent!!PERCENTAGE OF FAMILIES AND PEOPLE WHOSE INCOME IN THE PAST 12 MONTHS IS BELOW THE POVERTY LEVEL!!All people"]
+    )
+
+    return context_dict
+
+def render_page(context_dict:dict, manifest:BuildManifest):
+    """
+    Renders every page that uses the section 5 data (workforce-development.html) from its jinja
+    template. Pages are only rendered if the data or template changed since the last build.
+    Arguments:
+        - context_dict = dict; the context returned from build_context()
+        - manifest = BuildManifest; the build manifest to check and update
+    """
+    render_pages({'workforce-development': context_dict}, manifest)
 
-#####
-#### Income data ####
-#####
-
-#Per capita income
-context_dict['per_capita_income'] = dict(clean_acs_df['Estimate!!INCOME AND BENEFITS (IN 2019 INFLATION-ADJUSTED DOLLARS)!!Per capita income (dollars)'])
-
-#Households making between $15k and $50k per year for each region
-pct_income_benefits = 'Percent!!INCOME AND BENEFITS (IN 2019 INFLATION-ADJUSTED DOLLARS)!!'
-context_dict['pct_hh_between_15_50'] = dict(round(
-    pd.to_numeric(clean_acs_df[f"{pct_income_benefits}Total households!!$15,000 to $24,999"]) +
-    pd.to_numeric(clean_acs_df[f"{pct_income_benefits}Total households!!$25,000 to $34,999"]) +
-    pd.to_numeric(clean_acs_df[f"{pct_income_benefits}Total households!!$35,000 to $49,999"]),2))
-
-#####
-#### Population and household data ####
-#####
-
-#total households
-total_households_df = clean_acs_df["Estimate!!INCOME AND BENEFITS (IN 2019 INFLATION-ADJUSTED DOLLARS)!!Total households"]
-context_dict['total_households'] = dict(total_households_df)
-
-#City Population
-context_dict['population'] = dict(clean_pop_df['Estimate!!SEX AND AGE!!Total population'])
-
-#population density
-for region,area in area_dict.items():
-    density = round(pd.to_numeric(clean_pop_df['Estimate!!SEX AND AGE!!Total population'].loc[region]) / area,2)
-    context_dict[f"pop_density:{region}"] = density
-
-#avg household size
-context_dict['avg_hh_size'] = dict(
-    round(pd.to_numeric(clean_pop_df['Estimate!!SEX AND AGE!!Total population']) / pd.to_numeric(total_households_df),2)
-)
-
-#Poverty rate in last 12 months
-context_dict['poverty_rate'] = dict(
-    clean_acs_df["Percent!!PERCENTAGE OF FAMILIES AND PEOPLE WHOSE INCOME IN THE PAST 12 MONTHS IS BELOW THE POVERTY LEVEL!!All people"]
-)
-
-#prepare Jinja template
-file_loader = FileSystemLoader('templates')
-env = Environment(loader=file_loader)
-env.filters['comma_separated'] = comma_separated
-template = env.get_template("workforce-development.html.jinja")
-
-#open file and output a rendered jinja template
-with open("workforce-development.html", 'w', encoding='utf-8') as output_html:
-    output_html.write(template.render(context_dict=context_dict))
+def main():
+    """
+    Updates workforce-development.html with the newest data.
+    """
+    ap = argparse.ArgumentParser(description="Updates the section 5 data in workforce-development.html.")
+    ap.add_argument('--refresh', action='store_true', help="ignore cached API responses and download everything again")
+    ap.add_argument('--trace', metavar='FILE', help="record a timing and memory trace of the run to FILE (Chrome trace format)")
+    args = ap.parse_args()
+    set_refresh(args.refresh)
+    if args.trace:
+        tracing.enable(args.trace)
+
+    manifest = BuildManifest()
+    render_page(build_context(), manifest)
+    manifest.save()
+    evict()
+    manifest.report()
+    tracing.finish()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""
+table_rules.py
+
+Works out table cell colors from declarative conditional formatting rules. Each rule is checked
+against the whole dataframe at once with NumPy, so coloring a table with thousands of rows costs
+a handful of array operations instead of a Python loop per cell.
+
+Rules are declared in yaml, either with the table_rules key of a section in bls_config.yaml or as
+a named rule set in table_rules.yaml (for the population and distress tables, which don't come
+from a bls_config.yaml section). Rules are applied in order and later rules paint over earlier
+ones. Every rule can limit itself to some columns and rows:
+    - columns = list; column names, 'index' for the index column. Default is every data column
+    - rows = list; row positions, negative positions count from the bottom. Default is every row
+
+Rule types:
+    - stripe = alternates the colors in 'colors' down the rows
+    - fill = fills every selected cell with 'color'
+    - threshold = fills cells with 'color' when their value is 'below', 'above', 'at_most' or
+                  'at_least' the given number. Cells that aren't numbers never match.
+
+example:
+    table_rules:
+        - {type: stripe, colors: [white, lightgrey]}
+        - {type: fill, columns: [index], color: orange}
+        - {type: threshold, columns: [Threshold], rows: [1, 2], below: 0.8, color: yellow}
+
+usage:
+    from table_rules import fill_colors
+    cells=dict(values=..., fill_color=fill_colors(df, 'distress'))
+"""
+import functools
+import numpy as np
+import pandas as pd
+import yaml
+
+TABLE_RULES_FILE = 'table_rules.yaml'
+DEFAULT_RULES = 'default'
+
+#files that change how tables are colored, for build fingerprints
+TABLE_RULES_SOURCES = [__file__, TABLE_RULES_FILE]
+
+#comparisons allowed in threshold rules
+THRESHOLD_OPERATORS = {
+    'below': np.less,
+    'above': np.greater,
+    'at_most': np.less_equal,
+    'at_least': np.greater_equal,
+}
+
+@functools.lru_cache(maxsize=None)
+def load_rule_sets(rules_file:str=TABLE_RULES_FILE) -> dict:
+    """
+    Reads the named rule sets from the table_rules.yaml file.
+    Arguments:
+        - rules_file = str; path to the table_rules.yaml file
+    Returns dict mapping each rule set name to a list of rules.
+    """
+    with open(rules_file) as rules_yaml:
+        return yaml.load(rules_yaml, Loader=yaml.FullLoader)
+
+def resolve_rules(rules=None) -> list:
+    """
+    Finds the list of rules to apply.
+    Arguments:
+        - rules = list or str; a list of rules, the name of a rule set in table_rules.yaml, or
+                  None for the default rule set
+    Returns list of dicts
+    """
+    if rules is None:
+        rules = DEFAULT_RULES
+    if isinstance(rules, str):
+        rule_sets = load_rule_sets()
+        if rules not in rule_sets:
+            raise KeyError(f"No table rule set named '{rules}' in {TABLE_RULES_FILE}.")
+        return rule_sets[rules]
+    return rules
+
+def _column_mask(df:pd.DataFrame, columns:list=None) -> np.ndarray:
+    """
+    Selects matrix columns, where column 0 is the index and the rest are the dataframe columns.
+    """
+    if columns is None:
+        return np.arange(len(df.columns) + 1) > 0
+    names = np.array(['index'] + [str(col) for col in df.columns], dtype=object)
+    return np.isin(names, [str(col) for col in columns])
+
+def _row_mask(df:pd.DataFrame, rows:list=None) -> np.ndarray:
+    """
+    Selects rows by position.
+    """
+    mask = np.zeros(len(df.index), dtype=bool)
+    if rows is None:
+        mask[:] = True
+    else:
+        positions = np.array(rows, dtype=int)
+        mask[positions[(positions < len(mask)) & (positions >= -len(mask))]] = True
+    return mask
+
+def _numeric_values(df:pd.DataFrame) -> np.ndarray:
+    """
+    Converts the table to a float matrix lined up with the color matrix. The index column and
+    anything that isn't a number become NaN, which never passes a threshold.
+    """
+    values = df.apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+    return np.column_stack([np.full(len(df.index), np.nan), values])
+
+def color_matrix(df:pd.DataFrame, rules=None) -> np.ndarray:
+    """
+    Evaluates the rules against a dataframe.
+    Arguments:
+        - df = pandas.DataFrame; the data shown in the table
+        - rules = list or str; rules or the name of a rule set, see resolve_rules()
+    Returns numpy.ndarray of colors with one row per table row and one column per table column,
+    where column 0 is the index column. Cells that no rule matched are None.
+    """
+    colors = np.full((len(df.index), len(df.columns) + 1), None, dtype=object)
+    numeric_values = None
+    for rule in resolve_rules(rules):
+        mask = np.outer(_row_mask(df, rule.get('rows')), _column_mask(df, rule.get('columns')))
+        if rule['type'] == 'stripe':
+            stripes = np.array(rule['colors'], dtype=object)
+            row_colors = stripes[np.arange(len(df.index)) % len(stripes)]
+            colors = np.where(mask, row_colors[:, None], colors)
+        elif rule['type'] == 'fill':
+            colors[mask] = rule['color']
+        elif rule['type'] == 'threshold':
+            if numeric_values is None:
+                numeric_values = _numeric_values(df)
+            operators = [op for op in THRESHOLD_OPERATORS if op in rule]
+            if len(operators) != 1:
+                raise ValueError(f"Threshold rules need exactly one of: {', '.join(THRESHOLD_OPERATORS)}")
+            with np.errstate(invalid='ignore'):
+                passed = THRESHOLD_OPERATORS[operators[0]](numeric_values, rule[operators[0]])
+            colors[mask & passed] = rule['color']
+        else:
+            raise ValueError(f"Unknown table rule type '{rule['type']}'. Expected stripe, fill or threshold.")
+    return colors
+
+def fill_colors(df:pd.DataFrame, rules=None) -> list:
+    """
+    Evaluates the rules and arranges the colors the way go.Table and html_table.py expect them.
+    Arguments:
+        - df = pandas.DataFrame; the data shown in the table
+        - rules = list or str; rules or the name of a rule set, see resolve_rules()
+    Returns list with a list of colors for each column, starting with the index column.
+    """
+    return color_matrix(df, rules).T.tolist()
@@ -0,0 +1,214 @@
+"""
+tracing.py
+
+Optional instrumentation for the data scripts. When tracing is on, spans are recorded around each
+fetch, transform, figure build and file write with their wall time, memory use and details like
+cache hits and bytes downloaded. At the end of a run the spans are written as a Chrome trace-event
+JSON file (open it at chrome://tracing or https://ui.perfetto.dev) and a summary table is printed.
+
+Tracing is turned on with the --trace FILE flag of each script, or by setting the WAEDD_TRACE
+environment variable to the trace file path. When it is off, span() returns a shared no-op
+context manager and traced functions are called directly, so it costs one flag check per call.
+
+Each span records:
+    - wall time
+    - alloc_bytes = change in memory allocated by Python (tracemalloc) during the span
+    - peak_alloc_bytes = highest Python allocation seen so far in the run
+    - max_rss_kb = peak resident set size of the process so far
+    - anything added with annotate(), like cache='hit' or bytes=1234
+
+usage:
+    with span('clean bls', 'transform'):
+        df = bls_data.clean_df()
+
+    @traced('write')
+    def write_figure(fig, figure_path):
+        ...
+
+    annotate(cache='miss', bytes=len(body))
+"""
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  #not available on windows
+    resource = None
+
+TRACE_ENV = 'WAEDD_TRACE'
+
+_enabled = False
+_trace_file = None
+_events = []
+_events_lock = threading.Lock()
+_local = threading.local()
+_null_span = contextlib.nullcontext()
+
+def enable(trace_file:str=None):
+    """
+    Turns tracing on for this process.
+    Arguments:
+        - trace_file = str; where finish() writes the trace, None to only keep events in memory
+                       (used by build.py worker processes, which hand their events back)
+    """
+    global _enabled, _trace_file
+    _enabled = True
+    _trace_file = trace_file
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def enabled() -> bool:
+    """
+    Returns True if tracing is on.
+    """
+    return _enabled
+
+def _max_rss_kb() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else 0
+
+@contextlib.contextmanager
+def _span(name:str, category:str, args:dict):
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    span_args = dict(args)
+    stack.append(span_args)
+    alloc_start, _ = tracemalloc.get_traced_memory()
+    start = time.perf_counter_ns()
+    try:
+        yield span_args
+    finally:
+        end = time.perf_counter_ns()
+        alloc_end, alloc_peak = tracemalloc.get_traced_memory()
+        stack.pop()
+        span_args.update({
+            'alloc_bytes': alloc_end - alloc_start,
+            'peak_alloc_bytes': alloc_peak,
+            'max_rss_kb': _max_rss_kb(),
+        })
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': start / 1000,
+            'dur': (end - start) / 1000,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': span_args,
+        }
+        with _events_lock:
+            _events.append(event)
+
+def span(name:str, category:str='other', **args):
+    """
+    Records a span around a block of code.
+    Arguments:
+        - name = str; name of the span, like 'fetch census' or 'write ./graphs/mean_weekly_wage'
+        - category = str; fetch, transform, figure, write or render
+        - args = details to record with the span
+    Returns a context manager
+    """
+    if not _enabled:
+        return _null_span
+    return _span(name, category, args)
+
+def annotate(**args):
+    """
+    Adds details to the innermost open span in this thread, numbers are added to any value
+    already recorded. Does nothing when tracing is off.
+    """
+    if not _enabled or not getattr(_local, 'stack', None):
+        return
+    span_args = _local.stack[-1]
+    for key, val in args.items():
+        if isinstance(val, (int, float)) and isinstance(span_args.get(key), (int, float)):
+            span_args[key] += val
+        else:
+            span_args[key] = val
+
+def traced(category:str, name:str=None):
+    """
+    Decorator that records a span every time the function is called.
+    Arguments:
+        - category = str; fetch, transform, figure, write or render
+        - name = str; name of the span, defaults to the function name
+    """
+    def decorator(func):
+        span_name = name if name else func.__name__
+
+        @functools.wraps(func)
+        def traced_func(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _span(span_name, category, {}):
+                return func(*args, **kwargs)
+        return traced_func
+    return decorator
+
+def take_events() -> list:
+    """
+    Removes and returns the events recorded so far in this process.
+    """
+    global _events
+    with _events_lock:
+        events, _events = _events, []
+    return events
+
+def add_events(events:list):
+    """
+    Adds events recorded in another process, like a build.py worker.
+    """
+    with _events_lock:
+        _events.extend(events)
+
+def summary(events:list) -> list:
+    """
+    Totals the events by category and name.
+    Returns list of dicts sorted by total time, slowest first.
+    """
+    totals = {}
+    for event in events:
+        key = (event['cat'], event['name'])
+        total = totals.setdefault(key, {'category': event['cat'], 'name': event['name'], 'count': 0,
+                                        'total_ms': 0.0, 'max_ms': 0.0, 'alloc_bytes': 0,
+                                        'bytes': 0, 'cache_hits': 0, 'cache_misses': 0})
+        total['count'] += 1
+        total['total_ms'] += event['dur'] / 1000
+        total['max_ms'] = max(total['max_ms'], event['dur'] / 1000)
+        total['alloc_bytes'] = max(total['alloc_bytes'], event['args'].get('alloc_bytes', 0))
+        total['bytes'] += event['args'].get('bytes', 0)
+        total['cache_hits'] += event['args'].get('cache') == 'hit'
+        total['cache_misses'] += event['args'].get('cache') == 'miss'
+    return sorted(totals.values(), key=lambda total: total['total_ms'], reverse=True)
+
+def print_summary(events:list):
+    """
+    Prints the summary table for the events.
+    """
+    print(f"{'category':<10} {'name':<40} {'count':>5} {'total ms':>10} {'max ms':>9} {'max alloc KB':>12} {'KB down':>8} {'hit/miss':>8}")
+    for total in summary(events):
+        print(f"{total['category']:<10} {total['name'][:40]:<40} {total['count']:>5} {total['total_ms']:>10.1f} "
+              f"{total['max_ms']:>9.1f} {total['alloc_bytes'] / 1024:>12.0f} {total['bytes'] / 1024:>8.0f} "
+              f"{total['cache_hits']:>3}/{total['cache_misses']:<4}")
+
+def finish():
+    """
+    Writes the trace file and prints the summary table. Does nothing when tracing is off or the
+    trace has no file.
+    """
+    if not _enabled or not _trace_file:
+        return
+    events = take_events()
+    with open(_trace_file, 'w', encoding='utf-8') as trace:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace)
+    print_summary(events)
+    print(f"wrote trace to {_trace_file}")
+
+#turn tracing on from the environment so scripts without a --trace flag can be traced too
+if os.environ.get(TRACE_ENV):
+    enable(os.environ[TRACE_ENV])
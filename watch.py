@@ -0,0 +1,249 @@
+"""
+watch.py
+
+Watch mode for editing the site. Builds everything once, then keeps the imports and all of the
+fetched data in memory and watches the files that graphs, tables and pages are built from. When
+one of them changes, only the outputs it affects are built again:
+    - bls_config.yaml = the sections whose entry changed (new series are fetched first)
+    - distress_regions.yaml = the distress graph and tables, with the data fetched again
+    - table_rules.yaml = every table, unchanged ones are still skipped by the build manifest
+    - templates/ = the pages rendered from the changed templates. The context is rebuilt first
+                   if the template references different ACS variables
+    - waedd_data/ = the population graph and table for the changed workbook
+    - waedd_data/az_geography.json = everything that looks codes up in the geography index (the
+                                     bls_config.yaml sections, the distress page and section 5)
+    - profiles.yaml, templates/profiles/, templates/profile.html.jinja = the community profile pages
+
+Files are polled for changes, so no extra packages are needed. A mistake in a config file or
+template prints the error and keeps watching, so fixing the file triggers the next build.
+
+usage:
+    python watch.py
+    python watch.py --interval 0.5 --refresh
+"""
+import argparse
+import os
+import time
+import traceback
+import acs_variables
+import bls_batch
+import build
+import distress
+import geography
+import population_data
+import profiles
+import render
+import section_3
+import section_5
+import table_rules
+from build_manifest import BuildManifest
+from data_cache import evict, set_refresh
+
+#files and directories that outputs are built from
+WATCHED_PATHS = [
+    bls_batch.BLS_CONFIG_FILE,
+    bls_batch.DISTRESS_CONFIG_FILE,
+    table_rules.TABLE_RULES_FILE,
+    render.TEMPLATE_DIR,
+    population_data.WAEDD_DATA_DIR,
+    profiles.PROFILES_FILE,
+    profiles.PROFILE_TEMPLATE_DIR,
+]
+
+#population graph builder for each workbook in waedd_data
+WORKBOOK_BUILDERS = {
+    population_data.POP_EST_EXCEL_URL.split('/')[-1]: population_data.current_populations,
+    population_data.POP_PREDICTION_EXCEL_URL.split('/')[-1]: population_data.population_predictions,
+}
+
+#seconds to wait for an editor to finish saving before building
+SETTLE_TIME = 0.1
+
+def snapshot(paths:list=WATCHED_PATHS) -> dict:
+    """
+    Records the modification time and size of every watched file.
+    Arguments:
+        - paths = list; files and directories to watch, directories are not searched recursively
+    Returns dict mapping each file path to a tuple of (mtime_ns, size).
+    """
+    files = {}
+    for path in paths:
+        if os.path.isdir(path):
+            entries = [entry.path for entry in os.scandir(path) if entry.is_file() and '.tmp' not in entry.name]
+        else:
+            entries = [path]
+        for entry in entries:
+            try:
+                stat = os.stat(entry)
+            except FileNotFoundError:
+                continue
+            files[os.path.normpath(entry)] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+def changed_files(before:dict, after:dict) -> list:
+    """
+    Compares two snapshots.
+    Returns sorted list of the files that were added, removed or modified.
+    """
+    return sorted(path for path in before.keys() | after.keys() if before.get(path) != after.get(path))
+
+class SiteWatcher():
+    """
+    Holds the fetched data for the site between builds and works out what to build when a
+    watched file changes.
+
+    Attributes:
+        sections = dict; the bls_config.yaml sections by filename, as of the last build
+        distress_data = dict; the data fetched for the distress page, see distress.fetch_data()
+        profile_data = dict; the data fetched for the profile pages, see profiles.fetch_data()
+        contexts = dict; the context_dict for each page context, see build.CONTEXTS
+        acs_references = tuple; the ACS variable codes and labels the templates referenced when
+                         the contexts were built
+    """
+    def __init__(self):
+
+        self.sections = {}
+        self.distress_data = None
+        self.profile_data = None
+        self.contexts = {}
+        self.acs_references = None
+
+    def build_all(self):
+        """
+        Fetches all of the data once and builds every output.
+        """
+        manifest = BuildManifest()
+        bls_batch.prefetch_bls_data()
+        for build_func in WORKBOOK_BUILDERS.values():
+            build_func(manifest)
+        self._build_sections(manifest, section_3.load_bls_config())
+        self.distress_data = distress.fetch_data()
+        distress.build_distress(manifest, self.distress_data)
+        self.profile_data = profiles.fetch_data()
+        profiles.build_profiles(manifest, self.profile_data)
+        self._build_contexts(manifest)
+        render.render_pages(self.contexts, manifest)
+        manifest.save()
+        manifest.report()
+        evict()
+
+    def rebuild(self, changed:list):
+        """
+        Builds the outputs affected by the changed files.
+        Arguments:
+            - changed = list; paths of the watched files that changed
+        """
+        changed = [os.path.normpath(path) for path in changed]
+        rules_changed = table_rules.TABLE_RULES_FILE in changed
+        geography_changed = os.path.normpath(geography.GEOGRAPHY_FILE) in changed
+        config_changed = bls_batch.BLS_CONFIG_FILE in changed or geography_changed
+        regions_changed = bls_batch.DISTRESS_CONFIG_FILE in changed or geography_changed
+        manifest = BuildManifest()
+
+        if rules_changed:
+            table_rules.load_rule_sets.cache_clear()
+        if geography_changed:
+            geography.load_index.cache_clear()
+
+        #fetch any series added to either config, the store only requests what is missing
+        if config_changed or regions_changed:
+            bls_batch.preload_bls_data(bls_batch.fetch_bls_data(list(bls_batch.bls_requests().values())))
+
+        if config_changed or rules_changed:
+            sections = section_3.load_bls_config()
+            if not rules_changed:
+                sections = [waedd_section for waedd_section in sections
+                            if self.sections.get(waedd_section['filename']) != waedd_section]
+            self._build_sections(manifest, sections)
+
+        if regions_changed:
+            distress.DATA_REQUESTS = distress.data_requests()
+            self.distress_data = distress.fetch_data()
+        if regions_changed or rules_changed:
+            distress.build_distress(manifest, self.distress_data)
+
+        workbooks = {os.path.basename(path) for path in changed
+                     if os.path.dirname(path) == os.path.normpath(population_data.WAEDD_DATA_DIR)}
+        for excel_file, build_func in WORKBOOK_BUILDERS.items():
+            if excel_file in workbooks or rules_changed:
+                build_func(manifest)
+
+        templates = {os.path.basename(path) for path in changed
+                     if os.path.dirname(path) == os.path.normpath(render.TEMPLATE_DIR)}
+        if templates or geography_changed:
+            pages = [page for page in render.PAGES if page['template'] in templates]
+            if geography_changed:
+                section_5.DATA_REQUESTS = section_5.data_requests()
+            if geography_changed or acs_variables.scan_references() != self.acs_references:
+                self._build_contexts(manifest)
+                pages = render.PAGES
+            render.render_pages(self.contexts, manifest, pages)
+
+        profile_templates = os.path.normpath(profiles.PROFILE_TEMPLATE_DIR)
+        if (profiles.PROFILES_FILE in changed or profiles.PROFILE_TEMPLATE in templates
+                or any(os.path.dirname(path) == profile_templates for path in changed)):
+            profiles.build_profiles(manifest, self.profile_data)
+
+        manifest.save()
+        manifest.report()
+        evict()
+
+    def _build_sections(self, manifest:BuildManifest, sections:list):
+        for waedd_section in sections:
+            section_3.build_bls_section(waedd_section, manifest)
+        self.sections = {waedd_section['filename']: waedd_section for waedd_section in section_3.load_bls_config()}
+
+    def _build_contexts(self, manifest:BuildManifest):
+        #section_5 plans its ACS requests from the templates when DATA_REQUESTS is built
+        self.acs_references = acs_variables.scan_references()
+        self.contexts = {name: context['func'](manifest) for name, context in build.CONTEXTS.items()}
+
+    def watch(self, interval:float=1.0):
+        """
+        Polls the watched files until interrupted and builds whatever a change affects.
+        Arguments:
+            - interval = float; seconds between checks
+        """
+        files = snapshot()
+        print(f"watching {', '.join(WATCHED_PATHS)} (Ctrl+C to stop)")
+        while True:
+            time.sleep(interval)
+            changed = changed_files(files, snapshot())
+            if not changed:
+                continue
+
+            #let the editor finish writing before reading the files
+            time.sleep(SETTLE_TIME)
+            print(f"changed: {', '.join(changed)}")
+            start = time.perf_counter()
+            try:
+                self.rebuild(changed)
+            except Exception:
+                traceback.print_exc()
+                print("build failed, waiting for the next change")
+            else:
+                print(f"built in {time.perf_counter() - start:.2f}s")
+
+            #snapshot after building so files the build writes (like downloaded workbooks) aren't picked up as changes
+            files = snapshot()
+
+def main():
+    """
+    Builds the site once and then rebuilds outputs as their files change.
+    """
+    ap = argparse.ArgumentParser(description="Rebuilds graphs, tables and pages as the files they are built from change.")
+    ap.add_argument('--interval', type=float, default=1.0, help="seconds between checks for changed files")
+    ap.add_argument('--refresh', action='store_true', help="ignore cached API responses for the first build")
+    args = ap.parse_args()
+
+    set_refresh(args.refresh)
+    watcher = SiteWatcher()
+    watcher.build_all()
+    set_refresh(False)
+    try:
+        watcher.watch(args.interval)
+    except KeyboardInterrupt:
+        print("stopped watching")
+
+if __name__ == '__main__':
+    main()